@@ -18,6 +18,8 @@
 #
 #   Version v.0.1
 
+import heapq
+import re
 import struct
 import sys
 from datetime import datetime
@@ -249,6 +251,61 @@ def parse_filetime(qword):
     return datetime.utcfromtimestamp(float(qword) * 1e-7 - 11644473600)
 
 
+PRINTABLE_ASCII = " !\"#\$%&\'\(\)\*\+,-\./0123456789:;<=>\?@ABCDEFGHIJKLMNOPQRSTUVWXYZ\[\]\^_`abcdefghijklmnopqrstuvwxyz\{\|\}\\\~"
+
+
+class StringsExtractor(object):
+    """
+    Finds runs of printable ASCII and UTF-16LE characters in a buffer.
+    Each encoding is matched by its own precompiled pattern, and the
+      results are merged by offset.  One combined pattern would lose
+      UTF-16 strings that follow ASCII text, since the ASCII match
+      would take the first UTF-16 character.
+    """
+    ASCII = "ascii"
+    UTF16 = "utf-16"
+
+    def __init__(self, min_length=4):
+        """
+        Constructor.
+        Arguments:
+        - `min_length`: The minimum number of characters in a string.
+        """
+        super(StringsExtractor, self).__init__()
+        self._min_length = min_length
+        self._ascii = re.compile("[%s]{%d,}" % (PRINTABLE_ASCII, min_length))
+        self._utf16 = re.compile("(?:[%s]\x00){%d,}" %
+                                 (PRINTABLE_ASCII, min_length))
+
+    def _matches(self, pattern, encoding, buf, start, end):
+        codec = "ascii" if encoding == self.ASCII else "utf-16le"
+        for match in pattern.finditer(buf, start, end):
+            yield (match.start(), encoding, match.group().decode(codec))
+
+    def strings(self, buf, start=0, end=None):
+        """
+        A generator that yields tuples (offset, encoding, string) for each
+          string found in the buffer between `start` and `end`, ordered
+          by offset.
+        The buffer is not copied, so this is cheap for a small region
+          of a large buffer.
+        Arguments:
+        - `buf`: A string, or an object that supports the buffer interface,
+            such as array.array("B").
+        - `start`: The offset into the buffer at which to start.
+        - `end`: The offset into the buffer at which to stop.
+            Defaults to the end of the buffer.
+        """
+        if end is None:
+            end = len(buf)
+        if not isinstance(buf, str):
+            # so matches are strings, rather than slices of the array
+            buf = buffer(buf)
+        return heapq.merge(
+            self._matches(self._ascii, self.ASCII, buf, start, end),
+            self._matches(self._utf16, self.UTF16, buf, start, end))
+
+
 class BinaryParserException(Exception):
     """
     Base Exception class for binary parsing.
@@ -347,11 +404,18 @@ def read_dword(buf, offset):
         raise OverrunBufferException(offset, len(buf))
 
 
-class Block(object):
+class BaseBlock(object):
     """
     Base class for structure blocks in binary parsing.
     A block is associated with a offset into a byte-string.
+    BaseBlock only holds the buffer and offset, and provides the
+      unpackers, so subclasses may use `__slots__`.
     """
+    __slots__ = ("_buf", "_offset")
+    # list of dict(offset:number, type:string, name:string,
+    #              length:number, count:number)
+    _declared_fields = ()
+
     def __init__(self, buf, offset):
         """
         Constructor.
@@ -361,203 +425,10 @@ class Block(object):
         """
         self._buf = buf
         self._offset = offset
-        self._implicit_offset = 0
-        # list of dict(offset:number, type:string, name:string,
-        #              length:number, count:number)
-        self._declared_fields = []
 
     def __repr__(self):
         return "Block(buf=%r, offset=%r)" % (self._buf, self._offset)
 
-    def declare_field(self, type_, name, offset=None, length=None, count=None):
-        """
-        Declaratively add fields to this block.
-        This method will dynamically add corresponding offset and
-        unpacker methods to this block.
-
-        Arguments:
-        - `type_`: A string or a Nestable type.
-            If a string, should be one of the unpack_* types.
-            If a type, then it must be a subclass of Nestable.
-        - `name`: A string.
-        - `offset`: A number.
-        - `length`: (Optional) A number. For (w)strings, length in chars.
-        - `count`: (Optional) A number that specifies the number of
-            instances of this type.
-            If the count is greater than 1, then the handler will return
-            a generator of the items. This parameter is not valid if
-            the `length` parameter is provided.
-        """
-        is_generator = True
-        if count is None:
-            count = 1
-            is_generator = False
-
-        if count < 0:
-            raise "Count must be greater than 0."
-
-        if length is not None and count > 1:
-            raise "Cannot specify both `length` and `count`."
-
-        if offset is None:
-            offset = self._implicit_offset
-
-        basic_sizes = {
-            "byte": 1,
-            "int8": 1,
-            "word": 2,
-            "word_be": 2,
-            "int16": 2,
-            "dword": 4,
-            "dword_be": 4,
-            "int32": 4,
-            "qword": 8,
-            "int64": 8,
-            "float": 4,
-            "double": 8,
-            "dosdate": 4,
-            "filetime": 8,
-            "systemtime": 8,
-            "guid": 16,
-        }
-
-        handler = None
-
-        if isinstance(type_, type):
-            if not issubclass(type_, Nestable):
-                raise TypeError("Invalid nested structure")
-
-            typename = type_.__name__
-
-            if count == 0:
-                def no_class_handler():
-                    return
-                handler = no_class_handler
-            elif is_generator:
-                def many_class_handler():
-                    ofs = offset
-                    for _ in range(count):
-                        r = type_(self._buf, self.absolute_offset(ofs), self)
-                        ofs += len(r)
-                        yield r
-                handler = many_class_handler
-
-                if hasattr(type_, "structure_size"):
-                    ofs = offset
-                    for _ in range(count):
-                        ofs += type_.structure_size(self._buf, self.absolute_offset(ofs), self)
-                    self._implicit_offset = ofs
-                else:
-                    ofs = offset
-                    for _ in range(count):
-                        r = type_(self._buf, self.absolute_offset(ofs), self)
-                        ofs += len(r)
-                    self._implicit_offset = ofs
-            else:
-                # TODO(wb): this needs to cache/memoize
-                def class_handler():
-                    return type_(self._buf, self.absolute_offset(offset), self)
-                handler = class_handler
-
-                if hasattr(type_, "structure_size"):
-                    size = type_.structure_size(self._buf, self.absolute_offset(offset), self)
-                    self._implicit_offset = offset + size
-                else:
-                    temp = type_(self._buf, self.absolute_offset(offset), self)
-
-                    self._implicit_offset = offset + len(temp)
-        elif isinstance(type_, basestring):
-            typename = type_
-
-            if count == 0:
-                def no_basic_handler():
-                    return
-                handler = no_basic_handler
-            elif is_generator:
-                # length must be in basic_sizes
-                def many_basic_handler():
-                    ofs = offset
-                    f = getattr(self, "unpack_" + type_)
-                    for _ in range(count):
-                        yield f(ofs)
-                        ofs += basic_sizes[type_]
-                handler = many_basic_handler
-
-                self._implicit_offset = offset + count * basic_sizes[type_]
-            else:
-                if length is None:
-                    def basic_no_length_handler():
-                        f = getattr(self, "unpack_" + type_)
-                        return f(offset)
-                    handler = basic_no_length_handler
-
-                    if type_ in basic_sizes:
-                        self._implicit_offset = offset + basic_sizes[type_]
-                    elif type_ == "binary":
-                        self._implicit_offset = offset + length
-                    elif type_ == "string" and length is not None:
-                        self._implicit_offset = offset + length
-                    elif type_ == "wstring" and length is not None:
-                        self._implicit_offset = offset + (2 * length)
-                    elif "string" in type_ and length is None:
-                        raise ParseException("Implicit offset not supported for dynamic length strings")
-                    else:
-                        raise ParseException("Implicit offset not supported for type: " + type_)
-                else:
-                    def basic_length_handler():
-                        f = getattr(self, "unpack_" + type_)
-                        return f(offset, length)
-                    handler = basic_length_handler
-
-                    if type_ == "wstring":
-                        self._implicit_offset = offset + (2 * length)
-                    else:
-                        self._implicit_offset = offset + length
-
-        setattr(self, name, handler)
-        setattr(self, "_off_" + name, offset)
-        self.add_explicit_field(offset, typename, name, length, count)
-
-        try:
-            debug("(%s) %s\t@ %s\t: %s" % (typename.upper(),
-                                           name,
-                                           hex(self.absolute_offset(offset)),
-                                           str(handler())[:0x20]))
-        except ValueError: # invalid Windows timestamp
-            debug("(%s) %s\t@ %s\t: %s" % (typename.upper(),
-                                           name,
-                                           hex(self.absolute_offset(offset)),
-                                           "<<error>>"))
-
-    def add_explicit_field(self, offset, typename, name, length=None, count=1):
-        """
-        The `Block` class tracks the fields that have been added so that you can
-          pretty print the structure.  If there are other fields a subclass
-          parses, use `add_explicit_field` to include them in the pretty printing.
-        @type offset:  int
-        @param offset: The offset at which the field begins.
-        @type typename:  str or Block subclass
-        @param typename: The type of the value of the field.
-        @type name:  str
-        @param name: The name of the field.
-        @type length:  int
-        @param length: An explicit length for the field.
-        @type count:  int
-        @param count: The number of repetitions for the field.
-        @rtype: None
-        @return: None
-        """
-        
-        if type(typename) == type:
-            typename = typename.__name__
-        self._declared_fields.append({
-                "offset": offset,
-                "type": typename,
-                "name": name,
-                "length": length,
-                "count": count,
-                })
-
     def get_all_string(self, indent=0):
         """
         Get a nicely formatted, nested string of the contents of this structure
@@ -572,7 +443,7 @@ class Block(object):
         ret = ""
         for field in self._declared_fields:
             v = getattr(self, field["name"])()
-            if isinstance(v, Block):
+            if isinstance(v, BaseBlock):
                 if hasattr(v, "string"):
                     ret += "%s%s (%s)%s\t%s\n" % \
                         ("  " * indent, hex(field["offset"]), field["type"], 
@@ -595,9 +466,6 @@ class Block(object):
                      field["name"],  str(v))
         return ret
 
-    def current_field_offset(self):
-        return self._implicit_offset
-
     def unpack_byte(self, offset):
         """
         Returns a little-endian unsigned byte from the relative offset.
@@ -903,6 +771,274 @@ class Block(object):
         return self._offset
 
 
+class Block(BaseBlock):
+    """
+    A structure block whose fields are declared on each instance,
+      as it is parsed, using `declare_field`.
+    Each instance carries a `__dict__`, and a handler and metadata
+      for each field; see `CompactBlock` for a lighter alternative.
+    """
+    def __init__(self, buf, offset):
+        """
+        Constructor.
+        Arguments:
+        - `buf`: Byte string containing stuff to parse.
+        - `offset`: The offset into the buffer at which the block starts.
+        """
+        super(Block, self).__init__(buf, offset)
+        self._implicit_offset = 0
+        # list of dict(offset:number, type:string, name:string,
+        #              length:number, count:number)
+        self._declared_fields = []
+
+    def declare_field(self, type_, name, offset=None, length=None, count=None):
+        """
+        Declaratively add fields to this block.
+        This method will dynamically add corresponding offset and
+        unpacker methods to this block.
+
+        Arguments:
+        - `type_`: A string or a Nestable type.
+            If a string, should be one of the unpack_* types.
+            If a type, then it must be a subclass of Nestable.
+        - `name`: A string.
+        - `offset`: A number.
+        - `length`: (Optional) A number. For (w)strings, length in chars.
+        - `count`: (Optional) A number that specifies the number of
+            instances of this type.
+            If the count is greater than 1, then the handler will return
+            a generator of the items. This parameter is not valid if
+            the `length` parameter is provided.
+        """
+        is_generator = True
+        if count is None:
+            count = 1
+            is_generator = False
+
+        if count < 0:
+            raise "Count must be greater than 0."
+
+        if length is not None and count > 1:
+            raise "Cannot specify both `length` and `count`."
+
+        if offset is None:
+            offset = self._implicit_offset
+
+        basic_sizes = {
+            "byte": 1,
+            "int8": 1,
+            "word": 2,
+            "word_be": 2,
+            "int16": 2,
+            "dword": 4,
+            "dword_be": 4,
+            "int32": 4,
+            "qword": 8,
+            "int64": 8,
+            "float": 4,
+            "double": 8,
+            "dosdate": 4,
+            "filetime": 8,
+            "systemtime": 8,
+            "guid": 16,
+        }
+
+        handler = None
+
+        if isinstance(type_, type):
+            if not issubclass(type_, Nestable):
+                raise TypeError("Invalid nested structure")
+
+            typename = type_.__name__
+
+            if count == 0:
+                def no_class_handler():
+                    return
+                handler = no_class_handler
+            elif is_generator:
+                def many_class_handler():
+                    ofs = offset
+                    for _ in range(count):
+                        r = type_(self._buf, self.absolute_offset(ofs), self)
+                        ofs += len(r)
+                        yield r
+                handler = many_class_handler
+
+                if hasattr(type_, "structure_size"):
+                    ofs = offset
+                    for _ in range(count):
+                        ofs += type_.structure_size(self._buf, self.absolute_offset(ofs), self)
+                    self._implicit_offset = ofs
+                else:
+                    ofs = offset
+                    for _ in range(count):
+                        r = type_(self._buf, self.absolute_offset(ofs), self)
+                        ofs += len(r)
+                    self._implicit_offset = ofs
+            else:
+                # TODO(wb): this needs to cache/memoize
+                def class_handler():
+                    return type_(self._buf, self.absolute_offset(offset), self)
+                handler = class_handler
+
+                if hasattr(type_, "structure_size"):
+                    size = type_.structure_size(self._buf, self.absolute_offset(offset), self)
+                    self._implicit_offset = offset + size
+                else:
+                    temp = type_(self._buf, self.absolute_offset(offset), self)
+
+                    self._implicit_offset = offset + len(temp)
+        elif isinstance(type_, basestring):
+            typename = type_
+
+            if count == 0:
+                def no_basic_handler():
+                    return
+                handler = no_basic_handler
+            elif is_generator:
+                # length must be in basic_sizes
+                def many_basic_handler():
+                    ofs = offset
+                    f = getattr(self, "unpack_" + type_)
+                    for _ in range(count):
+                        yield f(ofs)
+                        ofs += basic_sizes[type_]
+                handler = many_basic_handler
+
+                self._implicit_offset = offset + count * basic_sizes[type_]
+            else:
+                if length is None:
+                    def basic_no_length_handler():
+                        f = getattr(self, "unpack_" + type_)
+                        return f(offset)
+                    handler = basic_no_length_handler
+
+                    if type_ in basic_sizes:
+                        self._implicit_offset = offset + basic_sizes[type_]
+                    elif type_ == "binary":
+                        self._implicit_offset = offset + length
+                    elif type_ == "string" and length is not None:
+                        self._implicit_offset = offset + length
+                    elif type_ == "wstring" and length is not None:
+                        self._implicit_offset = offset + (2 * length)
+                    elif "string" in type_ and length is None:
+                        raise ParseException("Implicit offset not supported for dynamic length strings")
+                    else:
+                        raise ParseException("Implicit offset not supported for type: " + type_)
+                else:
+                    def basic_length_handler():
+                        f = getattr(self, "unpack_" + type_)
+                        return f(offset, length)
+                    handler = basic_length_handler
+
+                    if type_ == "wstring":
+                        self._implicit_offset = offset + (2 * length)
+                    else:
+                        self._implicit_offset = offset + length
+
+        setattr(self, name, handler)
+        setattr(self, "_off_" + name, offset)
+        self.add_explicit_field(offset, typename, name, length, count)
+
+        try:
+            debug("(%s) %s\t@ %s\t: %s" % (typename.upper(),
+                                           name,
+                                           hex(self.absolute_offset(offset)),
+                                           str(handler())[:0x20]))
+        except ValueError: # invalid Windows timestamp
+            debug("(%s) %s\t@ %s\t: %s" % (typename.upper(),
+                                           name,
+                                           hex(self.absolute_offset(offset)),
+                                           "<<error>>"))
+
+    def add_explicit_field(self, offset, typename, name, length=None, count=1):
+        """
+        The `Block` class tracks the fields that have been added so that you can
+          pretty print the structure.  If there are other fields a subclass
+          parses, use `add_explicit_field` to include them in the pretty printing.
+        @type offset:  int
+        @param offset: The offset at which the field begins.
+        @type typename:  str or Block subclass
+        @param typename: The type of the value of the field.
+        @type name:  str
+        @param name: The name of the field.
+        @type length:  int
+        @param length: An explicit length for the field.
+        @type count:  int
+        @param count: The number of repetitions for the field.
+        @rtype: None
+        @return: None
+        """
+        
+        if type(typename) == type:
+            typename = typename.__name__
+        self._declared_fields.append({
+                "offset": offset,
+                "type": typename,
+                "name": name,
+                "length": length,
+                "count": count,
+                })
+
+    def current_field_offset(self):
+        return self._implicit_offset
+
+
+class CompactBlock(BaseBlock):
+    """
+    A structure block whose fields are declared once, on the class,
+      by the `compact_fields` decorator.  The fields are at fixed offsets,
+      and subclasses should define `__slots__` (usually empty), so that
+      an instance is no larger than its buffer reference and offset.
+    """
+    __slots__ = ()
+    # list of tuples (type, name, offset[, length]).
+    # `length` is a number, or the name of a field that holds the length.
+    FIELDS = ()
+
+
+def _compact_field_handler(type_, offset, length):
+    unpacker = getattr(BaseBlock, "unpack_" + type_)
+    if length is None:
+        def handler(self):
+            return unpacker(self, offset)
+    elif isinstance(length, basestring):
+        def handler(self):
+            return unpacker(self, offset, getattr(self, length)())
+    else:
+        def handler(self):
+            return unpacker(self, offset, length)
+    return handler
+
+
+def compact_fields(cls):
+    """
+    Class decorator that adds an unpacker method and an `_off_<name>`
+      offset attribute for each entry in the `FIELDS` list of a
+      `CompactBlock` subclass, and records the fields on the class
+      for `get_all_string`.
+    """
+    declared = list(cls._declared_fields)
+    for field in cls.__dict__.get("FIELDS", ()):
+        (type_, name, offset) = field[:3]
+        length = None
+        if len(field) > 3:
+            length = field[3]
+        handler = _compact_field_handler(type_, offset, length)
+        handler.__name__ = name
+        setattr(cls, name, handler)
+        setattr(cls, "_off_" + name, offset)
+        declared.append({
+                "offset": offset,
+                "type": type_,
+                "name": name,
+                "length": length,
+                "count": 1,
+                })
+    cls._declared_fields = tuple(declared)
+    return cls
+
+
 class Nestable(object):
     """
     A Nestable is a mixin type that can be provided with a Block type.
@@ -910,6 +1046,8 @@ class Nestable(object):
     `structure_size` staticmethod.  This enables the parent Block to
     seek among its children.
     """
+    __slots__ = ()
+
     def __init__(self, buf, offset):
         super(Nestable, self).__init__()
 
@@ -0,0 +1,491 @@
+#!/usr/bin/python
+
+#    This file is part of INDXParse.
+#
+#   Copyright 2011-13 Will Ballenthin <william.ballenthin@mandiant.com>
+#                    while at Mandiant <http://www.mandiant.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#   Version v.1.2
+import array
+import struct
+from collections import namedtuple
+
+from BinaryParser import Block
+from BinaryParser import Nestable
+from BinaryParser import ParseException
+from BinaryParser import align
+from BinaryParser import debug
+from MFT import FixupBlock
+from MFT import valid_fixups
+
+
+class RestartArea(Block, Nestable):
+    def __init__(self, buf, offset, parent):
+        super(RestartArea, self).__init__(buf, offset)
+        self.declare_field("qword", "current_lsn", 0x0)
+        self.declare_field("word", "log_clients")
+        self.declare_field("word", "client_free_list")
+        self.declare_field("word", "client_in_use_list")
+        self.declare_field("word", "flags")
+        self.declare_field("dword", "seq_number_bits")
+        self.declare_field("word", "restart_area_length")
+        self.declare_field("word", "client_array_offset")
+        self.declare_field("qword", "file_size")
+        self.declare_field("dword", "last_lsn_data_length")
+        self.declare_field("word", "log_record_header_length")
+        self.declare_field("word", "log_page_data_offset")
+        self.declare_field("dword", "restart_log_open_count")
+
+    @staticmethod
+    def structure_size(buf, offset, parent):
+        return 0x2C
+
+    def __len__(self):
+        return 0x2C
+
+
+class RestartPageHeader(FixupBlock):
+    def __init__(self, buf, offset, parent):
+        super(RestartPageHeader, self).__init__(buf, offset, parent)
+        self.declare_field("dword", "magic", 0x0)
+        self.declare_field("word", "usa_offset")
+        self.declare_field("word", "usa_count")
+        self.declare_field("qword", "chkdsk_lsn")
+        self.declare_field("dword", "system_page_size")
+        self.declare_field("dword", "log_page_size")
+        self.declare_field("word", "restart_area_offset")
+        self.declare_field("word", "minor_version")
+        self.declare_field("word", "major_version")
+        self.fixup(self.usa_count(), self.usa_offset())
+
+    def restart_area(self):
+        return RestartArea(self._buf,
+                           self.absolute_offset(self.restart_area_offset()),
+                           self)
+
+
+class LOG_OPERATION:
+    """
+    WORD.  The redo and undo operations of an NTFS log record.
+    """
+    Noop = 0x00
+    CompensationLogRecord = 0x01
+    InitializeFileRecordSegment = 0x02
+    DeallocateFileRecordSegment = 0x03
+    WriteEndOfFileRecordSegment = 0x04
+    CreateAttribute = 0x05
+    DeleteAttribute = 0x06
+    UpdateResidentValue = 0x07
+    UpdateNonresidentValue = 0x08
+    UpdateMappingPairs = 0x09
+    DeleteDirtyClusters = 0x0A
+    SetNewAttributeSizes = 0x0B
+    AddIndexEntryRoot = 0x0C
+    DeleteIndexEntryRoot = 0x0D
+    AddIndexEntryAllocation = 0x0E
+    DeleteIndexEntryAllocation = 0x0F
+    WriteEndOfIndexBuffer = 0x10
+    SetIndexEntryVcnRoot = 0x11
+    SetIndexEntryVcnAllocation = 0x12
+    UpdateFileNameRoot = 0x13
+    UpdateFileNameAllocation = 0x14
+    SetBitsInNonresidentBitMap = 0x15
+    ClearBitsInNonresidentBitMap = 0x16
+    HotFix = 0x17
+    EndTopLevelAction = 0x18
+    PrepareTransaction = 0x19
+    CommitTransaction = 0x1A
+    ForgetTransaction = 0x1B
+    OpenNonresidentAttribute = 0x1C
+    OpenAttributeTableDump = 0x1D
+    AttributeNamesDump = 0x1E
+    DirtyPageTableDump = 0x1F
+    TransactionTableDump = 0x20
+    UpdateRecordDataRoot = 0x21
+    UpdateRecordDataAllocation = 0x22
+
+
+_OPERATION_NAMES = dict([(v, k) for (k, v) in LOG_OPERATION.__dict__.items()
+                         if not k.startswith("_")])
+
+# operations whose target is an MFT record
+MFT_OPERATIONS = frozenset([
+    LOG_OPERATION.InitializeFileRecordSegment,
+    LOG_OPERATION.DeallocateFileRecordSegment,
+    LOG_OPERATION.WriteEndOfFileRecordSegment,
+    LOG_OPERATION.CreateAttribute,
+    LOG_OPERATION.DeleteAttribute,
+    LOG_OPERATION.UpdateResidentValue,
+    LOG_OPERATION.UpdateMappingPairs,
+    LOG_OPERATION.SetNewAttributeSizes,
+    LOG_OPERATION.AddIndexEntryRoot,
+    LOG_OPERATION.DeleteIndexEntryRoot,
+    LOG_OPERATION.SetIndexEntryVcnRoot,
+    LOG_OPERATION.UpdateFileNameRoot,
+    LOG_OPERATION.UpdateRecordDataRoot,
+])
+
+# operations whose target is an INDX record
+INDX_OPERATIONS = frozenset([
+    LOG_OPERATION.AddIndexEntryAllocation,
+    LOG_OPERATION.DeleteIndexEntryAllocation,
+    LOG_OPERATION.WriteEndOfIndexBuffer,
+    LOG_OPERATION.SetIndexEntryVcnAllocation,
+    LOG_OPERATION.UpdateFileNameAllocation,
+    LOG_OPERATION.UpdateRecordDataAllocation,
+])
+
+
+def operation_name(operation):
+    return _OPERATION_NAMES.get(operation, "0x%x" % (operation))
+
+
+# A log record decoded in one pass, without a Block.
+# `offset` is the offset of the record header in $LogFile.
+# `redo_data` and `undo_data` are strings; for MFT and INDX operations
+#   they hold the bytes written to, or restored at, `record_offset` +
+#   `attribute_offset` of the target record.
+LogRecord = namedtuple("LogRecord", [
+    "offset", "lsn", "previous_lsn", "undo_next_lsn", "record_type",
+    "transaction_id", "flags", "redo_operation", "undo_operation",
+    "target_attribute", "target_vcn", "cluster_block_offset",
+    "record_offset", "attribute_offset", "lcns", "redo_data",
+    "undo_data"])
+
+_RCRD_MAGIC = 0x44524352
+_RSTR_MAGIC = 0x52545352
+_PAGE_HEADER = struct.Struct("<IHHQIHHH")
+_RECORD_HEADER = struct.Struct("<QQQIIIIH6x")
+_CLIENT_HEADER = struct.Struct("<HHHHHHHHHHHHQ")
+
+LOG_RECORD_MULTI_PAGE = 0x1
+LOG_RECORD_CLIENT_RECORD = 0x1
+
+
+def _decode_log_record(offset, header, data):
+    """
+    @raises ParseException if the LCNs, redo data, or undo data
+      do not fit in the record.
+    """
+    (lsn, previous_lsn, undo_next_lsn, _, _, record_type,
+     transaction_id, flags) = header
+    if record_type != LOG_RECORD_CLIENT_RECORD or \
+       len(data) < _CLIENT_HEADER.size:
+        return LogRecord(offset, lsn, previous_lsn, undo_next_lsn,
+                         record_type, transaction_id, flags,
+                         None, None, None, None, None, None, None,
+                         (), "", "")
+    (redo_operation, undo_operation, redo_offset, redo_length,
+     undo_offset, undo_length, target_attribute, lcns_to_follow,
+     record_offset, attribute_offset, cluster_block_offset, _,
+     target_vcn) = _CLIENT_HEADER.unpack_from(data, 0)
+    if _CLIENT_HEADER.size + 8 * lcns_to_follow > len(data):
+        raise ParseException("Log record at %s has %d LCNs past its end" %
+                             (hex(offset), lcns_to_follow))
+    if (redo_length and redo_offset + redo_length > len(data)) or \
+       (undo_length and undo_offset + undo_length > len(data)):
+        raise ParseException("Log record at %s has redo or undo data "
+                             "past its end" % (hex(offset)))
+    lcns = struct.unpack_from("<%dQ" % (lcns_to_follow), data,
+                              _CLIENT_HEADER.size)
+    return LogRecord(offset, lsn, previous_lsn, undo_next_lsn,
+                     record_type, transaction_id, flags, redo_operation,
+                     undo_operation, target_attribute, target_vcn,
+                     cluster_block_offset, record_offset, attribute_offset,
+                     lcns, data[redo_offset:redo_offset + redo_length],
+                     data[undo_offset:undo_offset + undo_length])
+
+
+class LogFile(object):
+    """
+    Streams the log records of an NTFS $LogFile.
+    The restart page gives the page size and LSN layout; then the RCRD
+      pages are read in chunks, their fixups are applied, and the records
+      in them are decoded, including records that continue onto
+      the following pages.
+    """
+    def __init__(self, f, chunk_pages=256):
+        """
+        Arguments:
+        - `f`: A file object open on $LogFile for binary reading.
+        - `chunk_pages`: The number of pages read at once.
+        """
+        super(LogFile, self).__init__()
+        self._f = f
+        self._chunk_pages = chunk_pages
+        self.page_size = 0x1000
+        self.data_offset = 0x40
+        self.seq_number_bits = None
+        self.current_lsn = None
+
+        f.seek(0, 2)
+        self.size = f.tell()
+        f.seek(0)
+        buf = array.array("B", f.read(0x1000))
+        try:
+            if len(buf) < 0x200 or struct.unpack_from("<I", buf)[0] != \
+               _RSTR_MAGIC or not valid_fixups(buf):
+                raise ParseException("No valid restart page")
+            page = RestartPageHeader(buf, 0, None)
+            area = page.restart_area()
+            self.page_size = page.log_page_size() or self.page_size
+            self.data_offset = area.log_page_data_offset() or \
+                self.data_offset
+            self.seq_number_bits = area.seq_number_bits()
+            self.current_lsn = area.current_lsn()
+        except (ParseException, struct.error):
+            debug("Using the default $LogFile layout")
+
+    def lsn_offset(self, lsn):
+        """
+        Returns the offset in $LogFile at which the record with the
+          given LSN is stored, or None if the layout is unknown.
+        """
+        if not self.seq_number_bits or self.seq_number_bits < 3:
+            return None
+        return ((lsn << self.seq_number_bits) & 0xFFFFFFFFFFFFFFFF) >> \
+            (self.seq_number_bits - 3)
+
+    def _pages(self):
+        """
+        Yields tuples (file offset, array, offset) for each RCRD page
+          with valid fixups, which have been applied.
+        The first two pages are restart pages, and the next two hold
+          copies of the tail of the log, so they are skipped.
+        """
+        offset = 4 * self.page_size
+        self._f.seek(offset)
+        chunk_size = self._chunk_pages * self.page_size
+        while True:
+            buf = array.array("B", self._f.read(chunk_size))
+            if not buf:
+                return
+            for ofs in range(0, len(buf) - self.page_size + 1,
+                             self.page_size):
+                if struct.unpack_from("<I", buf, ofs)[0] != _RCRD_MAGIC or \
+                   not valid_fixups(buf, ofs):
+                    debug("Invalid RCRD page at %s" % (hex(offset + ofs)))
+                    continue
+                (_, usa_offset, usa_count) = struct.unpack_from("<IHH",
+                                                                buf, ofs)
+                FixupBlock(buf, ofs, None).fixup(usa_count, usa_offset)
+                yield (offset + ofs, buf, ofs)
+            offset += len(buf)
+
+    def records(self):
+        """
+        A generator that yields a LogRecord for each record in the
+          RCRD pages, in file order.
+        Records whose contents are invalid, or that continue onto a page
+          that was skipped, are not yielded.
+        """
+        pending = None  # (offset, header, data so far, total length)
+        next_page = None
+        for (page_offset, buf, ofs) in self._pages():
+            if pending is not None and page_offset != next_page:
+                debug("Log record at %s continues onto an invalid page" %
+                      (hex(pending[0])))
+                pending = None
+            next_page = page_offset + self.page_size
+            (_, _, _, _, _, _, _, next_record_offset) = \
+                _PAGE_HEADER.unpack_from(buf, ofs)
+            end = ofs + self.page_size
+            pos = ofs + self.data_offset
+            if pending is not None:
+                (offset, header, data, total) = pending
+                take = min(total - len(data), end - pos)
+                data += buf[pos:pos + take].tostring()
+                pos = ofs + align(pos + take - ofs, 8)
+                if len(data) < total:
+                    pending = (offset, header, data, total)
+                    continue
+                pending = None
+                try:
+                    record = _decode_log_record(offset, header, data)
+                except ParseException as e:
+                    debug(str(e))
+                else:
+                    yield record
+            if next_record_offset:
+                # no record starts after the last one in the page
+                end = min(end, ofs + next_record_offset)
+            while pos + _RECORD_HEADER.size <= ofs + self.page_size and \
+                  pos < end:
+                header = _RECORD_HEADER.unpack_from(buf, pos)
+                lsn = header[0]
+                length = header[3]
+                if lsn == 0:
+                    break
+                offset = page_offset + pos - ofs
+                expected = self.lsn_offset(lsn)
+                if expected is not None and expected != offset:
+                    debug("Log record at %s has LSN %s of another offset" %
+                          (hex(offset), hex(lsn)))
+                    break
+                if length > self.size:
+                    debug("Log record at %s is longer than the log" %
+                          (hex(offset)))
+                    break
+                start = pos + _RECORD_HEADER.size
+                if start + length > ofs + self.page_size:
+                    data = buf[start:ofs + self.page_size].tostring()
+                    pending = (offset, header, data, length)
+                    break
+                try:
+                    record = _decode_log_record(
+                        offset, header, buf[start:start + length].tostring())
+                except ParseException as e:
+                    debug(str(e))
+                else:
+                    yield record
+                pos = ofs + align(start + length - ofs, 8)
+
+    def mft_record_number(self, record, cluster_size, record_size=1024):
+        """
+        Returns the number of the MFT record that a log record for an
+          MFT operation targets.
+        """
+        return (record.target_vcn * cluster_size +
+                record.cluster_block_offset * 512) // record_size
+
+    def target_offset(self, record, cluster_size):
+        """
+        Returns the offset in the volume of the MFT or INDX record that
+          a log record targets, from its first LCN, or None if it has
+          no LCNs.
+        """
+        if not record.lcns:
+            return None
+        return record.lcns[0] * cluster_size + \
+            record.cluster_block_offset * 512
+
+
+def record_lsn(f, offset, magic, cache):
+    """
+    Returns the LSN in the header of the FILE or INDX record at the
+      given offset in `f`, or None if there is no such record there.
+    `cache` is a dict from offset to LSN.
+    """
+    if offset not in cache:
+        f.seek(offset)
+        header = f.read(0x10)
+        cache[offset] = None
+        if len(header) == 0x10 and header[0:4] == magic:
+            cache[offset] = struct.unpack_from("<Q", header, 0x8)[0]
+    return cache[offset]
+
+
+def main():
+    import sys
+    import argparse
+    import BinaryParser
+
+    parser = argparse.ArgumentParser(description='Parse the NTFS '
+                                     '$LogFile.')
+    parser.add_argument('-m', action="store", metavar="path",
+                        nargs=1, dest="mft",
+                        help="MFT or image whose records are correlated "
+                        "with the log by LSN")
+    parser.add_argument('-t', action="store", metavar="type",
+                        nargs=1, dest="filetype",
+                        choices=["image", "MFT"], default=["MFT"],
+                        help="The type of the file given with -m "
+                        "(image or MFT), default MFT")
+    parser.add_argument('-c', action="store", metavar="size",
+                        nargs=1, type=int, dest="clustersize",
+                        help="Use this cluster size in bytes "
+                        "(default 4096 bytes)")
+    parser.add_argument('-r', action="store", metavar="size",
+                        nargs=1, type=int, dest="recordsize",
+                        help="Use this MFT record size in bytes "
+                        "(default from the boot sector of an image, "
+                        "or 1024 bytes)")
+    parser.add_argument('-o', action="store", metavar="offset",
+                        nargs=1, type=int, dest="offset",
+                        help="Offset in bytes to volume in image "
+                        "(default 32256 bytes)")
+    parser.add_argument('-v', action="store_true", dest="verbose",
+                        help="Print debugging information")
+    parser.add_argument('filename', action="store",
+                        help="Input $LogFile file path")
+    results = parser.parse_args()
+    BinaryParser.verbose = results.verbose
+    clustersize = results.clustersize[0] if results.clustersize else 4096
+    is_image = results.filetype[0].lower() == "image"
+    offset = results.offset[0] if results.offset else 32256
+
+    target = None
+    if results.mft:
+        target = open(results.mft[0], "rb")
+    recordsize = 1024
+    if results.recordsize:
+        recordsize = results.recordsize[0]
+    elif target is not None and is_image:
+        # clusters per MFT record, or if negative, log2 of the bytes
+        target.seek(offset + 0x40)
+        b = target.read(1)
+        if b:
+            clusters = struct.unpack("<b", b)[0]
+            if clusters > 0:
+                recordsize = clusters * clustersize
+            elif clusters < 0:
+                recordsize = 1 << -clusters
+    record_lsns = {}  # offset in the -m file -> LSN of the record there
+
+    print "LSN,PREVIOUS LSN,TRANSACTION,REDO,UNDO,MFT RECORD,VCN,LCN," \
+        "RECORD OFFSET,ATTRIBUTE OFFSET,REDO LENGTH,UNDO LENGTH,CURRENT"
+    with open(results.filename, "rb") as f:
+        log = LogFile(f)
+        for r in log.records():
+            if r.redo_operation is None:
+                continue
+            number = ""
+            current = ""
+            position = None
+            magic = None
+            volume_offset = log.target_offset(r, clustersize)
+            if r.redo_operation in MFT_OPERATIONS or \
+               r.undo_operation in MFT_OPERATIONS:
+                number = log.mft_record_number(r, clustersize, recordsize)
+                magic = "FILE"
+                if not is_image:
+                    position = number * recordsize
+                elif volume_offset is not None:
+                    position = offset + volume_offset
+            elif r.redo_operation in INDX_OPERATIONS or \
+                 r.undo_operation in INDX_OPERATIONS:
+                # INDX records can only be found in an image
+                magic = "INDX"
+                if is_image and volume_offset is not None:
+                    position = offset + volume_offset
+            if target is not None and position is not None:
+                # the record is as this log record left it
+                if record_lsn(target, position, magic, record_lsns) == r.lsn:
+                    current = "yes"
+            lcn = r.lcns[0] if r.lcns else ""
+            sys.stdout.write("%d,%d,%d,%s,%s,%s,%d,%s,%s,%s,%d,%d,%s\n" %
+                             (r.lsn, r.previous_lsn, r.transaction_id,
+                              operation_name(r.redo_operation),
+                              operation_name(r.undo_operation),
+                              number, r.target_vcn, lcn,
+                              hex(r.record_offset),
+                              hex(r.attribute_offset),
+                              len(r.redo_data), len(r.undo_data), current))
+    if target is not None:
+        target.close()
+
+
+if __name__ == "__main__":
+    main()
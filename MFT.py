@@ -19,12 +19,21 @@
 #
 #   Version v.1.1.8
 import array
+import bisect
+import hashlib
 import os
+import re
 import sys
+import time
+import Queue
 import struct
+import threading
+from collections import namedtuple
 from datetime import datetime
 
 from BinaryParser import Block
+from BinaryParser import CompactBlock
+from BinaryParser import compact_fields
 from BinaryParser import Nestable
 from BinaryParser import memoize
 from BinaryParser import align
@@ -424,6 +433,21 @@ class NTATTR_STANDARD_INDEX_HEADER(Block):
             yield e
         debug("No more entries.")
 
+    def compact_entries(self):
+        """
+        Returns a list of CompactIndexEntry tuples for the live INDX
+        entries associated with this node, decoded in one pass.
+        """
+        return [e for e in decode_index_node(self._buf, self.offset())
+                if not e.flags & INDEX_ENTRY_FLAGS.INDEX_ENTRY_END]
+
+    def compact_slack_entries(self):
+        """
+        Returns a list of CompactIndexEntry tuples for the INDX entries
+        found in the slack space associated with this node.
+        """
+        return decode_index_slack(self._buf, self.offset())
+
     def slack_entries(self):
         """
         A generator that yields INDX entries found in the slack space
@@ -478,21 +502,25 @@ class StandardInformationFieldDoesNotExist(Exception):
         return "Standard Information attribute field does not exist: %s" % (self._msg)
 
 
-class StandardInformation(Block):
+@compact_fields
+class StandardInformation(CompactBlock):
+    __slots__ = ()
+    FIELDS = [
+        ("filetime", "created_time", 0x0),
+        ("filetime", "modified_time", 0x8),
+        ("filetime", "changed_time", 0x10),
+        ("filetime", "accessed_time", 0x18),
+        ("dword", "attributes", 0x20),
+        ("binary", "reserved", 0x24, 0xC),
+        # ("dword", "owner_id", 0x30),  # Win2k+
+        # ("dword", "security_id", 0x34),  # Win2k+
+        # ("qword", "quota_charged", 0x38),  # Win2k+
+        # ("qword", "usn", 0x40),  # Win2k+
+    ]
+
     def __init__(self, buf, offset, parent):
         debug("STANDARD INFORMATION ATTRIBUTE at %s." % (hex(offset)))
         super(StandardInformation, self).__init__(buf, offset)
-        self.declare_field("filetime", "created_time", 0x0)
-        self.declare_field("filetime", "modified_time")
-        self.declare_field("filetime", "changed_time")
-        self.declare_field("filetime", "accessed_time")
-        self.declare_field("dword", "attributes")
-        self.declare_field("binary", "reserved",
-                           self.current_field_offset(), 0xC)
-        # self.declare_field("dword", "owner_id", 0x30)  # Win2k+
-        # self.declare_field("dword", "security_id")  # Win2k+
-        # self.declare_field("qword", "quota_charged")  # Win2k+
-        # self.declare_field("qword", "usn")  # Win2k+
 
     def owner_id(self):
         """
@@ -531,22 +559,27 @@ class StandardInformation(Block):
             raise StandardInformationFieldDoesNotExist("USN")
 
 
-class FilenameAttribute(Block, Nestable):
+@compact_fields
+class FilenameAttribute(CompactBlock, Nestable):
+    __slots__ = ()
+    FIELDS = [
+        ("qword", "mft_parent_reference", 0x0),
+        ("filetime", "created_time", 0x8),
+        ("filetime", "modified_time", 0x10),
+        ("filetime", "changed_time", 0x18),
+        ("filetime", "accessed_time", 0x20),
+        ("qword", "physical_size", 0x28),
+        ("qword", "logical_size", 0x30),
+        ("dword", "flags", 0x38),
+        ("dword", "reparse_value", 0x3C),
+        ("byte", "filename_length", 0x40),
+        ("byte", "filename_type", 0x41),
+        ("wstring", "filename", 0x42, "filename_length"),
+    ]
+
     def __init__(self, buf, offset, parent):
         debug("FILENAME ATTRIBUTE at %s." % (hex(offset)))
         super(FilenameAttribute, self).__init__(buf, offset)
-        self.declare_field("qword", "mft_parent_reference", 0x0)
-        self.declare_field("filetime", "created_time")
-        self.declare_field("filetime", "modified_time")
-        self.declare_field("filetime", "changed_time")
-        self.declare_field("filetime", "accessed_time")
-        self.declare_field("qword", "physical_size")
-        self.declare_field("qword", "logical_size")
-        self.declare_field("dword", "flags")
-        self.declare_field("dword", "reparse_value")
-        self.declare_field("byte", "filename_length")
-        self.declare_field("byte", "filename_type")
-        self.declare_field("wstring", "filename", 0x42, self.filename_length())
 
     @staticmethod
     def structure_size(buf, offset, parent):
@@ -591,6 +624,132 @@ class SlackIndexEntry(IndexEntry):
             return False
 
 
+# A directory index entry decoded in one pass, without a Block.
+# The timestamps are raw FILETIMEs; see `filetime_to_unix`.
+# The final entry of a node has no filename, and its key fields are None.
+CompactIndexEntry = namedtuple("CompactIndexEntry", [
+    "offset", "mft_reference", "length", "flags", "child_vcn",
+    "mft_parent_reference", "created_time", "modified_time",
+    "changed_time", "accessed_time", "physical_size", "logical_size",
+    "file_flags", "reparse_value", "filename_type", "filename"])
+
+_NODE_HEADER = struct.Struct("<IIII")
+_ENTRY_HEADER = struct.Struct("<QHHI")
+_FILENAME_KEY = struct.Struct("<QQQQQQQIIBB")
+_FILETIMES = struct.Struct("<QQQQ")
+
+# FILETIMEs of 1990-01-01 and 2025-01-01, the bounds SlackIndexEntry uses
+_SLACK_MIN_FILETIME = 122756256000000000
+_SLACK_MAX_FILETIME = 133801632000000000
+
+
+def filetime_to_unix(qword):
+    """
+    Returns the whole seconds since the Unix epoch of a Windows FILETIME,
+      without building a datetime.
+    """
+    return (qword - 116444736000000000) // 10000000
+
+
+def _decode_index_entry(buf, offset, end):
+    """
+    @raises ParseException if the entry does not fit before `end`,
+      or its filename does not decode.
+    """
+    if offset + _ENTRY_HEADER.size > end:
+        raise OverrunBufferException(offset + _ENTRY_HEADER.size, end)
+    (ref, length, key_length, flags) = _ENTRY_HEADER.unpack_from(buf, offset)
+    if length < _ENTRY_HEADER.size or length % 8 != 0 or \
+       offset + length > end:
+        raise ParseException("Invalid INDX entry length %s at %s" %
+                             (hex(length), hex(offset)))
+    child_vcn = None
+    if flags & INDEX_ENTRY_FLAGS.INDEX_ENTRY_NODE:
+        if length < _ENTRY_HEADER.size + 8:
+            raise ParseException("INDX entry at %s has no subnode VCN" %
+                                 (hex(offset)))
+        child_vcn = struct.unpack_from("<Q", buf, offset + length - 8)[0]
+    if flags & INDEX_ENTRY_FLAGS.INDEX_ENTRY_END:
+        return CompactIndexEntry(offset, ref, length, flags, child_vcn,
+                                 None, None, None, None, None, None, None,
+                                 None, None, None, None)
+    if length < 0x52:
+        raise ParseException("INDX entry at %s is too short for a key" %
+                             (hex(offset)))
+    key = _FILENAME_KEY.unpack_from(buf, offset + 0x10)
+    name_offset = offset + 0x52
+    if name_offset + 2 * key[9] > offset + length:
+        raise ParseException("INDX entry filename at %s overruns the entry" %
+                             (hex(offset)))
+    try:
+        name = buffer(buf, name_offset, 2 * key[9])[:].decode("utf16")
+    except UnicodeDecodeError:
+        raise ParseException("Invalid INDX entry filename at %s" %
+                             (hex(offset)))
+    return CompactIndexEntry(offset, ref, length, flags, child_vcn,
+                             *(key[:9] + key[10:] + (name,)))
+
+
+def decode_index_node(buf, offset):
+    """
+    Decode each entry of the index node whose header is at the given
+      offset, including the final entry, into a list of
+      CompactIndexEntry tuples.
+    This is equivalent to, but much cheaper than, constructing
+      an IndexEntry and FilenameAttribute for each entry.
+    @raises ParseException if the node header or an entry is invalid.
+    """
+    if offset + _NODE_HEADER.size > len(buf):
+        raise OverrunBufferException(offset + _NODE_HEADER.size, len(buf))
+    (start, end, _, _) = _NODE_HEADER.unpack_from(buf, offset)
+    ret = []
+    if start == 0:
+        return ret
+    pos = offset + start
+    end += offset
+    if end > len(buf):
+        raise OverrunBufferException(end, len(buf))
+    while pos + 0x10 <= end:
+        e = _decode_index_entry(buf, pos, end)
+        ret.append(e)
+        if e.flags & INDEX_ENTRY_FLAGS.INDEX_ENTRY_END:
+            break
+        pos += e.length
+    return ret
+
+
+def decode_index_slack(buf, offset):
+    """
+    Decode the entries found in the slack space of the index node whose
+      header is at the given offset into a list of CompactIndexEntry
+      tuples, using the same timestamp checks as SlackIndexEntry.
+    @raises OverrunBufferException if the node header is truncated.
+    """
+    if offset + _NODE_HEADER.size > len(buf):
+        raise OverrunBufferException(offset + _NODE_HEADER.size, len(buf))
+    (_, end, allocation_end, _) = _NODE_HEADER.unpack_from(buf, offset)
+    ret = []
+    pos = offset + end
+    last = min(offset + allocation_end - 0x52, len(buf) - 0x52)
+    while pos <= last:
+        times = _FILETIMES.unpack_from(buf, pos + 0x18)
+        if min(times) <= _SLACK_MIN_FILETIME or \
+           max(times) >= _SLACK_MAX_FILETIME:
+            pos += 1
+            continue
+        (ref, length, key_length, flags) = _ENTRY_HEADER.unpack_from(buf, pos)
+        try:
+            key = _FILENAME_KEY.unpack_from(buf, pos + 0x10)
+            name = buffer(buf, pos + 0x52, 2 * key[9])[:].decode("utf16")
+        except UnicodeDecodeError:
+            pos += 1
+            continue
+        ret.append(CompactIndexEntry(pos, ref, length, flags, None,
+                                     *(key[:9] + key[10:] + (name,))))
+        pos += length or 1
+    return ret
+
+
 class Runentry(Block):
     def __init__(self, buf, offset, parent):
         super(Runentry, self).__init__(buf, offset)
@@ -608,6 +767,9 @@ class Runentry(Block):
     def is_valid(self):
         return self._offset_length > 0 and self._length_length > 0
 
+    def is_sparse(self):
+        return self._offset_length == 0 and self._length_length > 0
+
     def lsb2num(self, binary):
         count = 0
         ret = 0
@@ -673,6 +835,25 @@ class Runlist(Block):
             last_offset = current_offset
             yield (current_offset, current_length)
 
+    def data_runs(self):
+        """
+        Yields tuples (cluster, length) for each run, including sparse
+          runs, whose cluster is None.
+        `runs` stops at the first sparse run, which is fine for
+          INDX_ALLOCATION attributes but not for file data.
+        """
+        last_offset = 0
+        offset = self.offset()
+        entry = Runentry(self._buf, offset, self)
+        while entry.header() != 0 and (entry.is_valid() or entry.is_sparse()):
+            if entry.is_sparse():
+                yield (None, entry.length())
+            else:
+                last_offset += entry.offset()
+                yield (last_offset, entry.length())
+            offset += entry.size()
+            entry = Runentry(self._buf, offset, self)
+
 
 class ATTR_TYPE:
     STANDARD_INFORMATION = 0x10
@@ -781,6 +962,43 @@ class MFTRecord(FixupBlock):
             if a.type() == attr_type:
                 return a
 
+    def fingerprint(self):
+        """
+        Returns a hex digest of the bytes in use by this record,
+          after fixups have been applied.  This is meant for cheap
+          change detection across captures, not for integrity.
+        """
+        length = min(self.bytes_in_use(), len(self._buf) - self.offset())
+        return hashlib.md5(buffer(self._buf, self.offset(), length)).hexdigest()
+
+    def is_valid(self):
+        """
+        Check the structure of the record header and attribute list.
+        Records found in the MFT are trusted; this is meant for
+          records carved from elsewhere in an image.
+        """
+        try:
+            if self.magic() != 0x454C4946:
+                return False
+            if self.bytes_allocated() not in (1024, 4096) or \
+               self.bytes_in_use() > self.bytes_allocated() or \
+               self.bytes_allocated() > len(self._buf) - self.offset():
+                return False
+            if self.attrs_offset() < 0x30 or \
+               self.attrs_offset() % 8 != 0 or \
+               self.attrs_offset() >= self.bytes_in_use():
+                return False
+            end = self.offset() + self.bytes_in_use()
+            offset = self.offset() + self.attrs_offset()
+            while self.unpack_dword(offset) != 0xFFFFFFFF:
+                length = self.unpack_dword(offset + 4)
+                if length < 0x18 or length % 8 != 0 or offset + length > end:
+                    return False
+                offset += length
+        except OverrunBufferException:
+            return False
+        return True
+
     def is_directory(self):
         return self.flags() & 0x0002
 
@@ -802,6 +1020,11 @@ class MFTRecord(FixupBlock):
                 try:
                     value = a.value()
                     check = FilenameAttribute(value, 0, self)
+                    # the fields are read lazily, so check here that
+                    # the whole attribute is present and its name decodes
+                    if len(value) < len(check):
+                        continue
+                    check.filename()
                     if check.filename_type() == 0x0001 or \
                        check.filename_type() == 0x0003:
                         return check
@@ -819,12 +1042,15 @@ class MFTRecord(FixupBlock):
             print(str(e))
             return False
 
-    def data_attribute(self):
+    def data_attribute(self, name=""):
         """
-        Returns None if the default $DATA attribute does not exist
+        Returns None if the $DATA attribute does not exist
+        Arguments:
+        - `name`: The name of an alternate data stream, or the empty
+            string for the default stream.
         """
         for attr in self.attributes():
-            if attr.type() == ATTR_TYPE.DATA and attr.name() == "":
+            if attr.type() == ATTR_TYPE.DATA and attr.name() == name:
                 return attr
 
 
@@ -841,6 +1067,682 @@ class InvalidMFTRecordNumber(Exception):
         self.value = value
 
 
+class LatentFile(object):
+    """
+    Wraps a file object and sleeps before each read.
+    This simulates evidence stored on a high latency network mount,
+      so that the read-ahead machinery can be exercised locally.
+    """
+    def __init__(self, f, latency):
+        """
+        Arguments:
+        - `f`: A file object opened for reading.
+        - `latency`: The delay in seconds to add to each read.
+        """
+        self._f = f
+        self._latency = latency
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
+
+    def read(self, *args):
+        time.sleep(self._latency)
+        return self._f.read(*args)
+
+    def seek(self, *args):
+        return self._f.seek(*args)
+
+    def tell(self):
+        return self._f.tell()
+
+    def close(self):
+        return self._f.close()
+
+
+def open_image(filename, latency=0):
+    """
+    Open an image for reading, optionally with simulated latency.
+    """
+    f = open(filename, "rb")
+    if latency:
+        return LatentFile(f, latency)
+    return f
+
+
+class ReadAheadPool(object):
+    """
+    Reads extents from an image using a pool of worker threads, each
+      with its own file handle, so that many reads are outstanding at
+      once.  This hides the per-read latency of network mounted
+      evidence.
+    Callers `submit` a list of (offset, length) extents under a key,
+      and later `get` the concatenated data for that key.
+    If a read fails, `get` raises its exception.
+    """
+    def __init__(self, filename, workers=8, latency=0):
+        """
+        Arguments:
+        - `filename`: The path to the image.
+        - `workers`: The number of concurrent reads.
+        - `latency`: Simulated latency in seconds added to each read.
+        @raises IOError if the image cannot be opened.
+        """
+        self._jobs = Queue.Queue()
+        self._lock = threading.Condition()
+        self._pending = {}  # key -> [parts, number of outstanding parts]
+        self._threads = []
+        # the handles are opened here, so that errors reach the caller
+        files = [open_image(filename, latency) for _ in range(workers)]
+        for f in files:
+            t = threading.Thread(target=self._work, args=(f,))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _work(self, f):
+        with f:
+            while True:
+                job = self._jobs.get()
+                if job is None:
+                    return
+                (key, index, offset, length) = job
+                data = ""
+                try:
+                    f.seek(offset)
+                    data = f.read(length)
+                except Exception as e:
+                    # handed to the caller by `get`
+                    data = e
+                finally:
+                    with self._lock:
+                        entry = self._pending[key]
+                        entry[0][index] = data
+                        entry[1] -= 1
+                        if entry[1] == 0:
+                            self._lock.notify_all()
+
+    def submit(self, key, extents):
+        """
+        Schedule reads of the given extents.
+        Arguments:
+        - `key`: A hashable value used to `get` the result.
+        - `extents`: A list of (offset, length) tuples, in bytes.
+        """
+        with self._lock:
+            self._pending[key] = [[""] * len(extents), len(extents)]
+        for (index, (offset, length)) in enumerate(extents):
+            self._jobs.put((key, index, offset, length))
+
+    def get(self, key):
+        """
+        Block until the reads for `key` complete, and return the data
+          as an array of bytes in the order the extents were submitted.
+        @raises the exception of the first failed read, such as IOError.
+        """
+        with self._lock:
+            while self._pending[key][1] > 0:
+                self._lock.wait()
+            parts = self._pending.pop(key)[0]
+        for part in parts:
+            if isinstance(part, Exception):
+                raise part
+        return array.array("B", "".join(parts))
+
+    def close(self):
+        for _ in self._threads:
+            self._jobs.put(None)
+        for t in self._threads:
+            t.join()
+
+
+def coalesce_extents(extents):
+    """
+    Sort the given (offset, length) extents and merge those that are
+      adjacent or overlap.
+    Returns a list of (offset, length) tuples ordered by offset.
+    """
+    ret = []
+    for (offset, length) in sorted(extents):
+        if length <= 0:
+            continue
+        if ret and offset <= ret[-1][0] + ret[-1][1]:
+            (last_offset, last_length) = ret[-1]
+            end = max(last_offset + last_length, offset + length)
+            ret[-1] = (last_offset, end - last_offset)
+        else:
+            ret.append((offset, length))
+    return ret
+
+
+class ExtentPlanner(object):
+    """
+    Collects the extents needed by many consumers, such as the
+      INDX_ALLOCATION runs of a batch of directories, so that they can
+      be read with a few large, sequential requests.
+    Usage:
+      planner.add(key, extents) for each consumer, then either
+      planner.read(f), or issue the reads in planner.plan() yourself
+      and hand the results to planner.distribute().
+    """
+    def __init__(self):
+        self._requests = []  # list of (key, list of (offset, length))
+
+    def __len__(self):
+        return len(self._requests)
+
+    def add(self, key, extents):
+        """
+        Arguments:
+        - `key`: A hashable value that identifies the consumer.
+        - `extents`: A list of (offset, length) tuples, in bytes.
+        """
+        self._requests.append((key, extents))
+
+    def plan(self):
+        """
+        Returns the sorted, merged list of (offset, length) reads
+          that covers every requested extent.
+        """
+        return coalesce_extents([e for (_, extents) in self._requests
+                                 for e in extents])
+
+    def distribute(self, reads, datas):
+        """
+        Returns a dict from key to an array of the bytes requested
+          by that key, in the order its extents were added.
+        Keys with an extent in a failed read are left out, so that
+          the caller can read them itself, or skip them.
+        Arguments:
+        - `reads`: The list returned by `plan()`.
+        - `datas`: The data read for each entry of `reads`, or None
+            where the read failed.
+        """
+        starts = [offset for (offset, _) in reads]
+        ret = {}
+        for (key, extents) in self._requests:
+            buf = array.array("B")
+            for (offset, length) in extents:
+                i = bisect.bisect_right(starts, offset) - 1
+                if i < 0 or datas[i] is None:
+                    buf = None
+                    break
+                rel = offset - starts[i]
+                buf.fromstring(datas[i][rel:rel + length])
+            if buf is None:
+                debug("Failed to read the extents of %s" % (str(key)))
+                continue
+            ret[key] = buf
+        return ret
+
+    def read(self, f):
+        """
+        Read all requested extents from the file object `f` in
+          offset order, and distribute them as `distribute()` does.
+        """
+        reads = self.plan()
+        datas = []
+        for (offset, length) in reads:
+            try:
+                f.seek(offset)
+                datas.append(f.read(length))
+            except IOError:
+                debug("Failed to read %s bytes at %s" %
+                      (hex(length), hex(offset)))
+                datas.append(None)
+        return self.distribute(reads, datas)
+
+
+def valid_fixups(buf, offset=0, sector_size=512):
+    """
+    Check, without modifying the buffer, that each sector of a
+      multi-sector structure (FILE, INDX) ends with the update sequence
+      number from its header.  This is how torn or unrelated data
+      is recognized when carving.
+    Arguments:
+    - `buf`: A string or array of bytes.
+    - `offset`: The offset of the structure in the buffer.
+    """
+    try:
+        (usa_offset, usa_count) = struct.unpack_from("<HH", buf, offset + 4)
+        if usa_count < 2 or usa_offset < 8 or usa_offset % 2 != 0:
+            return False
+        usn = read_word(buf, offset + usa_offset)
+        for i in range(1, usa_count):
+            if read_word(buf, offset + sector_size * i - 2) != usn:
+                return False
+    except (struct.error, OverrunBufferException):
+        return False
+    return True
+
+
+def carve_magic(f, magic, extents, alignment, record_size,
+                base=0, chunk_size=16 * 1024 * 1024):
+    """
+    Scan the given extents of an image for a magic string that
+      begins at an offset aligned to `alignment` bytes from `base`.
+    The extents are read in large sequential chunks, and searched
+      with `str.find`, so that only hits are processed in Python.
+    Yields tuples (offset, data), where data is a string of up to
+      `record_size` bytes starting at the hit.
+    Arguments:
+    - `f`: A file object opened for reading.
+    - `magic`: A string, such as "INDX" or "FILE".
+    - `extents`: A list of (offset, length) tuples, in bytes.
+    - `alignment`: The alignment of valid hits, in bytes.
+    - `record_size`: The number of bytes to return for each hit.
+    - `base`: The offset alignment is relative to, such as the volume offset.
+    """
+    for (start, length) in extents:
+        end = start + length
+        pos = start
+        while pos < end:
+            want = min(chunk_size, end - pos)
+            f.seek(pos)
+            # read a little extra, so that hits near the end are complete
+            buf = f.read(want + record_size)
+            if not buf:
+                break
+            i = buf.find(magic)
+            while i != -1 and i < want:
+                skew = (pos + i - base) % alignment
+                if skew != 0:
+                    i = buf.find(magic, i + alignment - skew)
+                    continue
+                yield (pos + i, buf[i:i + record_size])
+                i = buf.find(magic, i + alignment)
+            pos += want
+
+
+class DirectoryIndex(object):
+    """
+    The B+ tree of a directory's $I30 index, built from its
+      INDEX_ROOT value and the contents of its INDEX_ALLOCATION
+      attribute.
+    INDX records are located by the VCN in their own headers, rather
+      than by their position, so records after a gap or an invalid
+      record are still found.
+    """
+    def __init__(self, root, allocation=None, record_size=None):
+        """
+        Arguments:
+        - `root`: The IndexRootHeader of the directory, or None.
+        - `allocation`: An array of bytes containing the INDEX_ALLOCATION.
+        - `record_size`: The size of an INDX record, in bytes.  By default,
+            this is taken from the index root.
+        """
+        self._root = root
+        if allocation is None:
+            allocation = array.array("B")
+        if record_size is None and root is not None:
+            record_size = root.index_record_size_bytes()
+        record_size = record_size or 4096
+        self._blocks = {}  # vcn -> IndexRecordHeader
+        self._visited = None  # VCNs reached by the last complete walk
+        offset = 0
+        while offset + record_size <= len(allocation):
+            if read_dword(allocation, offset) == 0x58444E49:
+                if valid_fixups(allocation, offset):
+                    block = IndexRecordHeader(allocation, offset, False)
+                    self._blocks.setdefault(block.vcn(), block)
+                else:
+                    debug("Bad fixups in INDX record at %s" % (hex(offset)))
+            offset += record_size
+
+    def _walk(self, node_header, visited):
+        for e in decode_index_node(node_header._buf, node_header.offset()):
+            if e.child_vcn is not None:
+                vcn = e.child_vcn
+                block = self._blocks.get(vcn)
+                if block is None:
+                    debug("Subnode VCN %s is not allocated" % (hex(vcn)))
+                elif vcn in visited:
+                    debug("Subnode VCN %s is referenced twice" % (hex(vcn)))
+                else:
+                    visited.add(vcn)
+                    for c in self._walk(block.node_header(), visited):
+                        yield c
+            if not e.flags & INDEX_ENTRY_FLAGS.INDEX_ENTRY_END:
+                yield e
+
+    def entries(self):
+        """
+        A generator that yields a CompactIndexEntry for each live entry
+          in collation order, following subnode pointers from the root.
+        """
+        if self._root is None:
+            return
+        visited = set()
+        for e in self._walk(self._root.node_header(), visited):
+            yield e
+        self._visited = visited
+
+    def root(self):
+        return self._root
+
+    def blocks(self):
+        """
+        Returns a list of tuples (vcn, IndexRecordHeader) for each
+          valid INDX record, ordered by VCN.
+        """
+        return sorted(self._blocks.items())
+
+    def unreferenced_blocks(self):
+        """
+        Returns a list of tuples (vcn, IndexRecordHeader) for the valid
+          INDX records that are not reachable from the index root,
+          ordered by VCN.  Their entries are stale.
+        The VCNs reached by a complete pass of `entries` are reused,
+          so the tree is only walked again if there was none.
+        """
+        visited = self._visited
+        if visited is None:
+            visited = set()
+            if self._root is not None:
+                for _ in self._walk(self._root.node_header(), visited):
+                    pass
+        return [(vcn, block) for (vcn, block) in self.blocks()
+                if vcn not in visited]
+
+
+class ClusterBitmap(object):
+    """
+    The allocation state of each cluster in a volume, as recorded
+      by the $Bitmap metadata file (MFT record 6).  Bit n is set
+      when cluster n is in use.
+    """
+    # whole bytes that are all free or all in use are handled by the
+    #   regex engine; only mixed bytes are inspected bit by bit.
+    _UNIFORM = re.compile("\x00+|\xff+")
+
+    def __init__(self, data, clusters=None):
+        """
+        Arguments:
+        - `data`: A string containing the contents of $Bitmap.
+        - `clusters`: The number of clusters in the volume, if known.
+        """
+        if clusters is None or clusters > len(data) * 8:
+            clusters = len(data) * 8
+        self._data = data
+        self._clusters = clusters
+
+    def __len__(self):
+        return self._clusters
+
+    def is_allocated(self, cluster):
+        if cluster < 0 or cluster >= self._clusters:
+            return False
+        return bool(ord(self._data[cluster >> 3]) & (1 << (cluster & 7)))
+
+    def _runs(self):
+        """
+        Yields tuples (first cluster, count, allocated) that cover the
+          bitmap in order, though adjacent runs may share a state.
+        """
+        data = self._data
+        pos = 0
+        nbytes = (self._clusters + 7) / 8
+        for m in self._UNIFORM.finditer(data, 0, nbytes):
+            for i in xrange(pos, m.start()):
+                b = ord(data[i])
+                for bit in xrange(8):
+                    yield (i * 8 + bit, 1, bool(b & (1 << bit)))
+            yield (m.start() * 8, (m.end() - m.start()) * 8,
+                   data[m.start()] == "\xff")
+            pos = m.end()
+        for i in xrange(pos, nbytes):
+            b = ord(data[i])
+            for bit in xrange(8):
+                yield (i * 8 + bit, 1, bool(b & (1 << bit)))
+
+    def extents(self, allocated=True):
+        """
+        Yields tuples (first cluster, count) of the maximal runs of
+          clusters that are (or, with `allocated=False`, are not) in use.
+        """
+        start = None
+        end = 0
+        for (cluster, count, state) in self._runs():
+            if cluster >= self._clusters:
+                break
+            count = min(count, self._clusters - cluster)
+            if state == allocated:
+                if start is None:
+                    start = cluster
+                end = cluster + count
+            elif start is not None:
+                yield (start, end - start)
+                start = None
+        if start is not None:
+            yield (start, end - start)
+
+
+class MFTTreeStore(object):
+    """
+    A compact file system tree, held in parallel arrays indexed by MFT
+      record number, rather than one object per record.
+    Each node has a parent, a first child and a next sibling (or -1),
+      a sequence number, flags, and a name stored in a shared table.
+    Records are added in one pass; a child that appears before its
+      parent waits in a pending list until the parent is added.
+    """
+    PRESENT = 0x1
+    DIRECTORY = 0x2
+
+    def __init__(self):
+        self._parent = array.array("i")
+        self._first_child = array.array("i")
+        self._next_sibling = array.array("i")
+        self._sequence = array.array("H")
+        self._flags = array.array("B")
+        self._name_offset = array.array("I")
+        self._name_length = array.array("H")
+        self._names = array.array("u")
+        # parent record number -> list of (child record number, parent seq)
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._flags)
+
+    def __contains__(self, number):
+        return 0 <= number < len(self._flags) and \
+            self._flags[number] & MFTTreeStore.PRESENT != 0
+
+    def _grow(self, size):
+        n = size - len(self._flags)
+        if n <= 0:
+            return
+        self._parent.extend(array.array("i", [-1]) * n)
+        self._first_child.extend(array.array("i", [-1]) * n)
+        self._next_sibling.extend(array.array("i", [-1]) * n)
+        self._sequence.extend(array.array("H", [0]) * n)
+        self._flags.extend(array.array("B", [0]) * n)
+        self._name_offset.extend(array.array("I", [0]) * n)
+        self._name_length.extend(array.array("H", [0]) * n)
+
+    def _link(self, number, parent):
+        self._parent[number] = parent
+        self._next_sibling[number] = self._first_child[parent]
+        self._first_child[parent] = number
+
+    def add(self, number, name, sequence, is_directory,
+            parent=None, parent_sequence=None):
+        """
+        Add a node.  Returns False if the record number is already present.
+        Arguments:
+        - `number`: The MFT record number.
+        - `name`: A unicode string.
+        - `sequence`: The sequence number of the record.
+        - `is_directory`: A boolean.
+        - `parent`: The record number of the parent, or None if unknown.
+        - `parent_sequence`: The sequence number the parent must have.
+        """
+        if number in self:
+            return False
+        self._grow(number + 1)
+        self._sequence[number] = sequence
+        self._flags[number] = MFTTreeStore.PRESENT | \
+            (MFTTreeStore.DIRECTORY if is_directory else 0)
+        self._name_offset[number] = len(self._names)
+        self._name_length[number] = len(name)
+        self._names.fromunicode(name)
+
+        if parent is not None and parent != number:
+            if parent in self:
+                if self._sequence[parent] == parent_sequence:
+                    self._link(number, parent)
+            else:
+                self._pending.setdefault(parent, []).append((number,
+                                                             parent_sequence))
+        for (child, expected) in self._pending.pop(number, []):
+            if expected == sequence:
+                self._link(child, number)
+        return True
+
+    @staticmethod
+    def record_fields(record):
+        """
+        Returns the arguments to `add`, after the record number, that
+          describe the given MFTRecord.  This tuple is small and
+          picklable, so it can be produced away from the store.
+        """
+        fn = record.filename_information()
+        if not fn:
+            return (u"???", record.sequence_number(), record.is_directory(),
+                    None, None)
+        ref = fn.mft_parent_reference()
+        return (fn.filename(), record.sequence_number(),
+                record.is_directory(), ref & 0xFFFFFFFFFFFF, ref >> 48)
+
+    def add_record(self, number, record):
+        """
+        Add a node for the given MFTRecord, which has the given record number.
+        Returns False if the record number is already present.
+        """
+        return self.add(number, *MFTTreeStore.record_fields(record))
+
+    def name(self, number):
+        offset = self._name_offset[number]
+        return self._names[offset:offset + self._name_length[number]].tounicode()
+
+    def is_directory(self, number):
+        return self._flags[number] & MFTTreeStore.DIRECTORY != 0
+
+    def sequence_number(self, number):
+        return self._sequence[number]
+
+    def parent(self, number):
+        """
+        Returns the record number of the parent, or -1 for an orphan.
+        """
+        return self._parent[number]
+
+    def has_children(self, number):
+        return self._first_child[number] != -1
+
+    def children(self, number):
+        """
+        Returns a list of the record numbers of the children of a node.
+        """
+        ret = []
+        child = self._first_child[number]
+        while child != -1:
+            ret.append(child)
+            child = self._next_sibling[child]
+        return ret
+
+    def path(self, number, cache=None, root="\\."):
+        """
+        Returns the full path of a node, in the style of
+          `NTFSFile.mft_record_build_path`.
+        Arguments:
+        - `number`: The record number of a node in the store.
+        - `cache`: An optional dict of record number to the path of a
+            directory.  Pass the same dict to each call so that each
+            directory is only walked once.
+        - `root`: The path of the root directory.
+        """
+        if cache is None:
+            cache = {}
+        names = []
+        seen = set()
+        n = number
+        while True:
+            if n in cache:
+                path = cache[n]
+                break
+            if n == 5:
+                path = root
+                break
+            if n in seen:
+                debug("Cycle detected")
+                path = "\\<CYCLE>"
+                break
+            seen.add(n)
+            names.append(n)
+            n = self._parent[n]
+            if n == -1:
+                path = "\\$OrphanFiles"
+                break
+        for n in reversed(names):
+            path += "\\" + self.name(n)
+            if self.is_directory(n):
+                cache[n] = path
+        return path
+
+    _COLUMNS = ("_parent", "_first_child", "_next_sibling", "_sequence",
+                "_flags", "_name_offset", "_name_length", "_names")
+    _MAGIC = "MFTTREE1"
+
+    def save(self, f):
+        """
+        Write the store to a file object opened for binary writing.
+        Children still waiting for a parent are saved as orphans.
+        """
+        f.write(MFTTreeStore._MAGIC)
+        for name in MFTTreeStore._COLUMNS:
+            column = getattr(self, name)
+            f.write(struct.pack("<cBQ", column.typecode,
+                                column.itemsize, len(column)))
+            column.tofile(f)
+
+    @staticmethod
+    def load(f):
+        """
+        Read a store written by `save` from a file object opened for
+          binary reading.
+        @raises INDXException if the file was not written by `save`
+          on a compatible build of Python.
+        """
+        if f.read(len(MFTTreeStore._MAGIC)) != MFTTreeStore._MAGIC:
+            raise INDXException("Not a saved MFT tree")
+        store = MFTTreeStore()
+        for name in MFTTreeStore._COLUMNS:
+            column = getattr(store, name)
+            header = f.read(struct.calcsize("<cBQ"))
+            try:
+                (typecode, itemsize, count) = struct.unpack("<cBQ", header)
+            except struct.error:
+                raise INDXException("Truncated MFT tree")
+            if typecode != column.typecode or itemsize != column.itemsize:
+                raise INDXException("Incompatible MFT tree column")
+            try:
+                column.fromfile(f, count)
+            except EOFError:
+                raise INDXException("Truncated MFT tree")
+        return store
+
+    def orphans(self):
+        """
+        Returns a list of the record numbers of nodes without a parent.
+        """
+        return [i for i in xrange(len(self._flags))
+                if self._flags[i] & MFTTreeStore.PRESENT and
+                self._parent[i] == -1]
+
+
 class NTFSFile():
     def __init__(self, options):
         if type(options) == dict:
@@ -851,6 +1753,7 @@ class NTFSFile():
             self.mftoffset = False
             self.prefix    = options["prefix"] or None
             self.progress  = options["progress"]
+            self.latency   = options.get("latency", 0)
         else:
             self.filename  = options.filename
             self.filetype  = options.filetype
@@ -859,11 +1762,16 @@ class NTFSFile():
             self.mftoffset = False
             self.prefix    = options.prefix
             self.progress  = options.progress
+            self.latency   = getattr(options, "latency", 0)
+        self._bitmap   = None
 
     # TODO calculate cluster size
 
+    def _open(self):
+        return open_image(self.filename, self.latency)
+
     def _calculate_mftoffset(self):
-        with open(self.filename, "rb") as f:
+        with self._open() as f:
             f.seek(self.offset)
             f.seek(0x30, 1)  # relative
             buf = f.read(8)
@@ -878,7 +1786,7 @@ class NTFSFile():
             size = os.path.getsize(self.filename)
             is_redirected = os.fstat(0) != os.fstat(1)
             should_progress = is_redirected and self.progress
-            with open(self.filename, "rb") as f:
+            with self._open() as f:
                 record = True
                 count = -1
                 while record:
@@ -902,7 +1810,7 @@ class NTFSFile():
         if self.filetype == "image":
             # TODO this overruns the MFT...
             # TODO this doesnt account for a fragmented MFT
-            with open(self.filename, "rb") as f:
+            with self._open() as f:
                 if not self.mftoffset:
                     self._calculate_mftoffset()
                 f.seek(self.mftoffset)
@@ -925,11 +1833,11 @@ class NTFSFile():
         if self.filetype == "indx":
             return array.array("B", "")
         if self.filetype == "mft":
-            with open(self.filename, "rb") as f:
+            with self._open() as f:
                 f.seek(number * 1024)
                 return array.array("B", f.read(1024))
         if self.filetype == "image":
-            with open(self.filename, "rb") as f:
+            with self._open() as f:
                 f.seek(number * 1024)
                 if not self.mftoffset:
                     self._calculate_mftoffset()
@@ -991,9 +1899,263 @@ class NTFSFile():
             return record
         return False
 
+    def cluster_bitmap(self):
+        """
+        Returns the ClusterBitmap loaded from $Bitmap (record 6).
+        Only available for images; the MFT alone does not contain
+          the data of $Bitmap.
+        """
+        if self._bitmap is not None:
+            return self._bitmap
+        if self.filetype != "image":
+            raise INDXException("$Bitmap requires an image")
+        attr = self.mft_get_record(6).data_attribute()
+        if attr is None:
+            raise INDXException("$Bitmap has no $DATA attribute")
+        if attr.non_resident() == 0:
+            data = attr.value().tostring()
+        else:
+            parts = []
+            with self._open() as f:
+                for (offset, length) in attr.runlist().runs():
+                    f.seek(offset * self.clustersize + self.offset)
+                    parts.append(f.read(length * self.clustersize))
+            data = "".join(parts)[:attr.data_size()]
+        with self._open() as f:
+            f.seek(self.offset)
+            boot = f.read(0x30)
+        # 4Kn volumes have 4096 byte sectors
+        sector_size = struct.unpack_from("<H", boot, 0x0B)[0] or 512
+        total_sectors = struct.unpack_from("<Q", boot, 0x28)[0]
+        clusters = None
+        if total_sectors > 0:
+            clusters = total_sectors * sector_size / self.clustersize
+        self._bitmap = ClusterBitmap(data, clusters)
+        return self._bitmap
+
+    def unallocated_extents(self):
+        """
+        Returns a list of (offset, length) tuples, in bytes, of the
+          unallocated space in the volume, suitable for carving.
+        """
+        return [(cluster * self.clustersize + self.offset,
+                 count * self.clustersize)
+                for (cluster, count)
+                in self.cluster_bitmap().extents(allocated=False)]
+
+    def directory_index(self, record, allocation=None):
+        """
+        Returns the DirectoryIndex of the $I30 index of the given
+          directory MFT record.
+        If `allocation` is provided, it is used as the already read
+          contents of the INDEX_ALLOCATION attribute.
+        """
+        root = None
+        attr = record.attribute(ATTR_TYPE.INDEX_ROOT)
+        if attr and attr.non_resident() == 0:
+            root = IndexRootHeader(attr.value(), 0, False)
+        if allocation is None:
+            allocation = array.array("B")
+            for attr in record.attributes():
+                if attr.type() != ATTR_TYPE.INDEX_ALLOCATION:
+                    continue
+                if attr.non_resident() == 0:
+                    allocation += array.array("B", attr.value())
+                    continue
+                for (offset, length) in attr.runlist().runs():
+                    try:
+                        allocation += self.read(offset * self.clustersize +
+                                                self.offset,
+                                                length * self.clustersize)
+                    except IOError:
+                        pass
+        return DirectoryIndex(root, allocation)
+
+    def carve_records(self, extents=None, alignment=1024):
+        """
+        Yields tuples (image offset, MFTRecord) for each valid FILE
+          record carved from the image, such as orphaned records in
+          unallocated space or file slack.
+        Arguments:
+        - `extents`: An optional list of (offset, length) tuples, in bytes,
+            that restricts the search.  By default, the whole volume.
+        - `alignment`: The alignment of records from the start of the
+            volume; 1024, or 512 to also find sector-aligned records.
+        """
+        if self.filetype != "image":
+            return
+        if extents is None:
+            size = os.path.getsize(self.filename)
+            extents = [(self.offset, size - self.offset)]
+        with self._open() as f:
+            for (offset, data) in carve_magic(f, "FILE", extents,
+                                              alignment, 4096,
+                                              base=self.offset):
+                # records are 1024 bytes, or 4096 bytes on 4Kn volumes
+                if len(data) < 0x20:
+                    continue
+                size = struct.unpack_from("<I", data, 0x1C)[0]
+                if size not in (1024, 4096):
+                    debug("Invalid FILE record size at %s" % (hex(offset)))
+                    continue
+                data = data[:size]
+                if len(data) < size or not valid_fixups(data):
+                    debug("Invalid FILE record at %s" % (hex(offset)))
+                    continue
+                try:
+                    record = MFTRecord(array.array("B", data), 0, False)
+                except (ParseException, OverrunBufferException):
+                    continue
+                if not record.is_valid():
+                    debug("Malformed FILE record at %s" % (hex(offset)))
+                    continue
+                yield (offset, record)
+
+    def data_extents(self, attr):
+        """
+        Returns a list of (logical offset, image offset, length) tuples,
+          in bytes, of the initialized data of a non-resident attribute.
+        Sparse runs have the image offset None.  The data past the
+          initialized size reads as zeros, and has no extents.
+        """
+        ret = []
+        end = min(attr.initialized_size(), attr.data_size())
+        logical = attr.lowest_vcn() * self.clustersize
+        for (cluster, count) in attr.runlist().data_runs():
+            if logical >= end:
+                break
+            length = min(count * self.clustersize, end - logical)
+            if cluster is None:
+                ret.append((logical, None, length))
+            else:
+                ret.append((logical, cluster * self.clustersize + self.offset,
+                            length))
+            logical += length
+        return ret
+
+    def _check_data_attribute(self, attr):
+        if attr.flags() & 0x4000:
+            raise INDXException("Cannot read encrypted data")
+        if attr.non_resident() == 0:
+            return
+        if self.filetype != "image":
+            raise INDXException("Cannot read non-resident data "
+                                "from anything but an image")
+        if attr.flags() & 0x0001:
+            raise INDXException("Cannot read compressed data")
+
+    def attribute_data(self, attr, f=None, chunk_size=0x100000):
+        """
+        Yields the data of an attribute as strings of at most
+          `chunk_size` bytes, so that large files are not held in
+          memory.  Sparse runs, and the data past the initialized size,
+          are zeros that are not read from the image.
+        Arguments:
+        - `attr`: A resident or non-resident Attribute.
+        - `f`: An open handle on the image, so that it may be shared
+            across many attributes.  By default, the image is opened
+            while the data is read.
+        """
+        self._check_data_attribute(attr)
+        if attr.non_resident() == 0:
+            yield attr.value()
+            return
+        if f is None:
+            with self._open() as f:
+                for chunk in self.attribute_data(attr, f, chunk_size):
+                    yield chunk
+            return
+        zeros = "\x00" * chunk_size
+        pos = 0
+        for (logical, offset, length) in self.data_extents(attr):
+            while pos < logical:
+                n = min(chunk_size, logical - pos)
+                yield zeros[:n]
+                pos += n
+            if offset is not None:
+                f.seek(offset)
+            end = logical + length
+            while pos < end:
+                n = min(chunk_size, end - pos)
+                chunk = zeros[:n]
+                if offset is not None:
+                    chunk = f.read(n)
+                    if not chunk:
+                        warning("Data at %s is past the end of the image" %
+                                (hex(offset + pos - logical)))
+                        break
+                yield chunk
+                pos += len(chunk)
+        while pos < attr.data_size():
+            n = min(chunk_size, attr.data_size() - pos)
+            yield zeros[:n]
+            pos += n
+
+    def export_attribute(self, attr, path):
+        """
+        Creates the output file for the data of an attribute, and returns
+          a list of (image offset, length, logical offset, output path)
+          reads that fill in its non-resident data, for `export_reads`.
+        Resident data is written at once.  Otherwise, the file is
+          extended to the data size, so sparse and uninitialized ranges
+          are left as zeros without being read.
+        The reads hold no reference to the attribute or its record,
+          so many may be collected without holding the records.
+        """
+        self._check_data_attribute(attr)
+        with open(path, "wb") as g:
+            if attr.non_resident() == 0:
+                g.write(attr.value())
+                return []
+            g.truncate(attr.data_size())
+        return [(offset, length, logical, path)
+                for (logical, offset, length) in self.data_extents(attr)
+                if offset is not None]
+
+    def export_reads(self, reads, chunk_size=0x100000):
+        """
+        Performs the reads returned by `export_attribute` for many files
+          through one handle, sorted by image offset, so the image is read
+          front to back rather than seeking back and forth between files.
+        """
+        current = None
+        g = None
+        try:
+            with self._open() as f:
+                for (offset, length, logical, path) in sorted(reads):
+                    if path != current:
+                        if g:
+                            g.close()
+                        g = open(path, "r+b")
+                        current = path
+                    f.seek(offset)
+                    g.seek(logical)
+                    while length > 0:
+                        chunk = f.read(min(chunk_size, length))
+                        if not chunk:
+                            warning("Data at %s is past the end of the "
+                                    "image" % (hex(offset)))
+                            break
+                        g.write(chunk)
+                        length -= len(chunk)
+        finally:
+            if g:
+                g.close()
+
+    def export_attributes(self, items, chunk_size=0x100000):
+        """
+        Writes the data of many attributes to files, given a list of
+          (attribute, output path) tuples, as `export_attribute` and
+          `export_reads` do.
+        """
+        reads = []
+        for (attr, path) in items:
+            reads.extend(self.export_attribute(attr, path))
+        self.export_reads(reads, chunk_size)
+
     def read(self, offset, length):
         if self.filetype == "image":
-            with open(self.filename, "rb") as f:
+            with self._open() as f:
                 f.seek(offset)
                 return array.array("B", f.read(length))
         return array.array("B", "")
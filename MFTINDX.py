@@ -23,15 +23,19 @@ from BinaryParser import info
 from BinaryParser import warning
 from BinaryParser import debug
 from BinaryParser import error
+from BinaryParser import StringsExtractor
+from SDS import SecurityDescriptorIndex
+from SDS import AccessEvaluator
+from SDS import ACCESS_MASK
+from SDS import WELL_KNOWN_USER_SIDS
 import calendar
+import re
 
 verbose = False
 import argparse
 
 
 def information_bodyfile(path, size, inode, owner_id, info, attributes=None):
-    if not attributes:
-        attributes = []
     try:
         modified = int(calendar.timegm(info.modified_time().timetuple()))
     except (ValueError, AttributeError):
@@ -48,21 +52,35 @@ def information_bodyfile(path, size, inode, owner_id, info, attributes=None):
         created  = int(calendar.timegm(info.created_time().timetuple()))
     except (ValueError, AttributeError):
         created = int(calendar.timegm(datetime.min.timetuple()))
+    return bodyfile_line(path, size, inode, owner_id,
+                         accessed, modified, changed, created, attributes)
+
+
+def bodyfile_line(path, size, inode, owner_id,
+                  accessed, modified, changed, created, attributes=None):
+    """
+    Returns a bodyfile formatted line, given Unix timestamps.
+    """
+    if not attributes:
+        attributes = []
     attributes_text = ""
     if len(attributes) > 0:
         attributes_text = " (%s)" % (", ".join(attributes))
-    return u"0|%s|%s|0|%d|0|%s|%s|%s|%s|%s\n" % (path + attributes_text, inode,
+    return u"0|%s|%s|0|%s|0|%s|%s|%s|%s|%s\n" % (path + attributes_text, inode,
                                                  owner_id,
                                                  size, accessed, modified,
                                                  changed, created)
 
 
-def record_bodyfile(ntfsfile, record, inode=None, attributes=None):
+def record_bodyfile(ntfsfile, record, inode=None, attributes=None,
+                    security=None):
     """
     Return a bodyfile formatted string for the given MFT record.
     The string contains metadata for the one file described by the record.
     The string may have multiple lines, which cover $SI and
       $FN timestamp entries, and entries for each ADS.
+    If a SecurityDescriptorIndex is provided as `security`, the owner SID
+      is listed in place of the security ID.
     """
     ret = ""
     if not attributes:
@@ -98,6 +116,8 @@ def record_bodyfile(ntfsfile, record, inode=None, attributes=None):
             si_index = si.security_id()
         except StandardInformationFieldDoesNotExist:
             si_index = 0
+        if security is not None:
+            si_index = security.owner(si_index) or si_index
         ret += "%s" % (information_bodyfile(path, size, inode, si_index, si, attributes))
         for ads in ADSs:
             ret += "%s" % (information_bodyfile(path + ":" + ads[0],
@@ -110,6 +130,8 @@ def record_bodyfile(ntfsfile, record, inode=None, attributes=None):
             si_index = si.security_id()
         except StandardInformationFieldDoesNotExist:
             si_index = 0
+        if security is not None:
+            si_index = security.owner(si_index) or si_index
         ret += "%s" % (information_bodyfile(path, size, inode, si_index, fn,
                                             attributes=attributes))
         for ads in ADSs:
@@ -120,37 +142,72 @@ def record_bodyfile(ntfsfile, record, inode=None, attributes=None):
     return ret
 
 
-def node_header_bodyfile(options, node_header, basepath):
+def compact_timestamp(filetime, default):
+    """
+    Returns the Unix timestamp of a FILETIME, or `default` if it is
+      outside the range `information_bodyfile` can represent.
+    """
+    t = filetime_to_unix(filetime)
+    if t < -62135596800 or t >= 253402300800:
+        return default
+    return t
+
+
+def index_entry_bodyfile(entry, basepath, attributes):
+    """
+    Returns a bodyfile formatted string for one INDX entry,
+      given as a CompactIndexEntry.
+    """
+    return bodyfile_line(basepath + "\\" + entry.filename,
+                         entry.logical_size, 0, 0,
+                         compact_timestamp(entry.accessed_time, 0),
+                         compact_timestamp(entry.modified_time, 0),
+                         compact_timestamp(entry.changed_time, 0),
+                         compact_timestamp(entry.created_time, -62135596800),
+                         attributes)
+
+
+def node_header_bodyfile(options, node_header, basepath, attributes=None):
     """
     Returns a bodyfile formatted string for all INDX entries following the
     given INDX node header.
+    `attributes` is an optional list of additional tags for each entry.
     """
     ret = ""
-    attrs = ["filename", "INDX"]
+    attrs = ["filename", "INDX"] + (attributes or [])
     if options.indxlist:
-        for e in node_header.entries():
-            path = basepath + "\\" + e.filename_information().filename()
-            size = e.filename_information().logical_size()
-            inode = 0
-            ret += information_bodyfile(path, size, inode, 0,
-                                        e.filename_information(),
-                                        attributes=attrs)
+        for e in node_header.compact_entries():
+            ret += index_entry_bodyfile(e, basepath, attrs)
     attrs.append("slack")
     if options.slack:
-        for e in node_header.slack_entries():
-            path = basepath + "\\" + e.filename_information().filename()
-            size = e.filename_information().logical_size()
-            inode = 0
-            ret += information_bodyfile(path, size, inode, 0,
-                                        e.filename_information(),
-                                        attributes=attrs)
+        for e in node_header.compact_slack_entries():
+            ret += index_entry_bodyfile(e, basepath, attrs)
     return ret
 
 
-def record_indx_entries_bodyfile(options, ntfsfile, record):
+def indx_allocation_extents(options, record):
+    """
+    Returns a list of (offset, length) tuples, in bytes relative to the
+    start of the image, that hold the non-resident INDX_ALLOCATION
+    attributes of the given MFT record.
+    """
+    extents = []
+    for attr in record.attributes():
+        if attr.type() != ATTR_TYPE.INDEX_ALLOCATION:
+            continue
+        if attr.non_resident() != 0:
+            for (offset, length) in attr.runlist().runs():
+                extents.append((offset * options.clustersize + options.offset,
+                                length * options.clustersize))
+    return extents
+
+
+def record_indx_entries_bodyfile(options, ntfsfile, record, extractbuf=None):
     """
     Returns a bodyfile formatted string for all INDX entries associated with
     the given MFT record
+    If `extractbuf` is provided, it is used as the already read contents
+      of the INDX_ALLOCATION attribute.
     """
     # TODO handle all possible errors here
     f = ntfsfile
@@ -158,49 +215,31 @@ def record_indx_entries_bodyfile(options, ntfsfile, record):
     if not record:
         return ret
     basepath = f.mft_record_build_path(record, {})
-    indxroot = record.attribute(ATTR_TYPE.INDEX_ROOT)
-    if indxroot:
-        if indxroot.non_resident() != 0:
-            # TODO this shouldn't happen.
-            pass
-        else:
-            irh = IndexRootHeader(indxroot.value(), 0, False)
-            nh = irh.node_header()
-            ret += node_header_bodyfile(options, nh, basepath)
-    extractbuf = array.array("B")
-    for attr in record.attributes():
-        if attr.type() != ATTR_TYPE.INDEX_ALLOCATION:
-            continue
-        if attr.non_resident() != 0:
-            for (offset, length) in attr.runlist().runs():
-                try:
-                    ooff = offset * options.clustersize + options.offset
-                    llen = length * options.clustersize
-                    extractbuf += f.read(ooff,
-                                         llen)
-                except IOError:
-                    pass
-        else:
-            extractbuf += array.array("B", attr.value())
-    if len(extractbuf) < 4096:  # TODO make this INDX record size
-        return ret
-    offset = 0
+    attrs = ["filename", "INDX"]
+    # a corrupt INDX node ends the listing of this directory only,
+    #   keeping the entries found before it
     try:
-        irh = IndexRecordHeader(extractbuf, offset, False)
-    except OverrunBufferException:
-        return ret
-    # TODO could miss something if there is an empty, valid record at the end
-    while irh.magic() == 0x58444E49:
-        nh = irh.node_header()
-        ret += node_header_bodyfile(options, nh, basepath)
-        # TODO get this from the boot record
-        offset += options.clustersize
-        if offset + 4096 > len(extractbuf):  # TODO make this INDX record size
-            return ret
-        try:
-            irh = IndexRecordHeader(extractbuf, offset, False)
-        except OverrunBufferException:
-            return ret
+        index = f.directory_index(record, extractbuf)
+        if options.indxlist:
+            for e in index.entries():
+                ret += index_entry_bodyfile(e, basepath, attrs)
+        if options.slack:
+            nodes = [block.node_header() for (_, block) in index.blocks()]
+            if index.root() is not None:
+                nodes.insert(0, index.root().node_header())
+            for nh in nodes:
+                for e in nh.compact_slack_entries():
+                    ret += index_entry_bodyfile(e, basepath,
+                                                attrs + ["slack"])
+        if options.indxlist:
+            # valid INDX records that the tree no longer points to
+            for (_, block) in index.unreferenced_blocks():
+                for e in block.node_header().compact_entries():
+                    ret += index_entry_bodyfile(e, basepath,
+                                                attrs + ["unreferenced"])
+    except (ParseException, UnicodeDecodeError, struct.error):
+        debug("Failed to parse INDX records of MFT record %d" %
+              (record.inode))
     return ret
 
 
@@ -213,36 +252,160 @@ def try_write(s):
 
 
 def print_nonresident_indx_bodyfile(options, buf, basepath=""):
-    offset = 0
-    try:
-        irh = IndexRecordHeader(buf, offset, False)
-    except OverrunBufferException:
-        return
-    # TODO could miss something if there is an empty, valid record at the end
-    while irh.magic() == 0x58444E49:
-        nh = irh.node_header()
-        try_write(node_header_bodyfile(options, nh, basepath))
-        offset += options.clustersize
-        if offset + 4096 > len(buf):  # TODO make this INDX record size
-            return
+    # there is no index root, so list each valid INDX record in VCN order
+    for (vcn, block) in DirectoryIndex(None, buf).blocks():
         try:
-            irh = IndexRecordHeader(buf, offset, False)
-        except OverrunBufferException:
-            return
-    return
+            try_write(node_header_bodyfile(options, block.node_header(),
+                                           basepath))
+        except ParseException:
+            debug("Failed to parse INDX record with VCN %d" % (vcn))
+
+
+def load_fingerprint_catalog(path):
+    """
+    Read a sidecar written by `--fingerprints` into a dict that maps
+      MFT record numbers to record fingerprints.
+    Malformed lines are skipped.
+    """
+    catalog = {}
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                (number, fingerprint) = line.strip().split(",")
+                catalog[int(number)] = fingerprint
+            except ValueError:
+                continue
+    return catalog
+
+
+def batched_records(options, ntfsfile, batch):
+    """
+    Yields tuples (list of MFT records, ExtentPlanner), where the planner
+      holds the INDX_ALLOCATION runs of up to `batch` of the records.
+    """
+    records = []
+    planner = ExtentPlanner()
+    for record in ntfsfile.record_generator():
+        extents = []
+        try:
+            if record.magic() == 0x454C4946:
+                extents = indx_allocation_extents(options, record)
+        except ParseException:
+            debug("Failed to find INDX_ALLOCATION runs "
+                  "for MFT record %d" % (record.inode))
+        if extents:
+            planner.add(record.inode, extents)
+        records.append(record)
+        if len(planner) >= batch or len(records) >= 16 * batch:
+            yield (records, planner)
+            records = []
+            planner = ExtentPlanner()
+    if records:
+        yield (records, planner)
+
+
+def indx_buffered_records(options, ntfsfile, pool=None):
+    """
+    Yields tuples (MFT record, INDX_ALLOCATION buffer or None).
+    The INDX_ALLOCATION runs of a batch of directories are planned
+      together: they are sorted, merged, and read with a few large
+      sequential requests, and then handed back to each record.
+    If a ReadAheadPool is provided, the reads for the next batch
+      are outstanding while the current batch is handled.
+    """
+    batch = options.prefetch or 64
+    if not pool:
+        with open_image(options.filename, options.latency) as f:
+            for (records, planner) in batched_records(options, ntfsfile,
+                                                      batch):
+                buffers = planner.read(f)
+                for record in records:
+                    yield (record, buffers.get(record.inode))
+        return
+
+    def submit(batch_id, planner):
+        reads = planner.plan()
+        keys = []
+        for (i, read) in enumerate(reads):
+            keys.append((batch_id, i))
+            pool.submit(keys[-1], [read])
+        return (reads, keys)
+
+    def collect(keys):
+        # a failed read leaves its directories to read their own INDX data
+        datas = []
+        for key in keys:
+            try:
+                datas.append(pool.get(key).tostring())
+            except IOError:
+                datas.append(None)
+        return datas
+
+    previous = None
+    for (batch_id, (records, planner)) in \
+            enumerate(batched_records(options, ntfsfile, batch)):
+        current = (records, planner, submit(batch_id, planner))
+        if previous:
+            (records, planner, (reads, keys)) = previous
+            datas = collect(keys)
+            buffers = planner.distribute(reads, datas)
+            for record in records:
+                yield (record, buffers.get(record.inode))
+        previous = current
+    if previous:
+        (records, planner, (reads, keys)) = previous
+        datas = collect(keys)
+        buffers = planner.distribute(reads, datas)
+        for record in records:
+            yield (record, buffers.get(record.inode))
+
+
+def open_security_index(options):
+    """
+    Returns the SecurityDescriptorIndex of the $SII and $SDS files
+      given on the command line, or None.
+    """
+    if not options.sii:
+        return None
+    return SecurityDescriptorIndex.open(options.sii, options.sds)
 
 
 def print_bodyfile(options):
     if options.filetype == "mft" or options.filetype == "image":
         f = NTFSFile(options)
+        security = open_security_index(options)
         if options.filter:
             refilter = re.compile(options.filter)
-        for record in f.record_generator():
+        catalog = {}
+        if options.catalog:
+            catalog = load_fingerprint_catalog(options.catalog)
+        sidecar = None
+        if options.fingerprints:
+            sidecar = open(options.fingerprints, "wb")
+        pool = None
+        if options.filetype == "image" and \
+           (options.indxlist or options.slack):
+            if options.prefetch:
+                pool = ReadAheadPool(options.filename,
+                                     workers=options.prefetch,
+                                     latency=options.latency)
+            records = indx_buffered_records(options, f, pool)
+        else:
+            records = ((r, None) for r in f.record_generator())
+        for (record, indxbuf) in records:
             debug("Considering MFT record %s" % (record.mft_record_number()))
             try:
                 if record.magic() != 0x454C4946:
                     debug("Record has a bad magic value")
                     continue
+                if sidecar or catalog:
+                    fingerprint = record.fingerprint()
+                    if sidecar:
+                        sidecar.write("%d,%s\n" % (record.inode, fingerprint))
+                    if catalog.get(record.inode) == fingerprint:
+                        debug("Skipping unchanged MFT record %d" % \
+                                  (record.inode))
+                        continue
                 if options.filter:
                     path = f.mft_record_build_path(record, {})
                     if not refilter.search(path):
@@ -250,40 +413,231 @@ def print_bodyfile(options):
                               "due to regex filter: " + path)
                         continue
                 if record.is_active() and options.mftlist:
-                    try_write(record_bodyfile(f, record))
+                    try_write(record_bodyfile(f, record, security=security))
                 if options.indxlist or options.slack:
-                    try_write(record_indx_entries_bodyfile(options, f, record))
+                    try_write(record_indx_entries_bodyfile(options, f, record,
+                                                           indxbuf))
                 elif (not record.is_active()) and options.deleted:
                     try_write(record_bodyfile(f, record,
-                                              attributes=["deleted"]))
-                if options.filetype == "image" and \
-                   (options.indxlist or options.slack):
-                    extractbuf = array.array("B")
-                    found_indxalloc = False
-                    for attr in record.attributes():
-                        if attr.type() != ATTR_TYPE.INDEX_ALLOCATION:
-                            continue
-                        found_indxalloc = True
-                        if attr.non_resident() != 0:
-                            for (offset, length) in attr.runlist().runs():
-                                ooff = offset * options.clustersize + options.offset
-                                llen = length * options.clustersize
-                                extractbuf += f.read(ooff, llen)
-                        else:
-                            pass  # This shouldn't happen.
-                    if found_indxalloc and len(extractbuf) > 0:
-                        path = f.mft_record_build_path(record, {})
-                        print_nonresident_indx_bodyfile(options,
-                                                        extractbuf,
-                                                        basepath=path)
+                                              attributes=["deleted"],
+                                              security=security))
             except InvalidAttributeException:
                 pass
+        if sidecar:
+            sidecar.close()
+        if pool:
+            pool.close()
+        if security:
+            security.close()
     elif options.filetype == "indx":
         with open(options.filename, "rb") as f:
             buf = array.array("B", f.read())
         print_nonresident_indx_bodyfile(options, buf)
 
 
+def print_writable_bodyfile(options):
+    """
+    List the active files that the SIDs given with --can-write may
+      write to, according to the DACLs of their security descriptors.
+    Each distinct security ID is evaluated once.
+    """
+    f = NTFSFile(options)
+    security = open_security_index(options)
+    evaluator = AccessEvaluator(options.can_write + WELL_KNOWN_USER_SIDS)
+    writable = {}  # security ID -> bool
+    for record in f.record_generator():
+        try:
+            if record.magic() != 0x454C4946 or not record.is_active():
+                continue
+            si = record.standard_information()
+            if not si:
+                continue
+            try:
+                security_id = si.security_id()
+            except StandardInformationFieldDoesNotExist:
+                continue
+            try:
+                can_write = writable[security_id]
+            except KeyError:
+                descriptor = security.descriptor(security_id)
+                can_write = descriptor is not None and \
+                    evaluator.allows(descriptor,
+                                     ACCESS_MASK.FILE_WRITE_DATA)
+                writable[security_id] = can_write
+            if can_write:
+                try_write(record_bodyfile(f, record,
+                                          attributes=["writable"],
+                                          security=security))
+        except InvalidAttributeException:
+            pass
+    security.close()
+
+
+def carved_indx_basepath(ntfsfile, node_header, offset):
+    """
+    Guess the path of the directory that owned a carved INDX record
+      from the parent reference of its entries.
+    """
+    ref = None
+    entries = node_header.compact_entries()
+    if len(entries) > 0:
+        ref = entries[0].mft_parent_reference
+    orphan = "\\$OrphanFiles\\INDX@%s" % (hex(offset))
+    if ref is None:
+        return orphan
+    try:
+        parent = ntfsfile.mft_get_record(ref & 0xFFFFFFFFFFFF)
+    except (InvalidMFTRecordNumber, ParseException):
+        return orphan
+    if parent.magic() != 0x454C4946 or \
+       parent.sequence_number() != ref >> 48:
+        return orphan
+    return ntfsfile.mft_record_build_path(parent, {})
+
+
+def print_indx_sweep_bodyfile(options, extents=None):
+    """
+    Carve INDX records from the image at cluster granularity, or every
+      4096 bytes with larger clusters, and list their live and slack
+      entries.  This recovers entries from the INDX records of deleted
+      directories, which are no longer reachable from any
+      INDX_ALLOCATION runlist.
+    `extents` is an optional list of (offset, length) tuples that
+      restricts the sweep; by default, the whole volume is swept.
+    """
+    f = NTFSFile(options)
+    if extents is None and options.unallocated:
+        extents = f.unallocated_extents()
+        debug("Restricted sweep to %d unallocated extents" % (len(extents)))
+    if extents is None:
+        size = os.path.getsize(options.filename)
+        extents = [(options.offset, size - options.offset)]
+    # INDX records are 4096 bytes, so with larger clusters, there are
+    #   several in each cluster
+    alignment = min(options.clustersize, 4096)
+    with open_image(options.filename, options.latency) as g:
+        for (offset, data) in carve_magic(g, "INDX", extents,
+                                          alignment, 4096,
+                                          base=options.offset):
+            if len(data) < 4096 or not valid_fixups(data):
+                debug("Invalid INDX record at %s" % (hex(offset)))
+                continue
+            try:
+                irh = IndexRecordHeader(array.array("B", data), 0, False)
+                nh = irh.node_header()
+                basepath = carved_indx_basepath(f, nh, offset)
+                try_write(node_header_bodyfile(options, nh, basepath,
+                                               attributes=["carved"]))
+            except (ParseException, UnicodeDecodeError, struct.error):
+                debug("Failed to parse INDX record at %s" % (hex(offset)))
+
+
+def print_carved_records_bodyfile(options):
+    """
+    Carve FILE records from the image, and list the files they describe.
+    """
+    f = NTFSFile(options)
+    security = open_security_index(options)
+    extents = None
+    if options.unallocated:
+        extents = f.unallocated_extents()
+    alignment = 512 if options.sector_aligned else 1024
+    for (offset, record) in f.carve_records(extents, alignment):
+        try:
+            try_write(record_bodyfile(f, record, attributes=["carved"],
+                                      security=security))
+        except InvalidAttributeException:
+            debug("No filename in FILE record at %s" % (hex(offset)))
+        except (ParseException, UnicodeDecodeError, struct.error):
+            debug("Failed to parse FILE record at %s" % (hex(offset)))
+    if security:
+        security.close()
+
+
+def region_strings(extractor, buf, start, end, base, prefix):
+    """
+    Returns a tab separated line for each string found in the given
+    region of the buffer.
+    `base` is subtracted from each offset, and `prefix` is a list of
+      columns to write before the offset.
+    """
+    ret = ""
+    end = min(end, len(buf))
+    for (offset, encoding, string) in extractor.strings(buf, start, end):
+        ret += "\t".join(prefix + [hex(offset - base), encoding, string])
+        ret += "\n"
+    return ret
+
+
+def node_header_strings(extractor, node_header, base, prefix):
+    """
+    Returns the strings found in the slack space of an INDX node.
+    """
+    start = node_header.offset() + node_header.entry_list_end()
+    end = node_header.offset() + node_header.entry_list_allocation_end()
+    return region_strings(extractor, node_header._buf, start, end,
+                          base, prefix)
+
+
+def record_strings(extractor, ntfsfile, record, extractbuf=None):
+    """
+    Returns the strings found in the slack space of the given MFT record,
+    and in the slack space of the INDX records of its $I30 index.
+    """
+    ret = ""
+    path = ntfsfile.mft_record_build_path(record, {})
+    inode = str(record.inode)
+    start = record.offset() + record.bytes_in_use()
+    end = record.offset() + record.bytes_allocated()
+    ret += region_strings(extractor, record._buf, start, end,
+                          record.offset(), [inode, path, "record"])
+    index = ntfsfile.directory_index(record, extractbuf)
+    if index.root() is not None:
+        ret += node_header_strings(extractor, index.root().node_header(), 0,
+                                   [inode, path, "INDX root"])
+    for (vcn, block) in index.blocks():
+        ret += node_header_strings(extractor, block.node_header(),
+                                   block.offset(),
+                                   [inode, path, "INDX vcn %d" % (vcn)])
+    return ret
+
+
+def print_strings(options):
+    """
+    List the ASCII and UTF-16 strings found in the slack space of
+      MFT records and INDX records.
+    Each line has the columns: inode, path, region, offset into
+      the region, encoding, string.
+    """
+    extractor = StringsExtractor(options.min_length)
+    if options.filetype == "indx":
+        with open(options.filename, "rb") as f:
+            buf = array.array("B", f.read())
+        for (vcn, block) in DirectoryIndex(None, buf).blocks():
+            try:
+                try_write(node_header_strings(extractor, block.node_header(),
+                                              block.offset(),
+                                              ["", "", "INDX vcn %d" % (vcn)]))
+            except (ParseException, UnicodeDecodeError, struct.error):
+                debug("Failed to find strings in INDX block %d" % (vcn))
+        return
+    f = NTFSFile(options)
+    if options.filetype == "image":
+        records = indx_buffered_records(options, f)
+    else:
+        records = ((r, None) for r in f.record_generator())
+    for (record, indxbuf) in records:
+        try:
+            if record.magic() != 0x454C4946:
+                debug("Record has a bad magic value")
+                continue
+            try_write(record_strings(extractor, f, record, indxbuf))
+        except (InvalidAttributeException, ParseException,
+                UnicodeDecodeError, struct.error):
+            debug("Failed to find strings in MFT record %d" %
+                  (record.inode))
+
+
 def print_indx_info(options):
     f = NTFSFile(options)
     try:
@@ -499,6 +853,92 @@ def print_indx_info(options):
     return
 
 
+def write_data(options):
+    """
+    Write the contents of the $DATA attribute, or of the alternate
+      data stream named with --stream, of a path or inode to a file,
+      or to STDOUT.
+    """
+    f = NTFSFile(options)
+    try:
+        record_num = int(options.datamode)
+        record = f.mft_get_record(record_num)
+    except ValueError:
+        record = f.mft_get_record_by_path(options.datamode)
+    except InvalidMFTRecordNumber:
+        error("MFT record %s is past the end of the MFT" %
+              (options.datamode))
+    if not record:
+        error("Did not find directory entry for " + options.datamode)
+    attr = record.data_attribute(options.stream)
+    if attr is None:
+        error("Did not find the $DATA attribute of " + options.datamode)
+    if options.output:
+        g = open(options.output, "wb")
+    else:
+        g = options.data_stdout
+    try:
+        for chunk in f.attribute_data(attr):
+            g.write(chunk)
+    except INDXException as e:
+        error(str(e))
+    finally:
+        if options.output:
+            g.close()
+
+
+def export_data(options):
+    """
+    Extract the $DATA attribute, or the alternate data stream named
+      with --stream, of each active file, or of those whose path
+      matches the filter, into a directory.
+    Files are named by inode, and each line of output has the columns:
+      inode, path, extracted file, size.
+    Only the planned reads are kept while the MFT is walked, not the
+      records, so memory does not grow with the number of records.
+    """
+    f = NTFSFile(options)
+    if options.filter:
+        refilter = re.compile(options.filter)
+    reads = []
+    for record in f.record_generator():
+        try:
+            if record.magic() != 0x454C4946:
+                debug("Record has a bad magic value")
+                continue
+            if not record.is_active() or record.is_directory():
+                continue
+            attr = record.data_attribute(options.stream)
+            if attr is None:
+                continue
+            path = f.mft_record_build_path(record, {})
+            if options.filter and not refilter.search(path):
+                debug("Skipping extracting path "
+                      "due to regex filter: " + path)
+                continue
+        except InvalidAttributeException:
+            continue
+        if attr.non_resident() > 0 and options.filetype != "image":
+            warning("Cannot extract non-resident data of %s "
+                    "from anything but an image" % (path))
+            continue
+        if attr.non_resident() > 0 and attr.flags() & 0x0001:
+            warning("Cannot extract compressed data of %s" % (path))
+            continue
+        if attr.flags() & 0x4000:
+            warning("Cannot extract encrypted data of %s" % (path))
+            continue
+        outpath = os.path.join(options.export, str(record.inode))
+        if attr.non_resident() > 0:
+            size = attr.data_size()
+        else:
+            size = attr.value_length()
+        reads.extend(f.export_attribute(attr, outpath))
+        try_write(u"%d\t%s\t%s\t%d\n" %
+                  (record.inode, path, outpath, size))
+    f.export_reads(reads)
+
+
 def main():
     parser = argparse.ArgumentParser(description='Parse NTFS '
                                      'filesystem structures.')
@@ -524,6 +964,43 @@ def main():
     parser.add_argument('-d', action="store_true", dest="deleted",
                         help="List file entries for MFT records "
                         "marked as deleted")
+    parser.add_argument('-w', action="store_true", dest="sweep",
+                        help="Sweep the image for INDX records, including "
+                        "those of deleted directories, and list "
+                        "their entries")
+    parser.add_argument('--carve', action="store_true", dest="carve",
+                        help="Carve FILE records from the image, and "
+                        "list the files they describe")
+    parser.add_argument('--sector-aligned', action="store_true",
+                        dest="sector_aligned",
+                        help="Carve FILE records at 512 byte, rather "
+                        "than 1024 byte, alignment")
+    parser.add_argument('--unallocated', action="store_true",
+                        dest="unallocated",
+                        help="Restrict the sweep (-w) or carving (--carve) "
+                        "to clusters that $Bitmap marks as unallocated")
+    parser.add_argument('--strings', action="store_true",
+                        dest="strings",
+                        help="List strings found in the slack space "
+                        "of MFT records and INDX records")
+    parser.add_argument('--min-length', action="store", metavar="count",
+                        nargs=1, type=int, dest="min_length",
+                        help="Minimum length of strings listed in "
+                        "strings mode (--strings), default 4")
+    parser.add_argument('--sii', action="store", metavar="path",
+                        nargs=1, dest="sii",
+                        help="Extracted $Secure:$SII INDEX_ALLOCATION, "
+                        "used with --sds to list file owner SIDs")
+    parser.add_argument('--sds', action="store", metavar="path",
+                        nargs=1, dest="sds",
+                        help="Extracted $Secure:$SDS stream, "
+                        "used with --sii to list file owner SIDs")
+    parser.add_argument('--can-write', action="append", metavar="SID",
+                        dest="can_write",
+                        help="List the files that this SID, along with "
+                        "Everyone and Authenticated Users, may write to; "
+                        "may be repeated for group SIDs, "
+                        "and requires --sii and --sds")
     parser.add_argument('-i', action="store", metavar="path|inode",
                         nargs=1, dest="infomode",
                         help="Print information about a path's INDX records")
@@ -531,6 +1008,23 @@ def main():
                         nargs=1, dest="extract",
                         help="Used with -i, extract INDX_ALLOCATION "
                         "attribute to a file")
+    parser.add_argument('--data', action="store", metavar="path|inode",
+                        nargs=1, dest="datamode",
+                        help="Write the contents of a path's $DATA "
+                        "attribute to STDOUT, or to the file given "
+                        "with --output")
+    parser.add_argument('--output', action="store", metavar="path",
+                        nargs=1, dest="output",
+                        help="Used with --data, write the contents "
+                        "to a file")
+    parser.add_argument('--export', action="store", metavar="dir",
+                        nargs=1, dest="export",
+                        help="Extract the $DATA attributes of active "
+                        "files, or those matching -f, into a directory")
+    parser.add_argument('--stream', action="store", metavar="name",
+                        nargs=1, dest="stream",
+                        help="Used with --data or --export, extract "
+                        "this alternate data stream")
     parser.add_argument('-f', action="store", metavar="regex",
                         nargs=1, dest="filter",
                         help="Only consider entries whose path "
@@ -538,6 +1032,23 @@ def main():
     parser.add_argument('-p', action="store", metavar="prefix",
                         nargs=1, dest="prefix",
                         help="Prefix paths with `prefix` rather than \\.\\")
+    parser.add_argument('--fingerprints', action="store", metavar="path",
+                        nargs=1, dest="fingerprints",
+                        help="Write a record number to record fingerprint "
+                        "sidecar to this file")
+    parser.add_argument('--catalog', action="store", metavar="path",
+                        nargs=1, dest="catalog",
+                        help="Skip MFT records whose fingerprint matches "
+                        "this sidecar from a previous run")
+    parser.add_argument('--prefetch', action="store", metavar="count",
+                        nargs=1, type=int, dest="prefetch",
+                        help="Read the INDX_ALLOCATION attributes of this "
+                        "many directories per batch, and read the next "
+                        "batch concurrently (image input only)")
+    parser.add_argument('--latency', action="store", metavar="ms",
+                        nargs=1, type=int, dest="latency",
+                        help="Simulate this many milliseconds of latency "
+                        "on each read of the input")
     parser.add_argument('--progress', action="store_true",
                         dest="progress",
                         help="Update a status indicator on STDERR "
@@ -552,6 +1063,11 @@ def main():
     global verbose
     verbose = results.verbose
 
+    # file data written to STDOUT must not be mixed with messages
+    results.data_stdout = sys.stdout
+    if results.datamode and not results.output:
+        sys.stdout = sys.stderr
+
     if results.filetype and results.filetype != "auto":
         results.filetype = results.filetype[0].lower()
         info("Asked to process a file with type: " + results.filetype)
@@ -617,15 +1133,100 @@ def main():
         if results.filetype == "indx":
             error("Cannot list MFT entries of an INDX record")
 
+    if results.sweep:
+        info("Asked to sweep the image for INDX records")
+        if results.filetype != "image":
+            error("Cannot sweep for INDX records in anything but an image")
+        if results.mftlist or results.deleted:
+            error("Sweep mode (-w) cannot be run "
+                  "with MFT list modes (-m/-d)")
+        if not (results.indxlist or results.slack):
+            results.indxlist = True
+            results.slack = True
+
+    if results.carve:
+        info("Asked to carve FILE records from the image")
+        if results.filetype != "image":
+            error("Cannot carve FILE records from anything but an image")
+        if results.mftlist or results.deleted:
+            error("Carve mode (--carve) cannot be run "
+                  "with MFT list modes (-m/-d)")
+
+    if results.sector_aligned and not results.carve:
+        warning("Sector alignment (--sector-aligned) "
+                "doesn't make sense without carve mode (--carve)")
+
+    if results.unallocated and not (results.sweep or results.carve):
+        warning("Restricting to unallocated clusters (--unallocated) "
+                "doesn't make sense without sweep (-w) or carve (--carve)")
+
+    if results.strings:
+        info("Asked to list strings in MFT record and INDX record slack")
+        if results.indxlist or \
+           results.slack or \
+           results.mftlist or \
+           results.deleted or \
+           results.sweep or \
+           results.carve:
+            error("Strings mode (--strings) cannot be run "
+                  "with file entry list modes (-l/-s/-m/-d/-w/--carve)")
+
+    if results.min_length:
+        results.min_length = results.min_length[0]
+        info("Listing strings of at least %d characters" %
+             (results.min_length))
+        if not results.strings:
+            warning("Minimum length (--min-length) doesn't make sense "
+                    "without strings mode (--strings)")
+    else:
+        results.min_length = 4
+
+    if results.sii or results.sds:
+        if not (results.sii and results.sds):
+            error("Owner SIDs require both $SII (--sii) and $SDS (--sds)")
+        results.sii = results.sii[0]
+        results.sds = results.sds[0]
+        info("Listing owner SIDs using %s and %s" %
+             (results.sii, results.sds))
+        if not (results.mftlist or results.deleted or results.carve or
+                results.can_write):
+            warning("Owner SIDs (--sii/--sds) only apply to "
+                    "MFT list modes (-m/-d), carve mode (--carve), "
+                    "and write access mode (--can-write)")
+
+    if results.can_write:
+        info("Asked to list files that %s may write to" %
+             (", ".join(results.can_write)))
+        if results.filetype == "indx":
+            error("Cannot list MFT entries of an INDX record")
+        if not results.sii:
+            error("Write access mode (--can-write) requires "
+                  "$SII (--sii) and $SDS (--sds)")
+        if results.indxlist or \
+           results.slack or \
+           results.mftlist or \
+           results.deleted or \
+           results.sweep or \
+           results.carve or \
+           results.strings:
+            error("Write access mode (--can-write) cannot be run "
+                  "with other list modes "
+                  "(-l/-s/-m/-d/-w/--carve/--strings)")
+
     if results.infomode:
         results.infomode = results.infomode[0]
         info("Asked to list information about path " + results.infomode)
         if results.indxlist or \
            results.slack or \
            results.mftlist or \
-           results.deleted:
+           results.deleted or \
+           results.sweep or \
+           results.carve or \
+           results.strings or \
+           results.can_write:
             error("Information mode (-i) cannot be run "
-                  "with file entry list modes (-l/-s/-m/-d)")
+                  "with file entry list modes "
+                  "(-l/-s/-m/-d/-w/--carve/--strings/--can-write)")
 
         if results.extract:
             results.extract = results.extract[0]
@@ -640,12 +1241,65 @@ def main():
         error("Cannot extract non-resident attributes "
               "from anything but an image")
 
+    if results.datamode or results.export:
+        if results.datamode and results.export:
+            error("Data mode (--data) cannot be run "
+                  "with export mode (--export)")
+        if results.filetype == "indx":
+            error("Cannot extract file data from an INDX record")
+        if results.indxlist or \
+           results.slack or \
+           results.mftlist or \
+           results.deleted or \
+           results.sweep or \
+           results.carve or \
+           results.strings or \
+           results.can_write or \
+           results.infomode:
+            error("Data modes (--data/--export) cannot be run "
+                  "with other modes "
+                  "(-i/-l/-s/-m/-d/-w/--carve/--strings/--can-write)")
+
+    if results.datamode:
+        results.datamode = results.datamode[0]
+        info("Asked to extract the $DATA attribute of " + results.datamode)
+
+    if results.output:
+        results.output = results.output[0]
+        info("Writing file data to " + results.output)
+        if not results.datamode:
+            warning("Output (--output) doesn't make sense "
+                    "without data mode (--data)")
+
+    if results.export:
+        results.export = results.export[0]
+        info("Asked to extract file data into " + results.export)
+        if not os.path.isdir(results.export):
+            error("Export directory %s does not exist" % (results.export))
+
+    if results.stream:
+        results.stream = results.stream[0].decode("utf-8")
+        info("Extracting the alternate data stream " + results.stream)
+        if not (results.datamode or results.export):
+            warning("Stream (--stream) doesn't make sense "
+                    "without data modes (--data/--export)")
+    else:
+        results.stream = ""
+
     if not (results.indxlist or
             results.slack or
             results.mftlist or
             results.deleted or
-            results.infomode):
-        error("You must choose a mode (-i/-l/-s/-m/-d)")
+            results.sweep or
+            results.carve or
+            results.strings or
+            results.can_write or
+            results.infomode or
+            results.datamode or
+            results.export):
+        error("You must choose a mode "
+              "(-i/-l/-s/-m/-d/-w/--carve/--strings/--can-write/"
+              "--data/--export)")
 
     if results.filter:
         results.filter = results.filter[0]
@@ -654,8 +1308,50 @@ def main():
         if results.infomode:
             warning("This filter has no meaning with information mode (-i)")
 
+    if results.fingerprints:
+        results.fingerprints = results.fingerprints[0]
+        info("Writing record fingerprints to " + results.fingerprints)
+        if results.filetype == "indx":
+            error("Cannot fingerprint MFT records of an INDX record")
+
+    if results.catalog:
+        results.catalog = results.catalog[0]
+        info("Skipping records unchanged since the catalog " +
+             results.catalog)
+        if results.filetype == "indx":
+            error("Cannot compare MFT records of an INDX record")
+        if results.infomode:
+            warning("The catalog has no meaning with information mode (-i)")
+
+    if results.prefetch:
+        results.prefetch = results.prefetch[0]
+        info("Reading INDX_ALLOCATION attributes in batches of %d "
+             "directories ahead" % (results.prefetch))
+        if results.filetype != "image":
+            warning("Read ahead (--prefetch) only applies to image input")
+
+    if results.latency:
+        results.latency = results.latency[0] / 1000.0
+        info("Simulating %s seconds of latency per read" %
+             (str(results.latency)))
+    else:
+        results.latency = 0
+
     if results.infomode:
         print_indx_info(results)
+    elif results.datamode:
+        write_data(results)
+    elif results.export:
+        export_data(results)
+    elif results.strings:
+        print_strings(results)
+    elif results.can_write:
+        print_writable_bodyfile(results)
+    elif results.sweep or results.carve:
+        if results.sweep:
+            print_indx_sweep_bodyfile(results)
+        if results.carve:
+            print_carved_records_bodyfile(results)
     elif results.indxlist or \
          results.slack or \
          results.mftlist or \
@@ -18,9 +18,13 @@
 #   limitations under the License.
 #
 #   Version v.2.0.0
+import os
 import sys
 import re
-import array
+import struct
+import hashlib
+import argparse
+import threading
 
 import wx
 import wx.lib.scrolledpanel as scrolled
@@ -28,11 +32,14 @@ import wx.lib.newevent
 from wx.lib.evtmgr import eventManager
 
 from MFT import NTFSFile
-from MFT import MFTRecord
+from MFT import MFTTreeStore
 from MFT import IndexRootHeader
 from MFT import ATTR_TYPE
 from MFT import FilenameAttribute
 from MFT import InvalidMFTRecordNumber
+from MFT import INDXException
+from BinaryParser import ParseException
+from BinaryParser import StringsExtractor
 
 
 verbose = False
@@ -49,53 +56,94 @@ VolumeOffsetUpdatedEvent, EVT_VOLUME_OFFSET_UPDATED_EVENT = wx.lib.newevent.NewE
 # @param cluster_size The cluster size in bytes.
 ClusterSizeUpdatedEvent, EVT_CLUSTER_SIZE_UPDATED_EVENT = wx.lib.newevent.NewEvent()
 
+# TreeLoadProgressEvent
+# @param count The number of MFT records loaded so far.
+# @param total The approximate number of MFT records.
+# @param done True once loading has finished or stopped.
+# @param updated A list of record numbers whose children changed.
+TreeLoadProgressEvent, EVT_TREE_LOAD_PROGRESS_EVENT = wx.lib.newevent.NewEvent()
+
 
 def nop(*args, **kwargs):
     pass
 
 
+def _tree_cache_path(filename):
+    """
+    Returns the path at which the tree built from the given MFT file
+      is cached.  The name depends on the size and modification time
+      of the file, and a hash of a few samples of its contents, so a
+      changed file gets a new entry.
+    """
+    st = os.stat(filename)
+    h = hashlib.md5("%d:%d" % (st.st_size, int(st.st_mtime)))
+    with open(filename, "rb") as f:
+        for offset in (0, st.st_size / 2, max(st.st_size - 0x10000, 0)):
+            f.seek(offset)
+            h.update(f.read(0x10000))
+    cache_home = os.environ.get("XDG_CACHE_HOME") or \
+        os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "mftview", h.hexdigest() + ".tree")
+
+
 def _expand_into(dest, src):
     vbox = wx.BoxSizer(wx.VERTICAL)
     vbox.Add(src, 1, wx.EXPAND | wx.ALL)
     dest.SetSizer(vbox)
 
 
+_HEX_FILTER = ''.join([(len(repr(chr(x))) == 3) and chr(x) or '.'
+                       for x in range(256)])
+
+
+def _format_hex_row(data, offset, length=16):
+    """
+    Returns a tuple (offset, hex, ascii) of strings for the row
+      of a hex dump that starts at the given offset.
+    """
+    s = data[offset:offset + length]
+    return ("%04X" % (offset),
+            ' '.join(["%02X" % ord(x) for x in s]),
+            s.translate(_HEX_FILTER))
+
+
 def _format_hex(data):
     """
     see http://code.activestate.com/recipes/142812/
     """
-    FILTER = ''.join([(len(repr(chr(x))) == 3) and chr(x) or '.'
-                      for x in range(256)])
-
-    def dump(src, length=16):
-        N = 0
-        result = ''
-        while src:
-            s, src = src[:length], src[length:]
-            hexa = ' '.join(["%02X" % ord(x) for x in s])
-            s = s.translate(FILTER)
-            result += "%04X   %-*s   %s\n" % (N, length * 3, hexa, s)
-            N += length
-        return result
-    return dump(data)
-
-
-class Node():
+    length = 16
+    result = []
+    for offset in range(0, len(data), length):
+        (N, hexa, s) = _format_hex_row(data, offset, length)
+        result.append("%s   %-*s   %s\n" % (N, length * 3, hexa, s))
+    return ''.join(result)
+
+
+class Node(object):
     """
     A node in the file system directory structure.
+    This is a lightweight view of one entry in an MFTTreeStore.
     """
-    def __init__(self, number, name, parent, is_directory):
+    __slots__ = ("_store", "_number")
+
+    def __init__(self, store, number):
+        self._store = store
         self._number = number
-        self._name = name
-        self._parent = parent
-        self.children = []  # public
-        self.is_directory = is_directory
 
-    def add_child(self, child):
-        self.children.append(child)
+    @property
+    def children(self):
+        return [Node(self._store, c)
+                for c in self._store.children(self._number)]
+
+    @property
+    def is_directory(self):
+        return self._store.is_directory(self._number)
+
+    def has_children(self):
+        return self._store.has_children(self._number)
 
     def get_name(self):
-        return self._name
+        return self._store.name(self._number)
 
 
 class AppModel(wx.EvtHandler):
@@ -103,12 +151,25 @@ class AppModel(wx.EvtHandler):
     @emit EVT_RECORD_UPDATED_EVENT
     @emit EVT_VOLUME_OFFSET_UPDATED_EVENT
     @emit EVT_CLUSTER_SIZE_UPDATED_EVENT
+    @emit EVT_TREE_LOAD_PROGRESS_EVENT
     """
-    def __init__(self, filename, record):
+    # number of records parsed by the loader before handing them to the UI
+    LOAD_BATCH_SIZE = 2000
+
+    def __init__(self, filename, record, filetype="mft"):
+        """
+        @param filetype - "mft" to load the tree from an MFT file, or
+          "image" to read directories on demand from a file system image.
+        """
         super(AppModel, self).__init__()
         self._filename = filename
-        self._nodes = {}
-        self._orphans = []
+        self._filetype = filetype
+        # record numbers of directories whose children have been read,
+        #   when reading directories on demand
+        self._read_directories = set()
+        self._tree = None
+        self._loader = None
+        self._stop_loading = threading.Event()
         self._record = record
         self._volume_offset = 32256
         self._cluster_size = 4096
@@ -144,24 +205,87 @@ class AppModel(wx.EvtHandler):
         return self.get_node(5)
 
     def get_node(self, rec_num):
-        if len(self._nodes) == 0:
+        if self._tree is None:
             self.fetch()
-        return self._nodes[rec_num]
+        return Node(self._tree, rec_num)
 
-    def fetch(self, progress_fn=nop):
+    def has_node(self, rec_num):
+        return self._tree is not None and rec_num in self._tree
+
+    def is_lazy(self):
         """
-        @param progress_fn - A function(count, total) called periodically
+        True if directories are read on demand from their INDX data,
+          rather than from a complete pass over the MFT.
         """
-        if len(self._nodes) > 0:
-            return
+        return self._filetype == "image"
 
-        total_count = 0
-        with open(self._filename, "rb") as f:
-            f.seek(0, 2)  # end
-            total_count = f.tell() / 1024
-            f.seek(0)
+    def has_children(self, rec_num):
+        """
+        When reading on demand, an unread directory may have children.
+        """
+        if self.is_lazy() and rec_num not in self._read_directories:
+            return self._tree.is_directory(rec_num)
+        return self._tree.has_children(rec_num)
 
-        f = NTFSFile({
+    def get_children(self, rec_num):
+        """
+        Returns the children of a node, directories first, each ordered
+          by name.  When reading on demand, the order comes from the
+          collated directory index, so no sorting is needed.
+        """
+        if not self.is_lazy():
+            return sorted(self.get_node(rec_num).children,
+                          key=lambda n: (not n.is_directory, n.get_name()))
+        numbers = self._read_directory(rec_num)
+        directories = [n for n in numbers if self._tree.is_directory(n)]
+        files = [n for n in numbers if not self._tree.is_directory(n)]
+        return [Node(self._tree, n) for n in directories + files]
+
+    def _read_directory(self, rec_num):
+        """
+        Add the children listed in a directory's $I30 index to the tree.
+        Returns their record numbers in collation order.
+        """
+        f = self.ntfsfile()
+        try:
+            record = f.mft_get_record(rec_num)
+            entries = list(f.directory_index(record).entries())
+        except (InvalidMFTRecordNumber, ParseException,
+                UnicodeDecodeError, struct.error):
+            sys.stderr.write("Unable to read directory %d\n" % (rec_num))
+            entries = []
+        self._read_directories.add(rec_num)
+
+        # a file is listed once for each name; prefer its long name
+        chosen = {}
+        for (i, e) in enumerate(entries):
+            number = e.mft_reference & 0xFFFFFFFFFFFF
+            if number == rec_num:  # the root lists itself as "."
+                continue
+            if number not in chosen or \
+               (chosen[number][1].filename_type == 2 and
+                e.filename_type != 2):
+                chosen[number] = (chosen.get(number, (i,))[0], e)
+        numbers = []
+        for (_, e) in sorted(chosen.values()):
+            number = e.mft_reference & 0xFFFFFFFFFFFF
+            self._tree.add(number, e.filename, e.mft_reference >> 48,
+                           e.file_flags & 0x10000000 != 0, rec_num,
+                           self._tree.sequence_number(rec_num))
+            numbers.append(number)
+        return numbers
+
+    def ntfsfile(self):
+        if self.is_lazy():
+            return NTFSFile({
+                "filename": self._filename,
+                "filetype": "image",
+                "offset": self._volume_offset,
+                "clustersize": self._cluster_size,
+                "prefix": "C:",
+                "progress": False,
+            })
+        return NTFSFile({
             "filename": self._filename,
             "filetype": "mft",
             "offset": 0,
@@ -170,79 +294,142 @@ class AppModel(wx.EvtHandler):
             "progress": False,
         })
 
-        class RecordConflict(Exception):
-            def __init__(self, count):
-                self.value = count
-
-        def add_node(mftfile, record):
-            """
-            Depends on the closure of `nodes` and `orphans`
-            @raises RecordConflict if the record already exists in nodes
-            """
-            rec_num = record.mft_record_number() & 0xFFFFFFFFFFFF
-
-            # node already exists by rec_num
-            if rec_num in self._nodes:
-                raise RecordConflict(rec_num)
-
-            # no filename info --> orphan with name "???"
-            fn = record.filename_information()
-            if not fn:
-                node = Node(rec_num, "???", None, record.is_directory())
-                self._orphans.append(node)
-                self._nodes[rec_num] = node
-                return node
-
-            # one level cycle
-            parent_record_num = fn.mft_parent_reference() & 0xFFFFFFFFFFFF
-            if parent_record_num == rec_num:
-                node = Node(rec_num, fn.filename(),
-                            None, record.is_directory())
-                self._orphans.append(node)
-                self._nodes[rec_num] = node
-                return node
-
-            if parent_record_num not in self._nodes:
-                # no parent --> orphan with correct filename
-                parent_buf = mftfile.mft_get_record_buf(parent_record_num)
-                if parent_buf == array.array("B", ""):
-                    node = Node(rec_num, fn.filename(),
-                                None, record.is_directory())
-                    self._orphans.append(node)
-                    self._nodes[rec_num] = node
-                    return node
-
-                # parent sequence num incorrect -->
-                #  orphan with correct filename
-                parent = MFTRecord(parent_buf, 0, False)
-                if parent.sequence_number() != fn.mft_parent_reference() >> 48:
-                    node = Node(rec_num, fn.filename(),
-                                None, record.is_directory())
-                    self._orphans.append(node)
-                    self._nodes[rec_num] = node
-                    return node
-
-                add_node(mftfile, parent)
-
-            parent_node = self._nodes[parent_record_num]
-            node = Node(rec_num, fn.filename(),
-                        parent_node, record.is_directory())
-            self._nodes[rec_num] = node
-            parent_node.add_child(node)
-            return node
+    def _total_count(self):
+        with open(self._filename, "rb") as f:
+            f.seek(0, 2)  # end
+            return f.tell() / 1024
+
+    def _load_cached_tree(self):
+        """
+        Returns the cached tree for this file, or None.
+        """
+        try:
+            with open(_tree_cache_path(self._filename), "rb") as f:
+                return MFTTreeStore.load(f)
+        except (IOError, OSError, INDXException):
+            return None
+
+    def _save_cached_tree(self):
+        try:
+            path = _tree_cache_path(self._filename)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            # write aside and rename, so a partial file is never read
+            with open(path + ".tmp", "wb") as f:
+                self._tree.save(f)
+            os.rename(path + ".tmp", path)
+        except (IOError, OSError) as e:
+            sys.stderr.write("Unable to cache MFT tree: %s\n" % (str(e)))
+
+    def fetch(self, progress_fn=nop):
+        """
+        Load the whole tree before returning.
+        @param progress_fn - A function(count, total) called periodically
+        """
+        if self._tree is not None:
+            return
+
+        self._tree = self._load_cached_tree()
+        if self._tree is not None:
+            return
 
+        total_count = self._total_count()
+        tree = MFTTreeStore()
         count = 0
-        for record in f.record_generator():
+        for record in self.ntfsfile().record_generator():
             count += 1
-            try:
-                add_node(f, record)
-            except RecordConflict:
-                # this is expected.
-                # this record must be a directory, and a descendant has already
-                # been processed.
-                pass
+            tree.add_record(record.inode, record)
             if count % 100 == 0:
                 progress_fn(count, total_count)
+        self._tree = tree
+        self._save_cached_tree()
+
+    def start_loading(self):
+        """
+        Load the tree on a worker thread.  Nodes become visible through
+          `get_node` in batches, and each batch is announced with an
+          EVT_TREE_LOAD_PROGRESS_EVENT.
+        A tree cached by an earlier session is used instead, if present.
+        """
+        if self._tree is not None:
+            return
+        if self.is_lazy():
+            self._tree = MFTTreeStore()
+            try:
+                self._tree.add_record(5, self.ntfsfile().mft_get_record(5))
+            except (InvalidMFTRecordNumber, ParseException):
+                sys.stderr.write("Unable to read the root directory\n")
+            wx.PostEvent(self, TreeLoadProgressEvent(count=len(self._tree),
+                                                     total=len(self._tree),
+                                                     done=True, updated=[]))
+            return
+        self._tree = self._load_cached_tree()
+        if self._tree is not None:
+            wx.PostEvent(self, TreeLoadProgressEvent(count=len(self._tree),
+                                                     total=len(self._tree),
+                                                     done=True, updated=[]))
+            return
+        self._tree = MFTTreeStore()
+        self._stop_loading.clear()
+        self._loader = threading.Thread(target=self._load,
+                                        args=(self._total_count(),))
+        self._loader.daemon = True
+        self._loader.start()
+
+    def stop_loading(self):
+        self._stop_loading.set()
+
+    def is_loading(self):
+        return self._loader is not None and self._loader.is_alive()
+
+    def _load(self, total_count):
+        """
+        Runs on the loader thread.  Only parses records; the store is
+          only modified on the UI thread, in `_add_batch`.
+        Records that fail to parse are skipped, and the final batch is
+          always posted, so the load finishes even if the thread fails.
+        """
+        batch = []
+        count = 0
+        try:
+            for record in self.ntfsfile().record_generator():
+                if self._stop_loading.is_set():
+                    break
+                count += 1
+                try:
+                    fields = MFTTreeStore.record_fields(record)
+                except (ParseException, UnicodeDecodeError, struct.error):
+                    sys.stderr.write("Unable to read MFT record %d\n" %
+                                     (record.inode))
+                    continue
+                batch.append((record.inode,) + fields)
+                if len(batch) >= AppModel.LOAD_BATCH_SIZE:
+                    wx.CallAfter(self._add_batch, batch, count, total_count,
+                                 False)
+                    batch = []
+        except Exception:
+            # the tree is incomplete, so it must not be cached
+            self._stop_loading.set()
+            raise
+        finally:
+            wx.CallAfter(self._add_batch, batch, count, total_count, True)
+
+    def _add_batch(self, batch, count, total, done):
+        tree = self._tree
+        updated = set()
+        for fields in batch:
+            number = fields[0]
+            if not tree.add(*fields):
+                continue
+            if tree.parent(number) != -1:
+                updated.add(tree.parent(number))
+            if tree.has_children(number):
+                updated.add(number)
+        if done and not self._stop_loading.is_set():
+            self._save_cached_tree()
+        wx.PostEvent(self, TreeLoadProgressEvent(count=count, total=total,
+                                                 done=done,
+                                                 updated=list(updated)))
 
 
 class MFTTreeCtrl(wx.TreeCtrl):
@@ -268,59 +455,86 @@ class MFTTreeCtrl(wx.TreeCtrl):
 
         self.SetImageList(self.il)
 
-        dialog = wx.ProgressDialog('Loading MFT', '0.00% Complete',
-                                   maximum=100.0,
-                                   style=wx.PD_AUTO_HIDE |
-                                       wx.PD_APP_MODAL |
-                                       wx.PD_CAN_ABORT |
-                                       wx.PD_ELAPSED_TIME |
-                                       wx.PD_ESTIMATED_TIME |
-                                       wx.PD_REMAINING_TIME)
-
-        def progress_update(count, total):
-            update_str = "%d / %d\n%0.2f%% Complete\n" % \
-                         (count, total, 100 * count / float(total))
-            (cont, skip) = dialog.Update(100 * count / float(total),
-                                         update_str)
-            if not cont:
-                sys.exit(0)
-        self._model.fetch(progress_fn=progress_update)
-        dialog.Update(100.0)
+        # rec_num -> tree item, for each item that has been displayed
+        self._items = {}
+        eventManager.Register(self._loaded_batch,
+                              EVT_TREE_LOAD_PROGRESS_EVENT,
+                              self._model)
+        self._model.start_loading()
+
+    def __del__(self, *args, **kwargs):
+        eventManager.DeregisterListener(self._loaded_batch)
+        eventManager.DeregisterDeadTopics()
+        super(MFTTreeCtrl, self).__del__(*args, **kwargs)
 
+    def _add_root(self):
         root = self._model.get_root()
         root_item = self.AddRoot(root.get_name(), self._folder_icon)
         self.SetPyData(root_item, {
             "rec_num": root._number,
             "has_expanded": False,
         })
-        if len(root.children) > 0:
+        self._items[root._number] = root_item
+        if self._model.has_children(root._number):
             self.SetItemHasChildren(root_item)
 
+    def _add_child(self, item, child_node):
+        if child_node.is_directory:
+            icon = self._folder_icon
+        else:
+            icon = self._file_icon
+        child_item = self.AppendItem(item, child_node.get_name())
+        self.SetItemImage(child_item, icon)
+        self.SetPyData(child_item, {
+            "rec_num": child_node._number,
+            "has_expanded": False,
+        })
+        self._items[child_node._number] = child_item
+        if self._model.has_children(child_node._number):
+            self.SetItemHasChildren(child_item)
+
+    def OnCompareItems(self, item1, item2):
+        """
+        Directories first, then files, each by name.
+        """
+        node1 = self._model.get_node(self.GetPyData(item1)["rec_num"])
+        node2 = self._model.get_node(self.GetPyData(item2)["rec_num"])
+        return cmp((not node1.is_directory, node1.get_name()),
+                   (not node2.is_directory, node2.get_name()))
+
+    def _loaded_batch(self, event):
+        """
+        Show the nodes that arrived in a batch under any item
+          that is already displayed.
+        """
+        if not self.GetRootItem().IsOk():
+            if not self._model.has_node(5):
+                return
+            self._add_root()
+        for rec_num in event.updated:
+            item = self._items.get(rec_num)
+            if item is None:
+                continue
+            node = self._model.get_node(rec_num)
+            if not self.GetPyData(item)["has_expanded"]:
+                if node.has_children():
+                    self.SetItemHasChildren(item)
+                continue
+            added = False
+            for child_node in node.children:
+                if child_node._number not in self._items:
+                    self._add_child(item, child_node)
+                    added = True
+            if added:
+                self.SortChildren(item)
+
     def _extend(self, item):
         if self.GetPyData(item)["has_expanded"]:
             return
 
         rec_num = self.GetPyData(item)["rec_num"]
-        node = self._model.get_node(rec_num)
-        for child_node in sorted([c for c in node.children if c.is_directory],
-                                 key=lambda x: x.get_name()):
-            child_item = self.AppendItem(item, child_node.get_name())
-            self.SetItemImage(child_item, self._folder_icon)
-            self.SetPyData(child_item, {
-                "rec_num": child_node._number,
-                "has_expanded": False,
-            })
-            if len(child_node.children) > 0:
-                self.SetItemHasChildren(child_item)
-        for child_node in sorted([c for c in node.children
-                                  if not c.is_directory],
-                                 key=lambda x: x.get_name()):
-            child_item = self.AppendItem(item, child_node.get_name())
-            self.SetItemImage(child_item, self._file_icon)
-            self.SetPyData(child_item, {
-                "rec_num": child_node._number,
-                "has_expanded": False,
-            })
+        for child_node in self._model.get_children(rec_num):
+            self._add_child(item, child_node)
         self.GetPyData(item)["has_expanded"] = True
 
     def OnExpandKey(self, event):
@@ -594,44 +808,59 @@ class RecordPane(scrolled.ScrolledPanel):
     def update(self, event):
         print "Warning: Unbound Record Pane update"
 
-ascii_byte = " !\"#\$%&\'\(\)\*\+,-\./0123456789:;<=>\?@ABCDEFGHIJKLMNOPQRSTUVWXYZ\[\]\^_`abcdefghijklmnopqrstuvwxyz\{\|\}\\\~"
 
+_strings_extractor = StringsExtractor()
 
-def ascii_strings(buf, n=4):
-    reg = "([%s]{%d,})" % (ascii_byte, n)
-    ascii_re = re.compile(reg)
-    for match in ascii_re.finditer(buf):
-        yield match.group().decode("ascii")
 
+def strings(buf):
+    for (_, _, string) in _strings_extractor.strings(buf):
+        yield string
 
-def unicode_strings(buf, n=4):
-    reg = b"((?:[%s]\x00){4,})" % (ascii_byte)
-    ascii_re = re.compile(reg)
-    for match in ascii_re.finditer(buf):
-        try:
-            yield match.group().decode("utf-16")
-        except UnicodeDecodeError:
-            print "unicode find error: " + str(match.group())
-            pass
 
+class HexListCtrl(wx.ListCtrl):
+    """
+    A virtual list that shows a hex dump of a buffer.
+    Rows are only formatted when they are drawn, so large buffers
+      display immediately.
+    """
+    ROW_LENGTH = 16
 
-def strings(buf):
-    for string in ascii_strings(buf):
-        yield string
-    for string in unicode_strings(buf):
-        yield string
+    def __init__(self, *args, **kwargs):
+        kwargs["style"] = kwargs.get("style", 0) | \
+            wx.LC_REPORT | wx.LC_VIRTUAL | wx.LC_HRULES
+        super(HexListCtrl, self).__init__(*args, **kwargs)
+        self._data = ""
+        self.SetFont(wx.Font(8, wx.SWISS, wx.NORMAL,
+                             wx.NORMAL, False, u'Courier'))
+        self.InsertColumn(0, "Offset", width=60)
+        self.InsertColumn(1, "Hex", width=380)
+        self.InsertColumn(2, "ASCII", width=140)
+
+    def update(self, data):
+        self._data = data
+        rows = (len(data) + self.ROW_LENGTH - 1) / self.ROW_LENGTH
+        self.SetItemCount(rows)
+        self.Refresh()
+
+    def OnGetItemText(self, item, col):
+        return _format_hex_row(self._data, item * self.ROW_LENGTH,
+                               self.ROW_LENGTH)[col]
 
 
 class DataPane(wx.Panel):
+    # strings found by the background extractor are shown in batches
+    #   of this many
+    STRINGS_BATCH_SIZE = 500
+
     def __init__(self, *args, **kwargs):
         super(DataPane, self).__init__(*args, **kwargs)
         self._data = ""
+        # incremented on each update, so stale extractors stop
+        self._generation = 0
 
         vsplitter = wx.SplitterWindow(self, -1)
         panel_left = wx.Panel(vsplitter, -1)
-        self._text = wx.TextCtrl(panel_left, -1, style=wx.TE_MULTILINE)
-        self._text.SetFont(wx.Font(8, wx.SWISS, wx.NORMAL,
-                                   wx.NORMAL, False, u'Courier'))
+        self._text = HexListCtrl(panel_left, -1)
         _expand_into(panel_left, self._text)
 
         panel_right = wx.Panel(vsplitter, -1)
@@ -648,19 +877,38 @@ class DataPane(wx.Panel):
 
     def update(self, data):
         self._data = data
-        hhex = unicode(_format_hex(data))
-        self._text.SetValue(hhex)
+        self._text.update(data)
 
-        strings_text = ""
-        strings_text += "ASCII\n"
-        strings_text += "----------------\n"
-        for string in ascii_strings(data):
-            strings_text += "%s\n" % (string)
-        strings_text += "\n\nUTF-16\n"
-        strings_text += "----------------\n"
-        for string in unicode_strings(data):
-            strings_text += "%s\n" % (string)
-        self._strings.SetValue(strings_text)
+        self._generation += 1
+        self._strings.SetValue("")
+        t = threading.Thread(target=self._extract_strings,
+                             args=(data, self._generation))
+        t.daemon = True
+        t.start()
+
+    def _extract_strings(self, data, generation):
+        """
+        Runs on a worker thread, and hands the strings to the UI in batches.
+        """
+        def lines():
+            for (offset, encoding, string) in \
+                    _strings_extractor.strings(data):
+                yield "%04X  %-6s  %s\n" % (offset, encoding, string)
+
+        batch = []
+        for line in lines():
+            if generation != self._generation:
+                return
+            batch.append(line)
+            if len(batch) >= self.STRINGS_BATCH_SIZE:
+                wx.CallAfter(self._append_strings, generation, "".join(batch))
+                batch = []
+        wx.CallAfter(self._append_strings, generation, "".join(batch))
+
+    def _append_strings(self, generation, text):
+        if generation != self._generation or not self:
+            return
+        self._strings.AppendText(text)
 
 
 class RecordHexPane(RecordPane):
@@ -1006,11 +1254,8 @@ class RecordDataPane(RecordPane):
                             sys.stderr.write("Error parsing runlist\n")
                             continue
                     elif len(attr.value()) > 0:
-                        value_view = wx.TextCtrl(self,
-                                                 style=wx.TE_MULTILINE)
-                        value_view.SetFont(wx.Font(8, wx.SWISS, wx.NORMAL,
-                                                 wx.NORMAL, False, u'Courier'))
-                        value_view.SetValue(unicode(_format_hex(attr.value())))
+                        value_view = HexListCtrl(self, -1)
+                        value_view.update(attr.value())
                         self._sizer.Add(value_view,
                                         self.EXPAND_VERTICALLY, wx.EXPAND)
                 except ZeroDivisionError:
@@ -1197,10 +1442,15 @@ class MFTRecordView(wx.Panel):
 
 
 class MFTFileView(wx.Panel):
-    def __init__(self, parent, filename):
+    def __init__(self, parent, filename, filetype="mft",
+                 volume_offset=None, cluster_size=None):
         super(MFTFileView, self).__init__(parent, -1, size=(950, 600))
         self._filename = filename
-        self._model = AppModel(filename, None)
+        self._model = AppModel(filename, None, filetype=filetype)
+        if volume_offset is not None:
+            self._model.set_volume_offset(volume_offset)
+        if cluster_size is not None:
+            self._model.set_cluster_size(cluster_size)
 
         vsplitter = wx.SplitterWindow(self, -1)
 
@@ -1218,26 +1468,34 @@ class MFTFileView(wx.Panel):
         self.Centre()
 
         self._tree.Bind(wx.EVT_TREE_SEL_CHANGED, self.OnFileSelected)
+        eventManager.Register(self._load_progress,
+                              EVT_TREE_LOAD_PROGRESS_EVENT,
+                              self._model)
 
     def __del__(self, *args, **kwargs):
+        self._model.stop_loading()
         self._tree.Unbind(wx.EVT_TREE_SEL_CHANGED)
+        eventManager.DeregisterListener(self._load_progress)
+        eventManager.DeregisterDeadTopics()
         super(MFTFileView, self).__del__(*args, **kwargs)
 
+    def _load_progress(self, event):
+        if self._model.is_lazy():
+            status = "Reading directories on demand"
+        elif event.done:
+            status = "Loaded %d MFT records" % (event.count)
+        else:
+            status = "Loading MFT: %d / %d records (%0.2f%%)" % \
+                     (event.count, event.total,
+                      100 * event.count / float(max(event.total, 1)))
+        self.GetTopLevelParent().SetStatusText(status)
+
     def OnFileSelected(self, event):
         item = event.GetItem()
         if not item.IsOk():
             item = self._tree.GetSelection()
         rec_num = self._tree.GetPyData(item)["rec_num"]
-
-        f = NTFSFile({
-            "filename": self._filename,
-            "filetype": "mft",
-            "offset": 0,
-            "clustersize": 4096,
-            "prefix": "C:",
-            "progress": False,
-        })
-
+        f = self._model.ntfsfile()
         try:
             self._model.set_record(f.mft_get_record(rec_num))
         except InvalidMFTRecordNumber as e:
@@ -1246,7 +1504,8 @@ class MFTFileView(wx.Panel):
 
 
 class MFTFileViewer(wx.Frame):
-    def __init__(self, parent, filename):
+    def __init__(self, parent, filename, filetype="mft",
+                 volume_offset=None, cluster_size=None):
         super(MFTFileViewer, self).__init__(parent, -1, "MFT File Viewer",
                                             size=(900, 600))
         self.CreateStatusBar()
@@ -1259,7 +1518,9 @@ class MFTFileViewer(wx.Frame):
         p = wx.Panel(self)
         self._nb = wx.Notebook(p)
 
-        view = MFTFileView(self._nb, filename)
+        view = MFTFileView(self._nb, filename, filetype=filetype,
+                           volume_offset=volume_offset,
+                           cluster_size=cluster_size)
         self._nb.AddPage(view, filename)
 
         _expand_into(p, self._nb)
@@ -1269,8 +1530,35 @@ class MFTFileViewer(wx.Frame):
         sys.exit(0)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='View the file system '
+                                     'described by an NTFS MFT.')
+    parser.add_argument('-t', action="store", metavar="type",
+                        nargs=1, dest="filetype", choices=["MFT", "image"],
+                        help="The type of the input file.  For an image, "
+                        "directories are read on demand from their "
+                        "INDX data, rather than by loading the whole MFT")
+    parser.add_argument('-o', action="store", metavar="offset",
+                        nargs=1, dest="offset", type=int,
+                        help="The offset of the partition in the image")
+    parser.add_argument('-c', action="store", metavar="size",
+                        nargs=1, dest="clustersize", type=int,
+                        help="The size of a cluster, in bytes")
+    parser.add_argument('filename', action="store",
+                        help="Input MFT or image file path")
+    results = parser.parse_args()
+
+    filetype = "mft"
+    if results.filetype and results.filetype[0] == "image":
+        filetype = "image"
+    offset = None
+    if results.offset:
+        offset = results.offset[0]
+    clustersize = None
+    if results.clustersize:
+        clustersize = results.clustersize[0]
+
     app = wx.App(False)
-    filename = sys.argv[1]
-    frame = MFTFileViewer(None, filename)
+    frame = MFTFileViewer(None, results.filename, filetype=filetype,
+                          volume_offset=offset, cluster_size=clustersize)
     frame.Show()
     app.MainLoop()
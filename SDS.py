@@ -18,6 +18,12 @@
 #   limitations under the License.
 #
 #   Version v.1.2
+import array
+import json
+import mmap
+import struct
+from collections import namedtuple
+
 from BinaryParser import Block
 from BinaryParser import Nestable
 from BinaryParser import ParseException
@@ -25,6 +31,10 @@ from BinaryParser import align
 from BinaryParser import read_byte
 from BinaryParser import read_word
 from BinaryParser import read_dword
+from BinaryParser import debug
+from BinaryParser import warning
+from MFT import DirectoryIndex
+from MFT import INDEX_ENTRY_FLAGS
 
 
 class NULL_OBJECT(object):
@@ -74,7 +84,7 @@ class SID_IDENTIFIER_AUTHORITY(Block, Nestable):
         return SID_IDENTIFIER_AUTHORITY.structure_size(self._buf, self.absolute_offset(0x0), None)
 
     def __str__(self):
-        return "%s" % (self.high_part() << 32 + self.low_part())
+        return "%d" % ((self.high_part() << 32) + self.low_part())
 
 
 class SID(Block, Nestable):
@@ -95,10 +105,7 @@ class SID(Block, Nestable):
         return self._off_sub_authorities + (self.sub_authority_count() * 4)
 
     def string(self):
-        ret = "S-%d-%s" % (self.revision(), self.identifier_authority())
-        for sub_auth in self.sub_authorities():
-            ret += "-%s" % (str(sub_auth))
-        return ret
+        return decode_sid(self._buf, self.offset())[0]
 
 
 class ACE_TYPES:
@@ -127,6 +134,9 @@ class ACE_TYPES:
     # This one is for WinNT/2k.
     ACCESS_MAX_MS_ACE_TYPE = 8
 
+    # Vista and later, in SACLs; laid out like SYSTEM_AUDIT_ACE_TYPE.
+    SYSTEM_MANDATORY_LABEL_ACE_TYPE = 0x11
+
 
 class ACE_FLAGS:
     """
@@ -267,6 +277,18 @@ class ObjectACE(ACE, Nestable):
     def __len__(self):
         return self.size()
 
+    def sid(self):
+        """
+        The SID follows the object type GUIDs that are present.
+        """
+        ofs = 0xC
+        if self.object_flags() & OBJECT_ACE_FLAGS.ACE_OBJECT_TYPE_PRESENT:
+            ofs += 16
+        if self.object_flags() & \
+           OBJECT_ACE_FLAGS.ACE_INHERITED_OBJECT_TYPE_PRESENT:
+            ofs += 16
+        return SID(self._buf, self.absolute_offset(ofs), self)
+
 
 class ACCESS_ALLOWED_OBJECT_ACE(ObjectACE):
     def __init__(self, buf, offset, parent):
@@ -366,16 +388,31 @@ class SECURITY_DESCRIPTOR_RELATIVE(Block, Nestable):
 
     @staticmethod
     def structure_size(buf, offset, parent):
-        return len(SECURITY_DESCRIPTOR_RELATIVE(buf, offset, parent))
-
-    def __len__(self):
+        """
+        Computed from the header and the size fields of the components,
+          without constructing them.
+        """
+        (control, owner_offset, group_offset,
+         sacl_offset, dacl_offset) = struct.unpack_from("<HIIII", buf,
+                                                        offset + 0x2)
         ret = 20
-        ret += len((self.owner() or null_object))
-        ret += len((self.group() or null_object))
-        ret += len((self.sacl() or null_object))
-        ret += len((self.dacl() or null_object))
+        if owner_offset != 0:
+            ret += SID.structure_size(buf, offset + owner_offset, None)
+        if group_offset != 0:
+            ret += SID.structure_size(buf, offset + group_offset, None)
+        if control & SECURITY_DESCRIPTOR_CONTROL.SE_SACL_PRESENT and \
+           sacl_offset > 0:
+            ret += ACL.structure_size(buf, offset + sacl_offset, None)
+        if control & SECURITY_DESCRIPTOR_CONTROL.SE_DACL_PRESENT and \
+           dacl_offset > 0:
+            ret += ACL.structure_size(buf, offset + dacl_offset, None)
         return ret
 
+    def __len__(self):
+        return SECURITY_DESCRIPTOR_RELATIVE.structure_size(self._buf,
+                                                           self.offset(),
+                                                           None)
+
     def owner(self):
         if self.owner_offset() != 0:
             return SID(self._buf, self.absolute_offset(self.owner_offset()), self)
@@ -414,7 +451,8 @@ class SDS_ENTRY(Block, Nestable):
         self.declare_field("dword", "security_id")
         self.declare_field("qword", "offset")
         self.declare_field("dword", "length")
-        self.declare_field(SECURITY_DESCRIPTOR_RELATIVE, "sid")
+        self.add_explicit_field(self.current_field_offset(),
+                                SECURITY_DESCRIPTOR_RELATIVE, "sid")
 
     @staticmethod
     def structure_size(buf, offset, parent):
@@ -423,6 +461,14 @@ class SDS_ENTRY(Block, Nestable):
     def __len__(self):
         return self.length()
 
+    def sid(self):
+        """
+        The security descriptor of the entry, which is only parsed
+          when it is asked for.
+        """
+        return SECURITY_DESCRIPTOR_RELATIVE(self._buf,
+                                            self.absolute_offset(0x14), self)
+
 
 class SDS(Block):
     def __init__(self, buf, offset, parent):
@@ -430,28 +476,781 @@ class SDS(Block):
         self.add_explicit_field(0, SDS, "sds_entries")
 
     def sds_entries(self):
-        ofs = 0
-        while len(self._buf) > self.offset() + ofs + 0x14:
-            s = SDS_ENTRY(self._buf, self.offset() + ofs, self)
-            if len(s) != 0:
-                yield s
-                ofs += len(s)
-                ofs = align(ofs, 0x10)
+        for (offset, _, _, _) in sds_entry_headers(self._buf, self.offset()):
+            yield SDS_ENTRY(self._buf, offset, self)
+
+
+def sds_entry_headers(buf, offset=0):
+    """
+    A generator that yields tuples (offset, hash, security ID, length)
+      for each entry of an $SDS stream.
+    Only the entry headers are read; see `decode_descriptor` to decode
+      the security descriptor that follows each header.
+    """
+    ofs = 0
+    end = len(buf)
+    while end > offset + ofs + SDS_ENTRY_HEADER.size:
+        (hash_, security_id, _, length) = \
+            SDS_ENTRY_HEADER.unpack_from(buf, offset + ofs)
+        if length != 0:
+            yield (offset + ofs, hash_, security_id, length)
+            ofs += length
+            ofs = align(ofs, 0x10)
+        else:
+            if ofs % 0x10000 == 0:
+                return
             else:
-                if ofs % 0x10000 == 0:
-                    return
+                ofs = align(ofs, 0x10000)
+
+
+# an entry of the $SII index:
+#   0x0   WORD   data offset
+#   0x2   WORD   data size
+#   0x4   DWORD  padding
+#   0x8   WORD   entry size
+#   0xA   WORD   key size
+#   0xC   WORD   flags
+#   0xE   WORD   padding
+#   0x10  DWORD  security ID (key)
+#   0x14  DWORD  hash
+#   0x18  DWORD  security ID
+#   0x1C  QWORD  offset of the SDS_ENTRY in $SDS
+#   0x24  DWORD  length of the SDS_ENTRY
+SII_ENTRY = struct.Struct("<HH4xHHH2xIIIQI")
+
+
+def sii_entries(buf):
+    """
+    A generator that yields tuples (security ID, hash, offset, length)
+      for each entry in the INDX records of a $SII index.
+    Arguments:
+    - `buf`: An array of bytes containing the INDEX_ALLOCATION
+        attribute of the $SII index.  Fixups are applied in place.
+    """
+    for (_, block) in DirectoryIndex(None, buf).blocks():
+        nh = block.node_header()
+        ofs = nh.offset() + nh.entry_list_start()
+        end = min(nh.offset() + nh.entry_list_end(), len(buf))
+        while ofs + SII_ENTRY.size <= end:
+            (_, _, size, _, flags, _, hash_, security_id,
+             sds_offset, sds_length) = SII_ENTRY.unpack_from(buf, ofs)
+            if flags & INDEX_ENTRY_FLAGS.INDEX_ENTRY_END or size == 0:
+                break
+            yield (security_id, hash_, sds_offset, sds_length)
+            ofs += size
+
+
+# An ACE, and a security descriptor, rendered once so that every file
+#   that refers to the descriptor can share them.
+# `dacl` and `sacl` are tuples of RenderedACE, or None if not present
+#   or NULL.  A NULL DACL grants everyone full access, while an empty
+#   DACL grants nothing.
+RenderedACE = namedtuple("RenderedACE", [
+    "ace_type", "ace_flags", "access_mask", "sid"])
+RenderedDescriptor = namedtuple("RenderedDescriptor", [
+    "owner", "group", "control", "dacl", "sacl", "sddl"])
+
+_SDDL_ACE_TYPES = {
+    ACE_TYPES.ACCESS_ALLOWED_ACE_TYPE: "A",
+    ACE_TYPES.ACCESS_DENIED_ACE_TYPE: "D",
+    ACE_TYPES.SYSTEM_AUDIT_ACE_TYPE: "AU",
+    ACE_TYPES.SYSTEM_ALARM_ACE_TYPE: "AL",
+    ACE_TYPES.ACCESS_ALLOWED_OBJECT_ACE_TYPE: "OA",
+    ACE_TYPES.ACCESS_DENIED_OBJECT_ACE_TYPE: "OD",
+    ACE_TYPES.SYSTEM_AUDIT_OBJECT_ACE_TYPE: "OU",
+    ACE_TYPES.SYSTEM_ALARM_OBJECT_ACE_TYPE: "OL",
+    ACE_TYPES.SYSTEM_MANDATORY_LABEL_ACE_TYPE: "ML",
+}
+
+_SDDL_ACE_FLAGS = [
+    (ACE_FLAGS.OBJECT_INHERIT_ACE, "OI"),
+    (ACE_FLAGS.CONTAINER_INHERIT_ACE, "CI"),
+    (ACE_FLAGS.NO_PROPAGATE_INHERIT_ACE, "NP"),
+    (ACE_FLAGS.INHERIT_ONLY_ACE, "IO"),
+    (ACE_FLAGS.INHERITED_ACE, "ID"),
+    (ACE_FLAGS.SUCCESSFUL_ACCESS_ACE_FLAG, "SA"),
+    (ACE_FLAGS.FAILED_ACCESS_ACE_FLAG, "FA"),
+]
+
+
+# the header of an SDS_ENTRY: hash, security ID, offset, length
+SDS_ENTRY_HEADER = struct.Struct("<IIQI")
+# the identifier authority of a SID is a big endian 48 bit number
+_SID_HEADER = struct.Struct(">BBHI")
+_SUB_AUTHORITIES = {}  # count -> struct.Struct
+# a volume has few distinct SIDs, so their strings are shared
+_SID_STRINGS = {}  # SID bytes -> SID string
+_SID_STRINGS_LIMIT = 0x10000
+_ACL_HEADER = struct.Struct("<BBHHH")
+_ACE_HEADER = struct.Struct("<BBHI")
+_DESCRIPTOR_HEADER = struct.Struct("<BBHIIII")
+
+
+def decode_sid(buf, offset):
+    """
+    Returns the tuple (SID string, length) of the SID at the offset,
+      decoded without a Block.
+    The sub-authorities are unpacked with one struct, and the string
+      of each distinct SID is only built once.
+    """
+    (revision, count, high, low) = _SID_HEADER.unpack_from(buf, offset)
+    length = 8 + 4 * count
+    key = buffer(buf, offset, length)[:]
+    try:
+        return (_SID_STRINGS[key], length)
+    except KeyError:
+        pass
+    if len(key) != length:
+        raise ParseException("SID overruns the buffer")
+    try:
+        sub_authorities = _SUB_AUTHORITIES[count]
+    except KeyError:
+        sub_authorities = struct.Struct("<%dI" % (count))
+        _SUB_AUTHORITIES[count] = sub_authorities
+    parts = ["S", str(revision), str((high << 32) + low)]
+    parts.extend(map(str, sub_authorities.unpack_from(buf, offset + 8)))
+    ret = intern("-".join(parts))
+    if len(_SID_STRINGS) >= _SID_STRINGS_LIMIT:
+        _SID_STRINGS.clear()
+    _SID_STRINGS[key] = ret
+    return (ret, length)
+
+
+def decode_acl(buf, offset):
+    """
+    Returns a tuple of RenderedACE for each ACE of the ACL at the offset,
+      decoded without a Block.
+    The SID of an ACE of an unknown type is None; the ACE is skipped
+      using its size.
+    """
+    (_, _, _, count, _) = _ACL_HEADER.unpack_from(buf, offset)
+    ofs = offset + _ACL_HEADER.size
+    aces = []
+    for _ in range(count):
+        (ace_type, ace_flags, size, access_mask) = \
+            _ACE_HEADER.unpack_from(buf, ofs)
+        if ace_type <= ACE_TYPES.SYSTEM_ALARM_ACE_TYPE or \
+           ace_type == ACE_TYPES.SYSTEM_MANDATORY_LABEL_ACE_TYPE:
+            sid = decode_sid(buf, ofs + 0x8)[0]
+        elif ACE_TYPES.ACCESS_MIN_MS_OBJECT_ACE_TYPE <= ace_type <= \
+                ACE_TYPES.ACCESS_MAX_MS_OBJECT_ACE_TYPE:
+            object_flags = read_dword(buf, ofs + 0x8)
+            sid_offset = ofs + 0xC
+            if object_flags & OBJECT_ACE_FLAGS.ACE_OBJECT_TYPE_PRESENT:
+                sid_offset += 16
+            if object_flags & \
+               OBJECT_ACE_FLAGS.ACE_INHERITED_OBJECT_TYPE_PRESENT:
+                sid_offset += 16
+            sid = decode_sid(buf, sid_offset)[0]
+        else:
+            debug("Unknown ACE type %s at %s" % (hex(ace_type), hex(ofs)))
+            sid = None
+        aces.append(RenderedACE(ace_type, ace_flags, access_mask, sid))
+        if size == 0:
+            break
+        ofs = align(ofs + size, 4)
+    return tuple(aces)
+
+
+def _sddl_ace_type(ace):
+    return _SDDL_ACE_TYPES.get(ace.ace_type, "0x%x" % (ace.ace_type))
+
+
+def _sddl_ace_flags(ace):
+    return "".join([f for (mask, f) in _SDDL_ACE_FLAGS
+                    if ace.ace_flags & mask])
+
+
+def sddl_aces(aces):
+    """
+    Returns the SDDL style string of a tuple of RenderedACE.
+    The SID of an ACE of an unknown type is left empty.
+    """
+    ret = ""
+    for ace in aces:
+        ret += "(%s;%s;0x%x;;;%s)" % (_sddl_ace_type(ace),
+                                      _sddl_ace_flags(ace),
+                                      ace.access_mask, ace.sid or "")
+    return ret
+
+
+def _sddl_acl(prefix, aces, flags):
+    if aces is None:
+        return prefix + ":" + flags + "NO_ACCESS_CONTROL"
+    return prefix + ":" + flags + sddl_aces(aces)
+
+
+def render_descriptor(sd):
+    """
+    Returns a RenderedDescriptor for a SECURITY_DESCRIPTOR_RELATIVE.
+    """
+    return decode_descriptor(sd._buf, sd.offset())
+
+
+def decode_descriptor(buf, offset):
+    """
+    Returns a RenderedDescriptor for the SECURITY_DESCRIPTOR_RELATIVE
+      at the offset, decoded without a Block.
+    The `sddl` field is in the style of the Security Descriptor Definition
+      Language, with access masks in hex rather than as rights strings.
+    """
+    (_, _, control, owner_offset, group_offset,
+     sacl_offset, dacl_offset) = _DESCRIPTOR_HEADER.unpack_from(buf, offset)
+    owner = None
+    if owner_offset != 0:
+        owner = decode_sid(buf, offset + owner_offset)[0]
+    group = None
+    if group_offset != 0:
+        group = decode_sid(buf, offset + group_offset)[0]
+    dacl_present = control & SECURITY_DESCRIPTOR_CONTROL.SE_DACL_PRESENT
+    dacl = None
+    if dacl_present and dacl_offset > 0:
+        dacl = decode_acl(buf, offset + dacl_offset)
+    sacl_present = control & SECURITY_DESCRIPTOR_CONTROL.SE_SACL_PRESENT
+    sacl = None
+    if sacl_present and sacl_offset > 0:
+        sacl = decode_acl(buf, offset + sacl_offset)
+
+    sddl = ""
+    if owner is not None:
+        sddl += "O:" + owner
+    if group is not None:
+        sddl += "G:" + group
+    if dacl_present:
+        flags = ""
+        if control & SECURITY_DESCRIPTOR_CONTROL.SE_DACL_PROTECTED:
+            flags += "P"
+        if control & SECURITY_DESCRIPTOR_CONTROL.SE_DACL_AUTO_INHERITED:
+            flags += "AI"
+        sddl += _sddl_acl("D", dacl, flags)
+    if sacl_present:
+        flags = ""
+        if control & SECURITY_DESCRIPTOR_CONTROL.SE_SACL_PROTECTED:
+            flags += "P"
+        if control & SECURITY_DESCRIPTOR_CONTROL.SE_SACL_AUTO_INHERITED:
+            flags += "AI"
+        sddl += _sddl_acl("S", sacl, flags)
+    return RenderedDescriptor(owner, group, control, dacl, sacl, sddl)
+
+
+class SecurityDescriptorIndex(object):
+    """
+    Finds the security descriptor of a security ID.
+    $SII is parsed once into a table of security ID to the offset
+      and length of its entry in $SDS, so each lookup is one
+      SDS_ENTRY parse, rather than a walk of the $SDS stream.
+    Descriptors are rendered once per security ID.  They are also cached
+      by their hash and bytes in `shared`, which may be passed to the
+      index of another volume so that common descriptors are only
+      rendered once across volumes.
+    """
+    def __init__(self, sii_buf, sds_buf, shared=None):
+        """
+        Arguments:
+        - `sii_buf`: An array of bytes containing the $SII index records.
+        - `sds_buf`: A string, mmap, or array containing the $SDS stream.
+        - `shared`: An optional dict of (hash, descriptor bytes)
+            to RenderedDescriptor.
+        """
+        super(SecurityDescriptorIndex, self).__init__()
+        self._sds = sds_buf
+        self._rendered = {}  # security ID -> RenderedDescriptor or None
+        if shared is None:
+            shared = {}
+        self._shared = shared
+        self._offsets = {}  # security ID -> (offset, length)
+        for (security_id, _, offset, length) in sii_entries(sii_buf):
+            self._offsets[security_id] = (offset, length)
+        debug("Indexed %d security descriptors" % (len(self._offsets)))
+        self._file = None
+
+    @staticmethod
+    def open(sii_path, sds_path, shared=None):
+        """
+        Build the index from an extracted $SII INDEX_ALLOCATION file
+          and an extracted $SDS stream, which is mapped rather than read.
+        """
+        with open(sii_path, "rb") as f:
+            sii_buf = array.array("B", f.read())
+        f = open(sds_path, "rb")
+        sds_buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        ret = SecurityDescriptorIndex(sii_buf, sds_buf, shared)
+        ret._file = f
+        return ret
+
+    def close(self):
+        if self._file is not None:
+            self._sds.close()
+            self._file.close()
+            self._file = None
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, security_id):
+        return security_id in self._offsets
+
+    def _entry_header(self, security_id):
+        """
+        Returns the tuple (offset, hash, length) of the $SDS entry of the
+          security ID, or None if it is not indexed, or the $SDS entry
+          at its offset doesn't match.
+        """
+        try:
+            (offset, length) = self._offsets[security_id]
+        except KeyError:
+            return None
+        if length < SDS_ENTRY_HEADER.size or \
+           offset + length > len(self._sds):
+            warning("$SDS entry for security ID %d is out of bounds" %
+                    (security_id))
+            return None
+        (hash_, entry_id, _, _) = SDS_ENTRY_HEADER.unpack_from(self._sds,
+                                                               offset)
+        if entry_id != security_id or \
+           not _sds_entry_intact(self._sds, offset, offset, len(self._sds)):
+            # fall back to the mirror copy of the entry
+            mirror = offset + SDS_BLOCK_SIZE
+            entry = _sds_entry_intact(self._sds, mirror, offset,
+                                      len(self._sds))
+            if entry is not None and entry[1] == security_id:
+                debug("Recovered $SDS entry at %s from its mirror" %
+                      (hex(offset)))
+                return (mirror, entry[0], entry[2])
+        if entry_id != security_id:
+            warning("$SDS entry at %s has security ID %d, expected %d" %
+                    (hex(offset), entry_id, security_id))
+            return None
+        return (offset, hash_, length)
+
+    def entry(self, security_id):
+        """
+        Returns the SDS_ENTRY for the security ID, or None if it is
+          not indexed, or the $SDS entry at its offset doesn't match.
+        """
+        header = self._entry_header(security_id)
+        if header is None:
+            return None
+        try:
+            return SDS_ENTRY(self._sds, header[0], None)
+        except (ParseException, struct.error):
+            warning("Failed to parse $SDS entry for security ID %d" %
+                    (security_id))
+            return None
+
+    def descriptor(self, security_id):
+        """
+        Returns the RenderedDescriptor of the security ID, or None.
+        """
+        try:
+            return self._rendered[security_id]
+        except KeyError:
+            pass
+        ret = None
+        header = self._entry_header(security_id)
+        if header is not None:
+            (offset, hash_, length) = header
+            start = offset + SDS_ENTRY_HEADER.size
+            key = (hash_, buffer(self._sds, start, length -
+                                 SDS_ENTRY_HEADER.size)[:])
+            ret = self._shared.get(key)
+            if ret is None:
+                try:
+                    ret = decode_descriptor(self._sds, start)
+                    self._shared[key] = ret
+                except (ParseException, struct.error):
+                    warning("Failed to parse $SDS entry "
+                            "for security ID %d" % (security_id))
+        self._rendered[security_id] = ret
+        return ret
+
+    def owner(self, security_id):
+        """
+        Returns the owner SID string of the security ID, or None.
+        """
+        d = self.descriptor(security_id)
+        if d is None:
+            return None
+        return d.owner
+
+
+# access masks that the generic rights map to, for files
+FILE_GENERIC_MAPPING = [
+    (ACCESS_MASK.GENERIC_READ, 0x00120089),
+    (ACCESS_MASK.GENERIC_WRITE, 0x00120116),
+    (ACCESS_MASK.GENERIC_EXECUTE, 0x001200A0),
+    (ACCESS_MASK.GENERIC_ALL, 0x001F01FF),
+]
+
+# SIDs that every logged on user holds
+WELL_KNOWN_USER_SIDS = [
+    "S-1-1-0",   # Everyone
+    "S-1-5-11",  # Authenticated Users
+]
+
+
+def map_generic_rights(mask):
+    """
+    Returns the access mask with its generic rights replaced by the
+      specific rights they map to for files.
+    """
+    for (generic, specific) in FILE_GENERIC_MAPPING:
+        if mask & generic:
+            mask = (mask & ~generic) | specific
+    return mask
+
+
+class AccessEvaluator(object):
+    """
+    Evaluates the access that a set of SIDs is granted to an object
+      by its security descriptor, in the way that Windows does:
+      the ACEs of the DACL are considered in order, and rights that
+      an earlier ACE denied cannot be allowed by a later one, nor the
+      other way around.  Inherit-only ACEs do not apply to the object.
+    Results are cached by descriptor, so the cost is per distinct
+      descriptor, rather than per file.
+    """
+    _ALLOW = (ACE_TYPES.ACCESS_ALLOWED_ACE_TYPE,
+              ACE_TYPES.ACCESS_ALLOWED_OBJECT_ACE_TYPE)
+    _DENY = (ACE_TYPES.ACCESS_DENIED_ACE_TYPE,
+             ACE_TYPES.ACCESS_DENIED_OBJECT_ACE_TYPE)
+
+    def __init__(self, sids):
+        """
+        Arguments:
+        - `sids`: The SID strings held by the user, including groups.
+        """
+        super(AccessEvaluator, self).__init__()
+        self._sids = frozenset(sids)
+        self._granted = {}  # RenderedDescriptor -> access mask
+
+    def granted(self, descriptor):
+        """
+        Returns the access mask granted by the RenderedDescriptor.
+        """
+        try:
+            return self._granted[descriptor]
+        except KeyError:
+            pass
+        if descriptor.dacl is None:
+            # without a DACL, or with a NULL DACL, everyone has
+            #  full access
+            ret = map_generic_rights(ACCESS_MASK.GENERIC_ALL)
+        else:
+            allowed = 0
+            denied = 0
+            for ace in descriptor.dacl:
+                if ace.ace_flags & ACE_FLAGS.INHERIT_ONLY_ACE or \
+                   ace.sid not in self._sids:
+                    continue
+                mask = map_generic_rights(ace.access_mask)
+                if ace.ace_type in self._ALLOW:
+                    allowed |= mask & ~denied
+                elif ace.ace_type in self._DENY:
+                    denied |= mask & ~allowed
+            ret = allowed
+        if descriptor.owner in self._sids:
+            # the owner may always read and change the DACL
+            ret |= ACCESS_MASK.READ_CONTROL | ACCESS_MASK.WRITE_DAC
+        self._granted[descriptor] = ret
+        return ret
+
+    def allows(self, descriptor, desired):
+        """
+        Returns True if all of the `desired` access is granted.
+        """
+        desired = map_generic_rights(desired)
+        return self.granted(descriptor) & desired == desired
+
+
+def security_hash(buf, offset, length):
+    """
+    Returns the hash NTFS stores for the security descriptor of the
+      given length at the offset: each DWORD is added to the running
+      hash rotated left by 3 bits.
+    """
+    ret = 0
+    for dword in struct.unpack_from("<%dI" % (length // 4), buf, offset):
+        ret = (dword + (((ret << 3) | (ret >> 29)) & 0xFFFFFFFF)) & 0xFFFFFFFF
+    return ret
+
+
+# $SDS is stored in blocks of this size, each followed by its mirror copy
+SDS_BLOCK_SIZE = 0x40000
+
+
+class SDS_MIRROR_STATUS:
+    OK = "ok"                            # both copies are the same
+    PRIMARY_CORRUPT = "primary corrupt"  # recovered from the mirror
+    MIRROR_CORRUPT = "mirror corrupt"    # the primary is intact
+    MISMATCH = "mismatch"                # both are intact, but differ
+    CORRUPT = "corrupt"                  # neither copy is intact
+
+
+# The result of comparing an $SDS entry with its mirror copy.
+# `recovered_offset` is the offset of the copy to use, or None.
+SDSMirrorResult = namedtuple("SDSMirrorResult", [
+    "offset", "security_id", "hash", "length", "status",
+    "recovered_offset"])
+
+
+def _sds_entry_header(buf, offset, expected_offset, end):
+    """
+    Returns the tuple (hash, security ID, length) of the $SDS entry at
+      `offset` if it is stored for `expected_offset` and fits before
+      `end`; otherwise, None.
+    """
+    if offset + SDS_ENTRY_HEADER.size > len(buf):
+        return None
+    (hash_, security_id, entry_offset, length) = \
+        SDS_ENTRY_HEADER.unpack_from(buf, offset)
+    if entry_offset != expected_offset or \
+       length < SDS_ENTRY_HEADER.size + _DESCRIPTOR_HEADER.size or \
+       expected_offset + length > end or \
+       offset + length > len(buf):
+        return None
+    return (hash_, security_id, length)
+
+
+def _sds_entry_intact(buf, offset, expected_offset, end):
+    """
+    Like `_sds_entry_header`, but also requires the descriptor
+      to match its hash.
+    """
+    header = _sds_entry_header(buf, offset, expected_offset, end)
+    if header is None:
+        return None
+    (hash_, _, length) = header
+    if security_hash(buf, offset + SDS_ENTRY_HEADER.size,
+                     length - SDS_ENTRY_HEADER.size) != hash_:
+        return None
+    return header
+
+
+def verify_sds(buf):
+    """
+    A generator that yields an SDSMirrorResult for each entry of an $SDS
+      stream, in one sequential pass.
+    Each block is compared with its mirror as a whole, and only the
+      entries of blocks that differ are checked against their hashes.
+    """
+    primary = 0
+    while primary < len(buf):
+        mirror = primary + SDS_BLOCK_SIZE
+        end = min(mirror, len(buf))
+        length = end - primary
+        same = buffer(buf, primary, length) == buffer(buf, mirror, length)
+
+        ofs = primary
+        while ofs + SDS_ENTRY_HEADER.size <= end:
+            (hash_, security_id, _, size) = \
+                SDS_ENTRY_HEADER.unpack_from(buf, ofs)
+            copy = ofs - primary + mirror
+            mirror_size = 0
+            if not same and copy + SDS_ENTRY_HEADER.size <= len(buf):
+                mirror_size = read_dword(buf, copy + 0x10)
+            if size == 0 and mirror_size == 0:
+                # the end of the entries in this part of the block
+                if (ofs - primary) % 0x10000 == 0:
+                    break
+                ofs = primary + align(ofs - primary, 0x10000)
+                continue
+
+            if same:
+                yield SDSMirrorResult(ofs, security_id, hash_, size,
+                                      SDS_MIRROR_STATUS.OK, ofs)
+                ofs = primary + align(ofs - primary + size, 0x10)
+                continue
+
+            primary_entry = _sds_entry_intact(buf, ofs, ofs, end)
+            mirror_entry = _sds_entry_intact(buf, copy, ofs, end)
+            if primary_entry and mirror_entry:
+                if buffer(buf, ofs, primary_entry[2]) == \
+                   buffer(buf, copy, primary_entry[2]):
+                    status = SDS_MIRROR_STATUS.OK
                 else:
-                    ofs = align(ofs, 0x10000)
+                    status = SDS_MIRROR_STATUS.MISMATCH
+                (entry, recovered) = (primary_entry, ofs)
+            elif primary_entry:
+                status = SDS_MIRROR_STATUS.MIRROR_CORRUPT
+                (entry, recovered) = (primary_entry, ofs)
+            elif mirror_entry:
+                status = SDS_MIRROR_STATUS.PRIMARY_CORRUPT
+                (entry, recovered) = (mirror_entry, copy)
+            else:
+                status = SDS_MIRROR_STATUS.CORRUPT
+                (entry, recovered) = (None, None)
+                header = _sds_entry_header(buf, ofs, ofs, end) or \
+                    _sds_entry_header(buf, copy, ofs, end)
+                if header is not None:
+                    entry = header
+            if entry is not None:
+                (hash_, security_id, size) = entry
+            yield SDSMirrorResult(ofs, security_id, hash_, size,
+                                  status, recovered)
+            if entry is not None:
+                ofs = primary + align(ofs - primary + size, 0x10)
+                continue
+
+            # the chain of entries is lost, so look for the next header
+            #   that is stored for its own offset
+            ofs += 0x10
+            while ofs + SDS_ENTRY_HEADER.size <= end and \
+                  _sds_entry_header(buf, ofs, ofs, end) is None and \
+                  _sds_entry_header(buf, ofs - primary + mirror,
+                                    ofs, end) is None:
+                ofs += 0x10
+        primary += 2 * SDS_BLOCK_SIZE
+
+
+def sds_descriptors(buf):
+    """
+    A generator that yields tuples (SDSMirrorResult, RenderedDescriptor)
+      for each entry of an $SDS stream that has an intact copy.
+    Mirror copies are not listed separately.
+    """
+    for r in verify_sds(buf):
+        if r.recovered_offset is None:
+            continue
+        try:
+            d = decode_descriptor(buf, r.recovered_offset +
+                                  SDS_ENTRY_HEADER.size)
+        except (ParseException, struct.error):
+            warning("Failed to parse $SDS entry at %s" % (hex(r.offset)))
+            continue
+        yield (r, d)
+
+
+def descriptor_matches(descriptor, sids):
+    """
+    Returns True if the owner, group, or any ACE of the descriptor
+      refers to one of the SIDs.
+    """
+    if descriptor.owner in sids or descriptor.group in sids:
+        return True
+    for acl in (descriptor.dacl, descriptor.sacl):
+        for ace in acl or ():
+            if ace.sid in sids:
+                return True
+    return False
+
+
+SDS_CSV_HEADER = "SECURITY ID,HASH,OFFSET,OWNER,GROUP,DACL,SACL\n"
+
+
+def _csv_aces(aces, present):
+    if aces is not None:
+        return sddl_aces(aces)
+    if present:
+        return "NO_ACCESS_CONTROL"
+    return ""
+
+
+def descriptor_csv(result, descriptor):
+    control = descriptor.control
+    dacl = _csv_aces(descriptor.dacl, control &
+                     SECURITY_DESCRIPTOR_CONTROL.SE_DACL_PRESENT)
+    sacl = _csv_aces(descriptor.sacl, control &
+                     SECURITY_DESCRIPTOR_CONTROL.SE_SACL_PRESENT)
+    return "%d,%s,%s,%s,%s,%s,%s\n" % (result.security_id, hex(result.hash),
+                                        hex(result.offset),
+                                        descriptor.owner or "",
+                                        descriptor.group or "", dacl, sacl)
+
+
+def _json_aces(aces):
+    if aces is None:
+        return None
+    return [{"type": _sddl_ace_type(ace),
+             "flags": _sddl_ace_flags(ace),
+             "access_mask": ace.access_mask,
+             "sid": ace.sid} for ace in aces]
+
+
+def descriptor_json(result, descriptor):
+    return json.dumps({"security_id": result.security_id,
+                       "hash": result.hash,
+                       "offset": result.offset,
+                       "owner": descriptor.owner,
+                       "group": descriptor.group,
+                       "dacl": _json_aces(descriptor.dacl),
+                       "sacl": _json_aces(descriptor.sacl)},
+                      sort_keys=True) + "\n"
 
 
 def main():
     import sys
-    import mmap
+    import argparse
     import contextlib
-
-    with open(sys.argv[1], 'r') as f:
+    import BinaryParser
+
+    parser = argparse.ArgumentParser(description='Parse the NTFS $SDS '
+                                     'security descriptor stream.')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('-c', action="store_true", dest="csv",
+                       help="Output CSV")
+    group.add_argument('-j', action="store_true", dest="json",
+                       help="Output JSON, one object per line")
+    group.add_argument('--verify', action="store_true", dest="verify",
+                       help="Compare each entry with its mirror copy, "
+                       "and list the entries that differ or are corrupt")
+    parser.add_argument('--sid', action="append", metavar="SID",
+                        dest="sids",
+                        help="Only list descriptors that refer to this SID "
+                        "as owner, group, or in an ACE; may be repeated")
+    parser.add_argument('--id', action="append", metavar="security_id",
+                        type=int, dest="ids",
+                        help="Only list descriptors with this security ID; "
+                        "may be repeated")
+    parser.add_argument('-v', action="store_true", dest="verbose",
+                        help="Print debugging information")
+    parser.add_argument('filename', action="store",
+                        help="Input $SDS file path")
+    results = parser.parse_args()
+    BinaryParser.verbose = results.verbose
+    ids = set(results.ids or [])
+    sids = set(results.sids or [])
+    if (ids or sids) and not (results.csv or results.json):
+        BinaryParser.error("Filters (--sid/--id) require "
+                           "CSV (-c) or JSON (-j) output")
+
+    with open(results.filename, 'r') as f:
         with contextlib.closing(mmap.mmap(f.fileno(), 0,
                                           access=mmap.ACCESS_READ)) as buf:
+            if results.verify:
+                counts = {}
+                for r in verify_sds(buf):
+                    counts[r.status] = counts.get(r.status, 0) + 1
+                    if r.status == SDS_MIRROR_STATUS.OK:
+                        continue
+                    recovered = ""
+                    if r.recovered_offset is not None:
+                        recovered = hex(r.recovered_offset)
+                    print "%s,%d,%s,%s" % (hex(r.offset), r.security_id,
+                                           r.status, recovered)
+                for (status, count) in sorted(counts.items()):
+                    print "# %s: %d" % (status, count)
+                return
+
+            if results.csv or results.json:
+                if results.csv:
+                    format_ = descriptor_csv
+                    sys.stdout.write(SDS_CSV_HEADER)
+                else:
+                    format_ = descriptor_json
+                pending = []
+                for (r, d) in sds_descriptors(buf):
+                    if ids and r.security_id not in ids:
+                        continue
+                    if sids and not descriptor_matches(d, sids):
+                        continue
+                    pending.append(format_(r, d))
+                    if len(pending) >= 1024:
+                        sys.stdout.write("".join(pending))
+                        pending = []
+                sys.stdout.write("".join(pending))
+                return
+
             s = SDS(buf, 0, None)
             print "SDS"
             for e in s.sds_entries():
@@ -0,0 +1,291 @@
+#!/usr/bin/python
+
+#    This file is part of INDXParse.
+#
+#   Copyright 2011-13 Will Ballenthin <william.ballenthin@mandiant.com>
+#                    while at Mandiant <http://www.mandiant.com>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#   Version v.1.2
+import re
+import struct
+from collections import namedtuple
+
+from BinaryParser import debug
+from BinaryParser import parse_filetime
+from MFT import MFTTreeStore
+
+
+class USN_REASON:
+    """
+    DWORD.
+    """
+    DATA_OVERWRITE = 0x00000001
+    DATA_EXTEND = 0x00000002
+    DATA_TRUNCATION = 0x00000004
+    NAMED_DATA_OVERWRITE = 0x00000010
+    NAMED_DATA_EXTEND = 0x00000020
+    NAMED_DATA_TRUNCATION = 0x00000040
+    FILE_CREATE = 0x00000100
+    FILE_DELETE = 0x00000200
+    EA_CHANGE = 0x00000400
+    SECURITY_CHANGE = 0x00000800
+    RENAME_OLD_NAME = 0x00001000
+    RENAME_NEW_NAME = 0x00002000
+    INDEXABLE_CHANGE = 0x00004000
+    BASIC_INFO_CHANGE = 0x00008000
+    HARD_LINK_CHANGE = 0x00010000
+    COMPRESSION_CHANGE = 0x00020000
+    ENCRYPTION_CHANGE = 0x00040000
+    OBJECT_ID_CHANGE = 0x00080000
+    REPARSE_POINT_CHANGE = 0x00100000
+    STREAM_CHANGE = 0x00200000
+    TRANSACTED_CHANGE = 0x00400000
+    INTEGRITY_CHANGE = 0x00800000
+    CLOSE = 0x80000000
+
+
+_REASON_NAMES = sorted([(v, k) for (k, v) in USN_REASON.__dict__.items()
+                        if not k.startswith("_")])
+
+
+def reason_string(reason):
+    """
+    Returns the names of the flags of a USN reason, joined by "|".
+    """
+    return "|".join([name for (mask, name) in _REASON_NAMES
+                     if reason & mask])
+
+
+# A change journal record decoded in one pass, without a Block.
+# `offset` is the offset of the record in the $J stream.
+# The file references of version 3 records are 128 bit numbers.
+# `timestamp` is a raw FILETIME.
+UsnRecord = namedtuple("UsnRecord", [
+    "offset", "length", "major_version", "minor_version",
+    "mft_reference", "parent_reference", "usn", "timestamp",
+    "reason", "source_info", "security_id", "file_attributes",
+    "filename"])
+
+_RECORD_HEADER = struct.Struct("<IHH")
+_V2_RECORD = struct.Struct("<QQqQIIIIHH")
+_V3_RECORD = struct.Struct("<QQQQqQIIIIHH")
+# records are padded to 8 bytes, and do not cross a page
+_MAX_RECORD_LENGTH = 0x1000
+_NONZERO = re.compile("[^\x00]")
+
+
+def decode_usn_record(buf, offset, base=0):
+    """
+    Returns the UsnRecord at the offset of the buffer, or None if there
+      is no valid version 2 or 3 record there.
+    Arguments:
+    - `buf`: A string.
+    - `offset`: The offset of the record in the buffer.
+    - `base`: The offset of the buffer in the $J stream.
+    """
+    if offset + _RECORD_HEADER.size > len(buf):
+        return None
+    (length, major, minor) = _RECORD_HEADER.unpack_from(buf, offset)
+    if major == 2:
+        fields = _V2_RECORD
+    elif major == 3:
+        fields = _V3_RECORD
+    else:
+        return None
+    header_length = _RECORD_HEADER.size + fields.size
+    if length < header_length or length % 8 != 0 or \
+       length > _MAX_RECORD_LENGTH or offset + length > len(buf):
+        return None
+    values = fields.unpack_from(buf, offset + _RECORD_HEADER.size)
+    if major == 2:
+        (ref, parent) = values[:2]
+        values = values[2:]
+    else:
+        ref = values[0] | (values[1] << 64)
+        parent = values[2] | (values[3] << 64)
+        values = values[4:]
+    (usn, timestamp, reason, source_info, security_id,
+     attributes, name_length, name_offset) = values
+    if name_offset < header_length or name_length % 2 != 0 or \
+       name_offset + name_length > length:
+        return None
+    start = offset + name_offset
+    try:
+        filename = buf[start:start + name_length].decode("utf-16le")
+    except UnicodeDecodeError:
+        return None
+    return UsnRecord(base + offset, length, major, minor, ref, parent, usn,
+                     timestamp, reason, source_info, security_id,
+                     attributes, filename)
+
+
+def usn_records(f, chunk_size=0x100000):
+    """
+    A generator that yields each UsnRecord of a $J stream, read from a
+      file object in chunks.
+    Most of a $J stream is zeros: the sparse range before the oldest
+      record, and the padding at the end of each page.  Runs of zeros
+      are skipped with a regular expression search, rather than one
+      record header at a time.
+    """
+    buf = ""
+    pos = 0  # offset of buf in the stream
+    i = 0
+    eof = False
+    while True:
+        if not eof and len(buf) - i < _MAX_RECORD_LENGTH:
+            parts = [buf[i:]]
+            pos += i
+            i = 0
+            # keep a whole record ahead, even with small chunks
+            size = len(parts[0])
+            while size < _MAX_RECORD_LENGTH:
+                data = f.read(chunk_size)
+                if not data:
+                    eof = True
+                    break
+                parts.append(data)
+                size += len(data)
+            buf = "".join(parts)
+        if i + _RECORD_HEADER.size > len(buf):
+            if eof:
+                return
+            continue
+        if buf[i:i + 4] == "\x00\x00\x00\x00":
+            m = _NONZERO.search(buf, i)
+            if m is None:
+                pos += len(buf)
+                buf = ""
+                i = 0
+                continue
+            # records start on 8 byte boundaries of the stream, and
+            #  this slot cannot hold one
+            i = max(i + 8, m.start() - (pos + m.start()) % 8)
+            continue
+        record = decode_usn_record(buf, i, pos)
+        if record is None:
+            debug("Invalid USN record at %s" % (hex(pos + i)))
+            i += 8
+            continue
+        yield record
+        i += record.length
+
+
+class UsnPathResolver(object):
+    """
+    Resolves the path of the file of a UsnRecord from the path of its
+      parent directory in an MFTTreeStore, and the filename in the record.
+    Paths of directories are cached, so each is built once.
+    """
+    def __init__(self, tree, root="\\."):
+        super(UsnPathResolver, self).__init__()
+        self._tree = tree
+        self._root = root
+        self._cache = {}
+
+    def path(self, record):
+        parent = record.parent_reference & 0xFFFFFFFFFFFF
+        sequence = (record.parent_reference >> 48) & 0xFFFF
+        if parent not in self._tree:
+            return "\\??\\" + record.filename
+        if self._tree.sequence_number(parent) != sequence:
+            return "\\$OrphanFiles\\" + record.filename
+        return self._tree.path(parent, self._cache, self._root) + \
+            "\\" + record.filename
+
+
+def load_tree(ntfsfile):
+    """
+    Returns an MFTTreeStore of the records of an NTFSFile.
+    """
+    tree = MFTTreeStore()
+    for record in ntfsfile.record_generator():
+        if record.magic() != 0x454C4946:
+            continue
+        tree.add_record(record.inode, record)
+    return tree
+
+
+def usn_csv(record, path):
+    try:
+        timestamp = parse_filetime(record.timestamp).isoformat()
+    except (ValueError, OverflowError):
+        timestamp = ""
+    return u"%d,%s,%s,%d,%d,%d,%d,0x%x,%s\n" % \
+        (record.usn, timestamp, reason_string(record.reason),
+         record.mft_reference & 0xFFFFFFFFFFFF,
+         (record.mft_reference >> 48) & 0xFFFF,
+         record.parent_reference & 0xFFFFFFFFFFFF,
+         (record.parent_reference >> 48) & 0xFFFF,
+         record.file_attributes, path)
+
+
+def main():
+    import sys
+    import argparse
+    import BinaryParser
+    from MFT import NTFSFile
+
+    parser = argparse.ArgumentParser(description='Parse the NTFS change '
+                                     'journal, $Extend\\$UsnJrnl:$J.')
+    parser.add_argument('-m', action="store", metavar="path",
+                        nargs=1, dest="mft",
+                        help="MFT or image used to resolve full paths")
+    parser.add_argument('-t', action="store", metavar="type",
+                        nargs=1, dest="filetype",
+                        choices=["image", "MFT"], default=["MFT"],
+                        help="The type of the file given with -m "
+                        "(image or MFT), default MFT")
+    parser.add_argument('-c', action="store", metavar="size",
+                        nargs=1, type=int, dest="clustersize",
+                        help="Use this cluster size in bytes "
+                        "(default 4096 bytes)")
+    parser.add_argument('-o', action="store", metavar="offset",
+                        nargs=1, type=int, dest="offset",
+                        help="Offset in bytes to volume in image "
+                        "(default 32256 bytes)")
+    parser.add_argument('-v', action="store_true", dest="verbose",
+                        help="Print debugging information")
+    parser.add_argument('filename', action="store",
+                        help="Input $J file path")
+    results = parser.parse_args()
+    BinaryParser.verbose = results.verbose
+
+    resolver = None
+    if results.mft:
+        f = NTFSFile({
+            "filename": results.mft[0],
+            "filetype": results.filetype[0].lower(),
+            "offset": results.offset[0] if results.offset else 32256,
+            "clustersize": results.clustersize[0] if results.clustersize
+            else 4096,
+            "prefix": None,
+            "progress": False,
+        })
+        resolver = UsnPathResolver(load_tree(f))
+
+    print "USN,TIMESTAMP,REASON,MFT RECORD,SEQUENCE,PARENT RECORD," \
+        "PARENT SEQUENCE,ATTRIBUTES,PATH"
+    with open(results.filename, "rb") as f:
+        for record in usn_records(f):
+            if resolver:
+                path = resolver.path(record)
+            else:
+                path = record.filename
+            sys.stdout.write(usn_csv(record, path).encode("utf-8"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/python
+import os
+import sys
+import struct
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from BinaryParser import CompactBlock
+from BinaryParser import OverrunBufferException
+from BinaryParser import compact_fields
+
+
+@compact_fields
+class Example(CompactBlock):
+    __slots__ = ()
+    FIELDS = [
+        ("dword", "magic", 0x0),
+        ("byte", "name_length", 0x4),
+        ("wstring", "name", 0x5, "name_length"),
+        ("binary", "tail", 0x5, 3),
+    ]
+
+
+class CompactBlockTest(unittest.TestCase):
+    def test_fields(self):
+        buf = "\x00\x00" + struct.pack("<IB", 0x454C4946, 3) + \
+            u"abc".encode("utf-16le")
+        block = Example(buf, 2)
+        self.assertEqual(block.magic(), 0x454C4946)
+        self.assertEqual(block.name_length(), 3)
+        self.assertEqual(block.name(), u"abc")
+        self.assertEqual(block.tail(), "a\x00b")
+        self.assertEqual(Example._off_name, 0x5)
+        self.assertEqual([f["name"] for f in Example._declared_fields],
+                         ["magic", "name_length", "name", "tail"])
+
+    def test_slots(self):
+        block = Example("\x00" * 8, 0)
+        self.assertFalse(hasattr(block, "__dict__"))
+        self.assertRaises(AttributeError, setattr, block, "extra", 1)
+
+    def test_lazy_overrun(self):
+        # nothing is read until a field is accessed
+        block = Example("\x01\x02", 0)
+        self.assertRaises(OverrunBufferException, block.magic)
+        self.assertRaises(OverrunBufferException, block.name_length)
+
+
+if __name__ == "__main__":
+    unittest.main()
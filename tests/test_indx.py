@@ -0,0 +1,154 @@
+#!/usr/bin/python
+import os
+import sys
+import array
+import struct
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from BinaryParser import ParseException
+from MFT import DirectoryIndex
+from MFT import IndexRootHeader
+from MFT import decode_index_node
+from MFT import decode_index_slack
+from test_mft import apply_fixups
+from test_mft import filename_value
+
+
+def index_entry(name, ref=0, child_vcn=None):
+    key = filename_value(name)
+    length = (0x10 + len(key) + 7) // 8 * 8
+    flags = 0
+    if child_vcn is not None:
+        length += 8
+        flags |= 0x1
+    entry = struct.pack("<QHHI", ref, length, len(key), flags) + key
+    entry = entry.ljust(length, "\x00")
+    if child_vcn is not None:
+        entry = entry[:-8] + struct.pack("<Q", child_vcn)
+    return entry
+
+
+def end_entry(child_vcn=None):
+    if child_vcn is None:
+        return struct.pack("<QHHI", 0, 0x10, 0, 0x2)
+    return struct.pack("<QHHIQ", 0, 0x18, 0, 0x3, child_vcn)
+
+
+def node(entries, start, allocation=None):
+    """
+    Returns an index node header followed by its entries, where `start`
+      is the offset of the entries relative to the header.
+    """
+    body = "".join(entries)
+    if allocation is None:
+        allocation = start + len(body)
+    header = struct.pack("<IIII", start, start + len(body), allocation, 0)
+    return header.ljust(start, "\x00") + body
+
+
+def index_root(entries):
+    header = struct.pack("<IIIBBBB", 0x30, 1, 4096, 1, 0, 0, 0)
+    return IndexRootHeader(array.array("B", header + node(entries, 0x10)),
+                           0, False)
+
+
+def indx_record(vcn, entries, slack=""):
+    header = struct.pack("<IHHQQ", 0x58444E49, 0x28, 9, 0, vcn)
+    body = node(entries, 0x28, 4096 - 0x18) + slack
+    return apply_fixups((header + body).ljust(4096, "\x00"), usa_offset=0x28)
+
+
+class DirectoryIndexTest(unittest.TestCase):
+    def index(self):
+        root = index_root([index_entry(u"m", child_vcn=0), end_entry(1)])
+        # INDX records are found by their VCN, not their position
+        allocation = indx_record(2, [index_entry(u"old"), end_entry()]) + \
+            indx_record(1, [index_entry(u"x"), end_entry()]) + \
+            indx_record(0, [index_entry(u"a"), index_entry(u"c"),
+                            end_entry()])
+        return DirectoryIndex(root, array.array("B", allocation))
+
+    def test_collation_order(self):
+        names = [e.filename for e in self.index().entries()]
+        self.assertEqual(names, [u"a", u"c", u"m", u"x"])
+
+    def test_blocks(self):
+        self.assertEqual([vcn for (vcn, _) in self.index().blocks()],
+                         [0, 1, 2])
+
+    def test_unreferenced_blocks(self):
+        index = self.index()
+        self.assertEqual([vcn for (vcn, _) in index.unreferenced_blocks()],
+                         [2])
+        list(index.entries())
+        # the VCNs seen by `entries` are reused
+        index._walk = None
+        self.assertEqual([vcn for (vcn, _) in index.unreferenced_blocks()],
+                         [2])
+
+    def test_missing_and_repeated_subnodes(self):
+        root = index_root([index_entry(u"m", child_vcn=0),
+                           index_entry(u"p", child_vcn=7),
+                           end_entry(0)])
+        allocation = indx_record(0, [index_entry(u"a"), end_entry()])
+        index = DirectoryIndex(root, array.array("B", allocation))
+        self.assertEqual([e.filename for e in index.entries()],
+                         [u"a", u"m", u"p"])
+
+    def test_bad_fixups(self):
+        allocation = bytearray(indx_record(0, [index_entry(u"a"),
+                                               end_entry()]))
+        allocation[0x3FE] = 0x00
+        index = DirectoryIndex(None, array.array("B", str(allocation)))
+        self.assertEqual(index.blocks(), [])
+
+
+class DecodeIndexNodeTest(unittest.TestCase):
+    def test_entries(self):
+        buf = node([index_entry(u"one", ref=17 | (2 << 48)),
+                    index_entry(u"two", ref=18, child_vcn=3),
+                    end_entry(4)], 0x10)
+        entries = decode_index_node(buf, 0)
+        self.assertEqual([(e.filename, e.mft_reference, e.child_vcn)
+                          for e in entries],
+                         [(u"one", 17 | (2 << 48), None),
+                          (u"two", 18, 3),
+                          (None, 0, 4)])
+        self.assertEqual(entries[0].offset, 0x10)
+        self.assertEqual(entries[0].logical_size, 0)
+
+    def test_invalid_length(self):
+        entry = bytearray(index_entry(u"one"))
+        struct.pack_into("<H", entry, 0x8, 0x1000)
+        buf = node([str(entry), end_entry()], 0x10)
+        self.assertRaises(ParseException, decode_index_node, buf, 0)
+
+    def test_filename_overrun(self):
+        entry = bytearray(index_entry(u"one"))
+        entry[0x50] = 0x40
+        buf = node([str(entry), end_entry()], 0x10)
+        self.assertRaises(ParseException, decode_index_node, buf, 0)
+
+    def test_invalid_filename(self):
+        entry = bytearray(index_entry(u"one"))
+        entry[0x52:0x54] = "\x00\xd8"
+        buf = node([str(entry), end_entry()], 0x10)
+        self.assertRaises(ParseException, decode_index_node, buf, 0)
+
+    def test_truncated_header(self):
+        self.assertRaises(ParseException, decode_index_node, "\x10\x00", 0)
+
+    def test_slack(self):
+        live = [index_entry(u"live"), end_entry()]
+        deleted = index_entry(u"deleted", ref=20)
+        buf = node(live, 0x10, 0x10 + len("".join(live)) + len(deleted))
+        entries = decode_index_slack(buf + deleted, 0)
+        self.assertEqual([(e.offset, e.filename, e.mft_reference)
+                          for e in entries],
+                         [(len(buf), u"deleted", 20)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+import os
+import sys
+import struct
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from LogFile import LOG_OPERATION
+from LogFile import LogFile
+from LogFile import operation_name
+from LogFile import record_lsn
+
+
+PAGE_SIZE = 0x1000
+DATA_OFFSET = 0x40
+SEQ_NUMBER_BITS = 51
+
+
+def apply_fixups(page, usa_offset, usn=0x1234):
+    page = bytearray(page)
+    struct.pack_into("<H", page, usa_offset, usn)
+    for i in range(1, PAGE_SIZE // 512 + 1):
+        end = 512 * i - 2
+        page[usa_offset + 2 * i:usa_offset + 2 * i + 2] = page[end:end + 2]
+        struct.pack_into("<H", page, end, usn)
+    return page
+
+
+def lsn(offset, sequence=1):
+    return (sequence << (64 - SEQ_NUMBER_BITS)) | (offset >> 3)
+
+
+def client_data(redo_operation, undo_operation, redo, undo, vcn,
+                cluster_block_offset):
+    header = struct.Struct("<HHHHHHHHHHHHQ")
+    redo_offset = header.size + 8
+    undo_offset = redo_offset + (len(redo) + 7) // 8 * 8
+    data = header.pack(redo_operation, undo_operation, redo_offset,
+                       len(redo), undo_offset, len(undo), 0, 1, 0x38, 0x18,
+                       cluster_block_offset, 0, vcn)
+    data += struct.pack("<Q", 0x100 + vcn)
+    return data + redo.ljust(undo_offset - redo_offset, "\x00") + undo
+
+
+def build_logfile(records, pages=8):
+    """
+    Returns a $LogFile with the given (redo operation, undo operation,
+      redo data, undo data, vcn, cluster block offset) client records,
+      written from the first RCRD page on, and the list of their LSNs.
+    """
+    data = bytearray(pages * PAGE_SIZE)
+    restart = bytearray(PAGE_SIZE)
+    struct.pack_into("<IHHQIIHHH", restart, 0, 0x52545352, 0x1E, 9, 0,
+                     PAGE_SIZE, PAGE_SIZE, 0x30, 1, 1)
+    struct.pack_into("<QHHHHIHHQIHHI", restart, 0x30, 0, 1, 0xFFFF, 0, 0,
+                     SEQ_NUMBER_BITS, 0x40, 0x40, len(data), 0, 0x30,
+                     DATA_OFFSET, 0)
+    data[0:PAGE_SIZE] = apply_fixups(restart, 0x1E)
+    data[PAGE_SIZE:2 * PAGE_SIZE] = data[0:PAGE_SIZE]
+
+    lsns = []
+    pos = 4 * PAGE_SIZE + DATA_OFFSET
+    previous = 0
+    for (redo_operation, undo_operation, redo, undo, vcn, cbo) in records:
+        body = client_data(redo_operation, undo_operation, redo, undo,
+                           vcn, cbo)
+        this = lsn(pos)
+        blob = struct.pack("<QQQIIIIH6x", this, previous, 0, len(body),
+                           0, 1, 7, 0) + body
+        lsns.append(this)
+        previous = this
+        # records continue after the header of the next page
+        i = 0
+        while i < len(blob):
+            room = PAGE_SIZE - pos % PAGE_SIZE
+            data[pos:pos + min(room, len(blob) - i)] = blob[i:i + room]
+            pos += min(room, len(blob) - i)
+            i += room
+            if i < len(blob):
+                pos += DATA_OFFSET
+        pos = (pos + 7) // 8 * 8
+    for page in range(4, pages):
+        start = page * PAGE_SIZE
+        struct.pack_into("<IHHQIHHH", data, start, 0x44524352, 0x28, 9,
+                         lsns[-1], 0, 1, 1, 0)
+        data[start:start + PAGE_SIZE] = \
+            apply_fixups(data[start:start + PAGE_SIZE], 0x28)
+    return (str(data), lsns)
+
+
+class LogFileTest(unittest.TestCase):
+    def test_records(self):
+        (data, lsns) = build_logfile([
+            (LOG_OPERATION.InitializeFileRecordSegment,
+             LOG_OPERATION.DeallocateFileRecordSegment,
+             "FILE" + "\x11" * 60, "", 0x10, 0),
+            (LOG_OPERATION.UpdateResidentValue,
+             LOG_OPERATION.UpdateResidentValue, "A" * 16, "B" * 16, 0x10, 2),
+            (LOG_OPERATION.CommitTransaction, LOG_OPERATION.Noop,
+             "", "", 0, 0)])
+        log = LogFile(StringIO(data))
+        self.assertEqual(log.page_size, PAGE_SIZE)
+        self.assertEqual(log.seq_number_bits, SEQ_NUMBER_BITS)
+        records = list(log.records())
+        self.assertEqual([r.lsn for r in records], lsns)
+        self.assertEqual([r.previous_lsn for r in records], [0] + lsns[:-1])
+        self.assertEqual(records[0].redo_data, "FILE" + "\x11" * 60)
+        self.assertEqual(records[1].undo_data, "B" * 16)
+        self.assertEqual(records[1].lcns, (0x110,))
+        self.assertEqual(operation_name(records[2].redo_operation),
+                         "CommitTransaction")
+        self.assertEqual(log.mft_record_number(records[1], 4096), 65)
+        self.assertEqual(log.mft_record_number(records[1], 4096, 4096), 16)
+        self.assertEqual(log.target_offset(records[1], 4096),
+                         0x110 * 4096 + 2 * 512)
+
+    def test_multi_page_record(self):
+        (data, lsns) = build_logfile([
+            (LOG_OPERATION.Noop, LOG_OPERATION.Noop, "", "", 0, 0),
+            (LOG_OPERATION.UpdateResidentValue,
+             LOG_OPERATION.UpdateResidentValue, "E" * 6000, "F" * 1500,
+             0x10, 4),
+            (LOG_OPERATION.CommitTransaction, LOG_OPERATION.Noop,
+             "", "", 0, 0)])
+        for chunk_pages in (1, 2, 256):
+            log = LogFile(StringIO(data), chunk_pages=chunk_pages)
+            records = list(log.records())
+            self.assertEqual([r.lsn for r in records], lsns)
+            self.assertEqual(records[1].redo_data, "E" * 6000)
+            self.assertEqual(records[1].undo_data, "F" * 1500)
+
+    def test_lsn_offset(self):
+        (data, lsns) = build_logfile([
+            (LOG_OPERATION.Noop, LOG_OPERATION.Noop, "", "", 0, 0)])
+        log = LogFile(StringIO(data))
+        self.assertEqual(log.lsn_offset(lsns[0]), 4 * PAGE_SIZE + DATA_OFFSET)
+
+    def multi_page_log(self):
+        return build_logfile([
+            (LOG_OPERATION.Noop, LOG_OPERATION.Noop, "", "", 0, 0),
+            (LOG_OPERATION.UpdateResidentValue,
+             LOG_OPERATION.UpdateResidentValue, "E" * 6000, "F" * 1500,
+             0x10, 4),
+            (LOG_OPERATION.CommitTransaction, LOG_OPERATION.Noop,
+             "", "", 0, 0)])
+
+    def test_skipped_continuation_page(self):
+        (data, lsns) = self.multi_page_log()
+        data = bytearray(data)
+        # the record continues onto page 5, whose fixups are now invalid
+        data[6 * PAGE_SIZE - 2] ^= 0xFF
+        log = LogFile(StringIO(str(data)))
+        self.assertEqual([r.lsn for r in log.records()], lsns[:1])
+
+    def test_torn_record(self):
+        (data, lsns) = build_logfile([
+            (LOG_OPERATION.Noop, LOG_OPERATION.Noop, "", "", 0, 0),
+            (LOG_OPERATION.UpdateResidentValue,
+             LOG_OPERATION.UpdateResidentValue, "A" * 16, "B" * 16, 0x10, 2),
+            (LOG_OPERATION.CommitTransaction, LOG_OPERATION.Noop,
+             "", "", 0, 0)])
+        log = LogFile(StringIO(data))
+        data = bytearray(data)
+        # lcns_to_follow of the second record
+        struct.pack_into("<H", data, log.lsn_offset(lsns[1]) + 0x30 + 0xE,
+                         0x100)
+        log = LogFile(StringIO(str(data)))
+        self.assertEqual([r.lsn for r in log.records()],
+                         [lsns[0], lsns[2]])
+
+    def test_garbage_length(self):
+        (data, lsns) = build_logfile([
+            (LOG_OPERATION.Noop, LOG_OPERATION.Noop, "", "", 0, 0),
+            (LOG_OPERATION.CommitTransaction, LOG_OPERATION.Noop,
+             "", "", 0, 0)])
+        data = bytearray(data)
+        page = data[4 * PAGE_SIZE:5 * PAGE_SIZE]
+        data[6 * PAGE_SIZE:7 * PAGE_SIZE] = page
+        struct.pack_into("<I", data, 4 * PAGE_SIZE + DATA_OFFSET + 0x18,
+                         0x7FFFFFFF)
+        # without the restart page, LSNs can't be checked against offsets
+        data[0:2 * PAGE_SIZE] = "\x00" * (2 * PAGE_SIZE)
+        log = LogFile(StringIO(str(data)))
+        self.assertEqual(log.seq_number_bits, None)
+        self.assertEqual([r.lsn for r in log.records()], lsns)
+
+    def test_record_lsn(self):
+        f = StringIO("\x00" * 0x400 + "FILE" + "\x00" * 4 +
+                     struct.pack("<Q", 0x1234) + "INDX" + "\x00" * 12)
+        cache = {}
+        self.assertEqual(record_lsn(f, 0x400, "FILE", cache), 0x1234)
+        self.assertEqual(record_lsn(f, 0x400, "INDX", {}), None)
+        self.assertEqual(record_lsn(f, 0x410, "INDX", {}), 0)
+        self.assertEqual(record_lsn(f, 0x800, "FILE", {}), None)
+        self.assertEqual(cache, {0x400: 0x1234})
+
+
+if __name__ == "__main__":
+    unittest.main()
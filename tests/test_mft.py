@@ -0,0 +1,339 @@
+#!/usr/bin/python
+import os
+import sys
+import shutil
+import struct
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from MFT import INDXException
+from MFT import MFTTreeStore
+from MFT import NTFSFile
+
+
+CLUSTER_SIZE = 4096
+MFT_CLUSTER = 4
+
+
+def apply_fixups(buf, usa_offset=0x30, usn=0x1234):
+    """
+    Moves the last word of each sector into the update sequence array,
+      and replaces it with the update sequence number.
+    """
+    buf = bytearray(buf)
+    count = len(buf) // 512 + 1
+    struct.pack_into("<H", buf, usa_offset, usn)
+    for i in range(1, count):
+        end = 512 * i - 2
+        buf[usa_offset + 2 * i:usa_offset + 2 * i + 2] = buf[end:end + 2]
+        struct.pack_into("<H", buf, end, usn)
+    return str(buf)
+
+
+def resident(attr_type, value, name=u""):
+    name = name.encode("utf-16le")
+    value_offset = (0x18 + len(name) + 7) // 8 * 8
+    length = (value_offset + len(value) + 7) // 8 * 8
+    header = struct.pack("<IIBBHHHIHBB", attr_type, length, 0,
+                         len(name) // 2, 0x18, 0, 0, len(value),
+                         value_offset, 0, 0)
+    return ((header + name).ljust(value_offset, "\x00") +
+            value).ljust(length, "\x00")
+
+
+def nonresident(attr_type, runs, data_size, initialized_size=None,
+                flags=0):
+    """
+    `runs` is a list of (cluster, count) tuples with small values, where
+      the cluster of a sparse run is None.
+    """
+    if initialized_size is None:
+        initialized_size = data_size
+    runlist = ""
+    last = 0
+    for (cluster, count) in runs:
+        if cluster is None:
+            runlist += struct.pack("<BB", 0x01, count)
+            continue
+        runlist += struct.pack("<BBh", 0x21, count, cluster - last)
+        last = cluster
+    runlist += "\x00"
+    clusters = sum(count for (_, count) in runs)
+    length = (0x40 + len(runlist) + 7) // 8 * 8
+    header = struct.pack("<IIBBHHHQQHB5xQQQ", attr_type, length, 1, 0, 0x40,
+                         flags, 0, 0, clusters - 1, 0x40, 0,
+                         clusters * CLUSTER_SIZE, data_size, initialized_size)
+    return (header + runlist).ljust(length, "\x00")
+
+
+def filename_value(name, parent=5, filename_type=1):
+    filetime = 130000000000000000
+    return struct.pack("<QQQQQQQIIBB", parent, filetime, filetime, filetime,
+                       filetime, 0, 0, 0, 0, len(name), filename_type) + \
+        name.encode("utf-16le")
+
+
+def mft_record(number, attributes=(), size=1024, flags=0x1):
+    body = "".join(attributes) + "\xff\xff\xff\xff"
+    usa_count = size // 512 + 1
+    attrs_offset = (0x30 + 2 * usa_count + 7) // 8 * 8
+    header = struct.pack("<IHHQHHHHIIQHHI", 0x454C4946, 0x30, usa_count, 0,
+                         1, 1, attrs_offset, flags, attrs_offset + len(body),
+                         size, 0, 0, 0, number)
+    record = header.ljust(attrs_offset, "\x00") + body
+    return apply_fixups(record.ljust(size, "\x00"))
+
+
+class Image(object):
+    """
+    A volume image, at offset zero, with its MFT at cluster 4.
+    """
+    def __init__(self, clusters=64, sector_size=512):
+        self.data = bytearray(clusters * CLUSTER_SIZE)
+        boot = bytearray(512)
+        boot[3:11] = "NTFS    "
+        struct.pack_into("<HB", boot, 0x0B, sector_size,
+                         CLUSTER_SIZE // sector_size)
+        struct.pack_into("<QQ", boot, 0x28,
+                         clusters * CLUSTER_SIZE // sector_size, MFT_CLUSTER)
+        self.data[0:512] = boot
+
+    def put(self, offset, data):
+        self.data[offset:offset + len(data)] = data
+
+    def put_record(self, number, record):
+        self.put(MFT_CLUSTER * CLUSTER_SIZE + number * 1024, record)
+
+    def ntfsfile(self, path):
+        with open(path, "wb") as f:
+            f.write(str(self.data))
+        return NTFSFile({"filename": path, "filetype": "image",
+                         "offset": 0, "clustersize": CLUSTER_SIZE,
+                         "prefix": None, "progress": False})
+
+
+class NTFSFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "image")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def bitmap_image(self, sector_size):
+        image = Image(clusters=64, sector_size=sector_size)
+        # the first 16 clusters are in use; $Bitmap has spare bits
+        bitmap = "\xff\xff" + "\x00" * 14
+        image.put(40 * CLUSTER_SIZE, bitmap)
+        image.put_record(6, mft_record(6, [nonresident(0x80, [(40, 1)],
+                                                       len(bitmap))]))
+        return image.ntfsfile(self.path)
+
+    def test_cluster_bitmap(self):
+        f = self.bitmap_image(512)
+        self.assertEqual(len(f.cluster_bitmap()), 64)
+        self.assertEqual(f.unallocated_extents(),
+                         [(16 * CLUSTER_SIZE, 48 * CLUSTER_SIZE)])
+
+    def test_cluster_bitmap_4kn(self):
+        f = self.bitmap_image(4096)
+        self.assertEqual(len(f.cluster_bitmap()), 64)
+
+    def carve_image(self):
+        image = Image(clusters=64)
+        base = 32 * CLUSTER_SIZE
+        image.put(base, mft_record(100, [resident(0x10, "\x00" * 0x48)]))
+        image.put(base + 0x1000,
+                  mft_record(101, [resident(0x10, "\x00" * 0x48)],
+                             size=4096))
+        torn = bytearray(mft_record(102, [resident(0x10, "\x00" * 0x48)]))
+        torn[0x3FE] = 0x00
+        image.put(base + 0x2000, torn)
+        image.put(base + 0x2600, mft_record(103, [resident(0x10,
+                                                           "\x00" * 0x48)]))
+        return (image.ntfsfile(self.path), [(base, 0x4000)])
+
+    def test_carve_records(self):
+        (f, extents) = self.carve_image()
+        carved = [(offset, record.mft_record_number(),
+                   record.bytes_allocated())
+                  for (offset, record) in f.carve_records(extents)]
+        self.assertEqual(carved, [(32 * CLUSTER_SIZE, 100, 1024),
+                                  (32 * CLUSTER_SIZE + 0x1000, 101, 4096)])
+
+    def test_carve_records_sector_aligned(self):
+        (f, extents) = self.carve_image()
+        carved = [record.mft_record_number()
+                  for (_, record) in f.carve_records(extents, alignment=512)]
+        self.assertEqual(carved, [100, 101, 103])
+
+    def data_image(self):
+        image = Image(clusters=64)
+        first = "".join(chr(i % 251) for i in range(2 * CLUSTER_SIZE))
+        second = "".join(chr(i % 241) for i in range(2 * CLUSTER_SIZE))
+        image.put(40 * CLUSTER_SIZE, first)
+        image.put(20 * CLUSTER_SIZE, second)
+        runs = [(40, 2), (None, 3), (20, 2)]
+        size = 7 * CLUSTER_SIZE - 100
+        initialized = 5 * CLUSTER_SIZE + 17
+        image.put_record(16, mft_record(16, [
+            nonresident(0x80, runs, size, initialized),
+            nonresident(0x80, runs, size, flags=0x4000)]))
+        expected = (first + "\x00" * (3 * CLUSTER_SIZE) + second)
+        expected = expected[:initialized].ljust(size, "\x00")
+        return (image.ntfsfile(self.path), expected)
+
+    def test_attribute_data(self):
+        (f, expected) = self.data_image()
+        attr = f.mft_get_record(16).data_attribute()
+        for chunk_size in (1000, CLUSTER_SIZE, 0x100000):
+            chunks = list(f.attribute_data(attr, chunk_size=chunk_size))
+            self.assertTrue(max(len(c) for c in chunks) <= chunk_size)
+            self.assertEqual("".join(chunks), expected)
+
+    def test_export_attributes(self):
+        (f, expected) = self.data_image()
+        attr = f.mft_get_record(16).data_attribute()
+        output = os.path.join(self.directory, "16")
+        f.export_attributes([(attr, output)])
+        with open(output, "rb") as g:
+            self.assertEqual(g.read(), expected)
+
+    def test_filename_information_truncated(self):
+        image = Image(clusters=64)
+        truncated = filename_value(u"truncated.txt")[:0x48]
+        image.put_record(16, mft_record(16, [
+            resident(0x30, truncated),
+            resident(0x30, filename_value(u"TRUNCA~1.TXT", filename_type=2))]))
+        fn = image.ntfsfile(self.path).mft_get_record(16).filename_information()
+        self.assertEqual(fn.filename(), u"TRUNCA~1.TXT")
+
+    def test_alternate_data_stream(self):
+        image = Image(clusters=64)
+        image.put_record(16, mft_record(16, [
+            resident(0x80, "unnamed"),
+            resident(0x80, "[ZoneTransfer]", name=u"Zone.Identifier")]))
+        f = image.ntfsfile(self.path)
+        record = f.mft_get_record(16)
+        self.assertEqual("".join(f.attribute_data(record.data_attribute())),
+                         "unnamed")
+        ads = record.data_attribute(u"Zone.Identifier")
+        self.assertEqual(ads.name(), u"Zone.Identifier")
+        self.assertEqual("".join(f.attribute_data(ads)), "[ZoneTransfer]")
+        self.assertEqual(record.data_attribute(u"missing"), None)
+        output = os.path.join(self.directory, "16")
+        f.export_attributes([(ads, output)])
+        with open(output, "rb") as g:
+            self.assertEqual(g.read(), "[ZoneTransfer]")
+
+    def test_export_reads(self):
+        (f, expected) = self.data_image()
+        attr = f.mft_get_record(16).data_attribute()
+        output = os.path.join(self.directory, "16")
+        reads = f.export_attribute(attr, output)
+        # the reads don't refer to the attribute, and skip the sparse run
+        self.assertEqual(sorted(reads),
+                         [(20 * CLUSTER_SIZE, 17, 5 * CLUSTER_SIZE, output),
+                          (40 * CLUSTER_SIZE, 2 * CLUSTER_SIZE, 0, output)])
+        f.export_reads(reads, chunk_size=1000)
+        with open(output, "rb") as g:
+            self.assertEqual(g.read(), expected)
+
+    def test_encrypted_data(self):
+        (f, _) = self.data_image()
+        attrs = list(f.mft_get_record(16).attributes())
+        self.assertRaises(INDXException, list, f.attribute_data(attrs[1]))
+        self.assertRaises(INDXException, f.export_attributes,
+                          [(attrs[1], os.path.join(self.directory, "x"))])
+
+
+class MFTTreeStoreTest(unittest.TestCase):
+    def tree(self):
+        tree = MFTTreeStore()
+        tree.add(5, u".", 5, True, 5, 5)
+        # children that arrive before their parent
+        tree.add(40, u"b.txt", 1, False, 30, 2)
+        tree.add(41, u"stale.txt", 1, False, 30, 1)
+        tree.add(30, u"dir", 2, True, 5, 5)
+        tree.add(31, u"a.txt", 1, False, 30, 2)
+        tree.add(50, u"lost.txt", 1, False, 60, 1)
+        return tree
+
+    def test_add(self):
+        tree = self.tree()
+        self.assertTrue(30 in tree)
+        self.assertFalse(32 in tree)
+        self.assertFalse(1000 in tree)
+        self.assertFalse(tree.add(30, u"again", 3, True, 5, 5))
+        self.assertEqual(tree.name(30), u"dir")
+        self.assertEqual(tree.sequence_number(30), 2)
+        self.assertTrue(tree.is_directory(30))
+        self.assertFalse(tree.is_directory(31))
+
+    def test_parent(self):
+        tree = self.tree()
+        self.assertEqual(tree.parent(40), 30)
+        self.assertEqual(tree.parent(31), 30)
+        self.assertEqual(tree.parent(30), 5)
+        self.assertEqual(tree.parent(5), -1)
+        # the parent has a different sequence number
+        self.assertEqual(tree.parent(41), -1)
+        self.assertEqual(sorted(tree.children(30)), [31, 40])
+        self.assertTrue(tree.has_children(30))
+        self.assertFalse(tree.has_children(31))
+        self.assertEqual(sorted(tree.orphans()), [5, 41, 50])
+
+    def test_path(self):
+        tree = self.tree()
+        cache = {}
+        self.assertEqual(tree.path(40, cache), u"\\.\\dir\\b.txt")
+        self.assertEqual(cache, {30: u"\\.\\dir"})
+        self.assertEqual(tree.path(31, cache, root="C:"), u"\\.\\dir\\a.txt")
+        self.assertEqual(tree.path(31, root="C:"), u"C:\\dir\\a.txt")
+        self.assertEqual(tree.path(41), u"\\$OrphanFiles\\stale.txt")
+        self.assertEqual(tree.path(5), u"\\.")
+
+    def test_path_cycle(self):
+        tree = MFTTreeStore()
+        tree.add(30, u"x", 1, True, 31, 1)
+        tree.add(31, u"y", 1, True, 30, 1)
+        self.assertEqual(tree.path(30), u"\\<CYCLE>\\y\\x")
+
+    def save(self, tree):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "tree")
+        with open(path, "wb") as f:
+            tree.save(f)
+        return path
+
+    def load(self, path, data=None):
+        if data is not None:
+            with open(path, "wb") as f:
+                f.write(data)
+        with open(path, "rb") as f:
+            return MFTTreeStore.load(f)
+
+    def test_save_load(self):
+        tree = self.tree()
+        loaded = self.load(self.save(tree))
+        self.assertEqual(len(loaded), len(tree))
+        for n in xrange(len(tree)):
+            self.assertEqual(n in loaded, n in tree)
+        self.assertEqual(loaded.path(40), u"\\.\\dir\\b.txt")
+        self.assertEqual(sorted(loaded.children(30)), [31, 40])
+        self.assertEqual(loaded.sequence_number(30), 2)
+        self.assertEqual(loaded.orphans(), tree.orphans())
+
+    def test_load_invalid(self):
+        path = self.save(self.tree())
+        with open(path, "rb") as f:
+            data = f.read()
+        for bad in ("not a tree", data[:20], data[:-2]):
+            self.assertRaises(INDXException, self.load, path, bad)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+import os
+import sys
+import shutil
+import struct
+import argparse
+import tempfile
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import MFTINDX
+from test_indx import end_entry
+from test_indx import index_entry
+from test_indx import indx_record
+from test_mft import Image
+from test_mft import filename_value
+from test_mft import mft_record
+from test_mft import resident
+
+
+def named_resident(attr_type, name, value):
+    """
+    Builds a resident attribute whose name is the given raw bytes.
+    """
+    header = struct.pack("<IIBBHHHIHBB", attr_type, 0, 0, len(name) // 2,
+                         0x18, 0, 0, len(value), 0x20, 0, 0)
+    attr = (header + name).ljust(0x20, "\x00") + value
+    attr = attr.ljust((len(attr) + 7) // 8 * 8, "\x00")
+    return attr[:4] + struct.pack("<I", len(attr)) + attr[8:]
+
+
+def options(path, **kwargs):
+    ret = argparse.Namespace(filename=path, filetype="image", offset=0,
+                             clustersize=4096, prefix=None, progress=False,
+                             latency=0, unallocated=False, indxlist=True,
+                             slack=False, sector_aligned=False, sii=None,
+                             sds=None)
+    for (key, value) in kwargs.items():
+        setattr(ret, key, value)
+    return ret
+
+
+class MFTINDXTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "image")
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.directory)
+
+    def output(self):
+        return sys.stdout.getvalue()
+
+    def test_sweep_large_clusters(self):
+        image = Image(clusters=64)
+        # the second INDX record of an 8192 byte cluster
+        image.put(41 * 4096, indx_record(0, [index_entry(u"swept.txt"),
+                                             end_entry()]))
+        with open(self.path, "wb") as f:
+            f.write(str(image.data))
+        for clustersize in (4096, 8192):
+            sys.stdout = StringIO()
+            MFTINDX.print_indx_sweep_bodyfile(options(self.path,
+                                                      clustersize=clustersize))
+            self.assertTrue("INDX@0x29000\\swept.txt (filename, INDX, "
+                            "carved)" in self.output())
+
+    def test_carve_bad_records(self):
+        image = Image(clusters=64)
+        si = resident(0x10, "\x00" * 0x48)
+        # an ADS whose name is not valid UTF-16
+        image.put(32 * 4096, mft_record(100, [
+            si, resident(0x30, filename_value(u"bad.txt")),
+            named_resident(0x80, "\x00\xd8", "data")]))
+        image.put(33 * 4096, mft_record(101, [
+            si, resident(0x30, filename_value(u"good.txt"))]))
+        with open(self.path, "wb") as f:
+            f.write(str(image.data))
+        MFTINDX.print_carved_records_bodyfile(options(self.path))
+        self.assertTrue("good.txt" in self.output())
+        self.assertFalse("bad.txt" in self.output())
+
+    def test_strings_bad_record(self):
+        si = resident(0x10, "\x00" * 0x48)
+        # an index root too short to hold its node header
+        bad = mft_record(0, [si, resident(0x30, filename_value(u"bad")),
+                             resident(0x90, "root", name=u"$I30")])
+        good = mft_record(1, [si, resident(0x30, filename_value(u"good"))])
+        good = good[:0x300] + "slackstring" + good[0x30B:]
+        with open(self.path, "wb") as f:
+            f.write(bad + good)
+        MFTINDX.print_strings(options(self.path, filetype="mft",
+                                      min_length=4))
+        self.assertTrue("slackstring" in self.output())
+
+
+if __name__ == "__main__":
+    unittest.main()
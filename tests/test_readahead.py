@@ -0,0 +1,126 @@
+#!/usr/bin/python
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from StringIO import StringIO
+
+from MFT import ExtentPlanner
+from MFT import LatentFile
+from MFT import ReadAheadPool
+from MFT import coalesce_extents
+from MFT import open_image
+
+
+class FailingFile(StringIO):
+    """
+    A file whose reads at the given offsets fail.
+    """
+    def __init__(self, data, bad_offsets):
+        StringIO.__init__(self, data)
+        self._bad_offsets = bad_offsets
+
+    def read(self, *args):
+        if self.tell() in self._bad_offsets:
+            raise IOError("bad sector")
+        return StringIO.read(self, *args)
+
+
+class ReadAheadTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "image")
+        self.data = "".join(chr(i % 251) for i in range(0x10000))
+        with open(self.path, "wb") as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_open_image(self):
+        with open_image(self.path) as f:
+            self.assertTrue(isinstance(f, file))
+        with open_image(self.path, 0.01) as f:
+            self.assertTrue(isinstance(f, LatentFile))
+            f.seek(0x100)
+            start = time.time()
+            self.assertEqual(f.read(0x10), self.data[0x100:0x110])
+            self.assertTrue(time.time() - start >= 0.01)
+            self.assertEqual(f.tell(), 0x110)
+
+    def test_pool(self):
+        pool = ReadAheadPool(self.path, workers=4, latency=0.001)
+        try:
+            for key in range(8):
+                pool.submit(key, [(0x1000 * key, 0x100), (0x10, 0x20)])
+            for key in reversed(range(8)):
+                self.assertEqual(pool.get(key).tostring(),
+                                 self.data[0x1000 * key:0x1000 * key + 0x100] +
+                                 self.data[0x10:0x30])
+        finally:
+            pool.close()
+
+    def test_pool_errors(self):
+        pool = ReadAheadPool(self.path, workers=2)
+        try:
+            pool.submit("bad seek", [(0, 0x10), (-1, 0x10)])
+            pool.submit("bad offset", [(None, 0x10)])
+            pool.submit("good", [(0x20, 0x10)])
+            self.assertRaises(IOError, pool.get, "bad seek")
+            self.assertRaises(TypeError, pool.get, "bad offset")
+            self.assertEqual(pool.get("good").tostring(),
+                             self.data[0x20:0x30])
+        finally:
+            pool.close()
+
+    def test_pool_missing_image(self):
+        self.assertRaises(IOError, ReadAheadPool,
+                          os.path.join(self.directory, "missing"))
+
+
+class ExtentPlannerTest(unittest.TestCase):
+    def test_coalesce_extents(self):
+        self.assertEqual(coalesce_extents([(0x300, 0x100), (0, 0x100),
+                                           (0x100, 0x80), (0x50, 0x10),
+                                           (0x400, 0), (0x380, 0x100)]),
+                         [(0, 0x180), (0x300, 0x180)])
+        self.assertEqual(coalesce_extents([]), [])
+
+    def planner(self):
+        planner = ExtentPlanner()
+        planner.add("a", [(0x300, 0x10), (0x0, 0x10)])
+        planner.add("b", [(0x8, 0x10)])
+        planner.add("c", [(0x1000, 0x20)])
+        return planner
+
+    def test_plan(self):
+        self.assertEqual(self.planner().plan(),
+                         [(0, 0x18), (0x300, 0x10), (0x1000, 0x20)])
+
+    def test_distribute(self):
+        data = "".join(chr(i % 251) for i in range(0x2000))
+        planner = self.planner()
+        reads = planner.plan()
+        datas = [data[offset:offset + length] for (offset, length) in reads]
+        buffers = planner.distribute(reads, datas)
+        self.assertEqual(buffers["a"].tostring(),
+                         data[0x300:0x310] + data[0:0x10])
+        self.assertEqual(buffers["b"].tostring(), data[0x8:0x18])
+        self.assertEqual(buffers["c"].tostring(), data[0x1000:0x1020])
+
+    def test_read_failure(self):
+        data = "".join(chr(i % 251) for i in range(0x2000))
+        buffers = self.planner().read(FailingFile(data, [0x300]))
+        # only the directory whose extent failed is left out
+        self.assertEqual(sorted(buffers.keys()), ["b", "c"])
+        self.assertEqual(buffers["b"].tostring(), data[0x8:0x18])
+        self.assertEqual(buffers["c"].tostring(), data[0x1000:0x1020])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,341 @@
+#!/usr/bin/python
+import os
+import sys
+import array
+import json
+import struct
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from SDS import ACCESS_MASK
+from SDS import ACE_FLAGS
+from SDS import ACE_TYPES
+from SDS import AccessEvaluator
+from SDS import SDS_BLOCK_SIZE
+from SDS import SDS_ENTRY_HEADER
+from SDS import SDS_MIRROR_STATUS
+from SDS import SecurityDescriptorIndex
+from SDS import WELL_KNOWN_USER_SIDS
+from SDS import decode_descriptor
+from SDS import decode_sid
+from SDS import descriptor_csv
+from SDS import descriptor_json
+from SDS import sds_descriptors
+from SDS import security_hash
+from SDS import verify_sds
+from test_indx import end_entry
+from test_indx import indx_record
+
+
+USER = "S-1-5-21-1-2-3-1001"
+ADMINS = "S-1-5-32-544"
+EVERYONE = "S-1-1-0"
+
+
+def sid(string):
+    parts = [int(p) for p in string.split("-")[1:]]
+    (revision, authority, subs) = (parts[0], parts[1], parts[2:])
+    return struct.pack("<BB", revision, len(subs)) + \
+        struct.pack(">HI", authority >> 32, authority & 0xFFFFFFFF) + \
+        struct.pack("<%dI" % (len(subs)), *subs)
+
+
+def ace(ace_type, flags, mask, sid_string):
+    body = struct.pack("<I", mask) + sid(sid_string)
+    return struct.pack("<BBH", ace_type, flags, 4 + len(body)) + body
+
+
+def unknown_ace(ace_type, mask, sid_string, data):
+    """
+    Builds an ACE of a type the decoder doesn't know, such as a callback
+      ACE, whose SID is followed by application data.
+    """
+    body = struct.pack("<I", mask) + sid(sid_string) + data
+    body = body.ljust((len(body) + 3) // 4 * 4, "\x00")
+    return struct.pack("<BBH", ace_type, 0, 4 + len(body)) + body
+
+
+def acl(aces):
+    body = "".join(aces)
+    return struct.pack("<BBHHH", 2, 0, 8 + len(body), len(aces), 0) + body
+
+
+def descriptor(control, owner=None, group=None, dacl=None, sacl=None):
+    """
+    Builds a self-relative security descriptor.  Pass an ACL string, or
+      "" for an ACL that is present with offset zero (NULL).
+    """
+    buf = ""
+    offsets = []
+    for part in (owner, group, sacl, dacl):
+        if not part:
+            offsets.append(0)
+            continue
+        offsets.append(0x14 + len(buf))
+        buf += part
+    return struct.pack("<BBHIIII", 1, 0, control, *offsets) + buf
+
+
+def sds_stream(descriptors):
+    """
+    Returns an $SDS stream of one block and its mirror, holding the given
+      descriptors with security IDs from 0x100, and their offsets.
+    """
+    block = bytearray(SDS_BLOCK_SIZE)
+    offsets = []
+    pos = 0
+    for (i, d) in enumerate(descriptors):
+        entry = SDS_ENTRY_HEADER.pack(security_hash(d, 0, len(d)), 0x100 + i,
+                                      pos, SDS_ENTRY_HEADER.size + len(d)) + d
+        block[pos:pos + len(entry)] = entry
+        offsets.append(pos)
+        pos += (len(entry) + 0xF) // 0x10 * 0x10
+    return (str(block + block), offsets)
+
+
+def sii_buffer(buf, offsets):
+    """
+    Returns the $SII INDX record that indexes the entries of an $SDS
+      stream at the given offsets.
+    """
+    entries = []
+    for offset in offsets:
+        (hash_, security_id, _, length) = \
+            SDS_ENTRY_HEADER.unpack_from(buf, offset)
+        entries.append(struct.pack("<HH4xHHH2xIIIQI", 0x14, 0x14, 0x28, 4,
+                                   0, security_id, hash_, security_id,
+                                   offset, length))
+    return array.array("B", indx_record(0, entries + [end_entry()]))
+
+
+SE_DACL_PRESENT = 0x0004
+SE_SACL_PRESENT = 0x0010
+SE_SELF_RELATIVE = 0x8000
+
+
+class DecodeDescriptorTest(unittest.TestCase):
+    def test_sid(self):
+        self.assertEqual(decode_sid(sid(USER), 0), (USER, 28))
+        self.assertEqual(decode_sid(sid(EVERYONE), 0), (EVERYONE, 12))
+
+    def test_dacl(self):
+        buf = descriptor(SE_SELF_RELATIVE | SE_DACL_PRESENT,
+                         owner=sid(USER), group=sid(ADMINS),
+                         dacl=acl([ace(ACE_TYPES.ACCESS_ALLOWED_ACE_TYPE,
+                                       0, 0x1F01FF, ADMINS)]))
+        d = decode_descriptor(buf, 0)
+        self.assertEqual(d.owner, USER)
+        self.assertEqual(d.group, ADMINS)
+        self.assertEqual(len(d.dacl), 1)
+        self.assertEqual(d.dacl[0].sid, ADMINS)
+        self.assertEqual(d.dacl[0].access_mask, 0x1F01FF)
+        self.assertEqual(d.sacl, None)
+        self.assertEqual(d.sddl, "O:%sG:%sD:(A;;0x1f01ff;;;%s)" %
+                         (USER, ADMINS, ADMINS))
+
+    def test_null_dacl(self):
+        buf = descriptor(SE_SELF_RELATIVE | SE_DACL_PRESENT, owner=sid(USER))
+        d = decode_descriptor(buf, 0)
+        self.assertEqual(d.dacl, None)
+        self.assertEqual(d.sddl, "O:%sD:NO_ACCESS_CONTROL" % (USER))
+
+    def test_empty_dacl(self):
+        buf = descriptor(SE_SELF_RELATIVE | SE_DACL_PRESENT, owner=sid(USER),
+                         dacl=acl([]))
+        d = decode_descriptor(buf, 0)
+        self.assertEqual(d.dacl, ())
+        self.assertEqual(d.sddl, "O:%sD:" % (USER))
+
+    def test_absent_dacl(self):
+        d = decode_descriptor(descriptor(SE_SELF_RELATIVE, owner=sid(USER)), 0)
+        self.assertEqual(d.dacl, None)
+        self.assertEqual(d.sddl, "O:%s" % (USER))
+
+    def test_sacl_unknown_ace_types(self):
+        high = "S-1-16-12288"
+        buf = descriptor(SE_SELF_RELATIVE | SE_DACL_PRESENT |
+                         SE_SACL_PRESENT, owner=sid(USER),
+                         dacl=acl([]),
+                         sacl=acl([
+                             ace(ACE_TYPES.SYSTEM_MANDATORY_LABEL_ACE_TYPE,
+                                 0, 0x1, high),
+                             unknown_ace(0x12, 0x0, EVERYONE, "attribute"),
+                             ace(ACE_TYPES.SYSTEM_AUDIT_ACE_TYPE,
+                                 ACE_FLAGS.FAILED_ACCESS_ACE_FLAG,
+                                 ACCESS_MASK.FILE_WRITE_DATA, EVERYONE)]))
+        d = decode_descriptor(buf, 0)
+        self.assertEqual(d.owner, USER)
+        self.assertEqual([(a.ace_type, a.sid) for a in d.sacl],
+                         [(0x11, high), (0x12, None),
+                          (ACE_TYPES.SYSTEM_AUDIT_ACE_TYPE, EVERYONE)])
+        self.assertTrue(d.sddl.startswith("O:%sD:S:(ML;;0x1;;;%s)" %
+                                          (USER, high)))
+
+
+class SDSStreamTest(unittest.TestCase):
+    def test_unknown_ace_type(self):
+        allowed = descriptor(SE_SELF_RELATIVE | SE_DACL_PRESENT,
+                             owner=sid(USER),
+                             dacl=acl([ace(ACE_TYPES.ACCESS_ALLOWED_ACE_TYPE,
+                                           0, 0x1F01FF, ADMINS)]))
+        callback = descriptor(SE_SELF_RELATIVE | SE_DACL_PRESENT,
+                              owner=sid(ADMINS),
+                              dacl=acl([unknown_ace(0x9, 0x1F01FF, USER,
+                                                    "callback")]))
+        (buf, _) = sds_stream([allowed, callback])
+        results = list(sds_descriptors(buf))
+        self.assertEqual([r.security_id for (r, _) in results],
+                         [0x100, 0x101])
+        (r, d) = results[1]
+        self.assertEqual(d.dacl[0].ace_type, 0x9)
+        self.assertEqual(d.sddl, "O:%sD:(0x9;;0x1f01ff;;;)" % (ADMINS))
+        self.assertEqual(descriptor_csv(r, d).split(",")[5],
+                         "(0x9;;0x1f01ff;;;)")
+        self.assertEqual(json.loads(descriptor_json(r, d))["dacl"],
+                         [{"type": "0x9", "flags": "",
+                           "access_mask": 0x1F01FF, "sid": None}])
+
+
+class SDSMirrorTest(unittest.TestCase):
+    def setUp(self):
+        self.descriptors = [
+            descriptor(SE_SELF_RELATIVE | SE_DACL_PRESENT, owner=sid(USER),
+                       dacl=acl([ace(ACE_TYPES.ACCESS_ALLOWED_ACE_TYPE,
+                                     0, 0x1F01FF, ADMINS)])),
+            descriptor(SE_SELF_RELATIVE | SE_DACL_PRESENT, owner=sid(ADMINS),
+                       dacl=acl([]))]
+        (buf, self.offsets) = sds_stream(self.descriptors)
+        self.buf = bytearray(buf)
+
+    def statuses(self):
+        return [(r.security_id, r.status, r.recovered_offset)
+                for r in verify_sds(str(self.buf))]
+
+    def test_security_hash(self):
+        self.assertEqual(security_hash(struct.pack("<II", 1, 2), 0, 8), 10)
+        # the running hash is rotated, not shifted
+        self.assertEqual(security_hash(struct.pack("<II", 0x80000000, 0),
+                                       0, 8), 4)
+        self.assertEqual(security_hash("\x01\x00\x00\x00\xff", 0, 5), 1)
+
+    def test_intact(self):
+        self.assertEqual(self.statuses(),
+                         [(0x100, SDS_MIRROR_STATUS.OK, self.offsets[0]),
+                          (0x101, SDS_MIRROR_STATUS.OK, self.offsets[1])])
+
+    def test_primary_corrupt(self):
+        self.buf[self.offsets[0] + 0x30] ^= 0xFF
+        mirror = SDS_BLOCK_SIZE + self.offsets[0]
+        self.assertEqual(self.statuses(),
+                         [(0x100, SDS_MIRROR_STATUS.PRIMARY_CORRUPT, mirror),
+                          (0x101, SDS_MIRROR_STATUS.OK, self.offsets[1])])
+        descriptors = list(sds_descriptors(str(self.buf)))
+        self.assertEqual(descriptors[0][1].owner, USER)
+
+    def test_mirror_corrupt(self):
+        self.buf[SDS_BLOCK_SIZE + self.offsets[1] + 0x20] ^= 0xFF
+        self.assertEqual(self.statuses()[1],
+                         (0x101, SDS_MIRROR_STATUS.MIRROR_CORRUPT,
+                          self.offsets[1]))
+
+    def test_mismatch(self):
+        # both copies match their hashes, but have different owners
+        other = descriptor(SE_SELF_RELATIVE | SE_DACL_PRESENT,
+                           owner=sid("S-1-5-32-545"), dacl=acl([]))
+        (buf, _) = sds_stream([self.descriptors[0], other])
+        mirror = SDS_BLOCK_SIZE + self.offsets[1]
+        self.buf[mirror:mirror + 0x14 + len(other)] = \
+            buf[self.offsets[1]:self.offsets[1] + 0x14 + len(other)]
+        struct.pack_into("<I", self.buf, mirror + 0x4, 0x101)
+        self.assertEqual(self.statuses()[1],
+                         (0x101, SDS_MIRROR_STATUS.MISMATCH,
+                          self.offsets[1]))
+
+    def test_index_mirror_fallback(self):
+        sii = sii_buffer(str(self.buf), self.offsets)
+        self.buf[self.offsets[0] + 0x30] ^= 0xFF
+        index = SecurityDescriptorIndex(sii, str(self.buf))
+        self.assertEqual(index.owner(0x100), USER)
+        self.assertEqual(index.owner(0x101), ADMINS)
+        self.assertEqual(index.owner(0x102), None)
+
+    def test_index_mirror_fallback_header(self):
+        sii = sii_buffer(str(self.buf), self.offsets)
+        # the primary header is stored for another security ID
+        struct.pack_into("<I", self.buf, self.offsets[1] + 0x4, 0x200)
+        index = SecurityDescriptorIndex(sii, str(self.buf))
+        self.assertEqual(index.owner(0x101), ADMINS)
+
+
+class AccessEvaluatorTest(unittest.TestCase):
+    def evaluator(self, *sids):
+        return AccessEvaluator(list(sids) + WELL_KNOWN_USER_SIDS)
+
+    def decode(self, aces, owner=ADMINS):
+        return decode_descriptor(descriptor(SE_SELF_RELATIVE |
+                                            SE_DACL_PRESENT,
+                                            owner=sid(owner),
+                                            dacl=acl(aces)), 0)
+
+    def test_null_dacl_allows_everyone(self):
+        d = decode_descriptor(descriptor(SE_SELF_RELATIVE | SE_DACL_PRESENT,
+                                         owner=sid(ADMINS)), 0)
+        self.assertTrue(self.evaluator(USER).allows(
+            d, ACCESS_MASK.FILE_WRITE_DATA))
+
+    def test_empty_dacl_allows_nothing(self):
+        d = self.decode([])
+        self.assertFalse(self.evaluator(USER).allows(
+            d, ACCESS_MASK.FILE_WRITE_DATA))
+
+    def test_allowed_by_group(self):
+        d = self.decode([ace(ACE_TYPES.ACCESS_ALLOWED_ACE_TYPE, 0,
+                             ACCESS_MASK.GENERIC_WRITE, EVERYONE)])
+        self.assertTrue(self.evaluator(USER).allows(
+            d, ACCESS_MASK.FILE_WRITE_DATA))
+
+    def test_deny_before_allow(self):
+        d = self.decode([ace(ACE_TYPES.ACCESS_DENIED_ACE_TYPE, 0,
+                             ACCESS_MASK.FILE_WRITE_DATA, USER),
+                         ace(ACE_TYPES.ACCESS_ALLOWED_ACE_TYPE, 0,
+                             0x1F01FF, EVERYONE)])
+        e = self.evaluator(USER)
+        self.assertFalse(e.allows(d, ACCESS_MASK.FILE_WRITE_DATA))
+        self.assertTrue(e.allows(d, ACCESS_MASK.FILE_READ_DATA))
+        self.assertTrue(self.evaluator(ADMINS).allows(
+            d, ACCESS_MASK.FILE_WRITE_DATA))
+
+    def test_allow_before_deny(self):
+        d = self.decode([ace(ACE_TYPES.ACCESS_ALLOWED_ACE_TYPE, 0,
+                             ACCESS_MASK.FILE_WRITE_DATA, USER),
+                         ace(ACE_TYPES.ACCESS_DENIED_ACE_TYPE, 0,
+                             ACCESS_MASK.FILE_WRITE_DATA, EVERYONE)])
+        self.assertTrue(self.evaluator(USER).allows(
+            d, ACCESS_MASK.FILE_WRITE_DATA))
+
+    def test_unknown_ace_type(self):
+        d = self.decode([unknown_ace(0x9, ACCESS_MASK.FILE_WRITE_DATA, USER,
+                                     "callback"),
+                         ace(ACE_TYPES.ACCESS_ALLOWED_ACE_TYPE, 0,
+                             ACCESS_MASK.FILE_READ_DATA, USER)])
+        e = self.evaluator(USER)
+        self.assertFalse(e.allows(d, ACCESS_MASK.FILE_WRITE_DATA))
+        self.assertTrue(e.allows(d, ACCESS_MASK.FILE_READ_DATA))
+
+    def test_inherit_only(self):
+        d = self.decode([ace(ACE_TYPES.ACCESS_ALLOWED_ACE_TYPE,
+                             ACE_FLAGS.INHERIT_ONLY_ACE,
+                             ACCESS_MASK.FILE_WRITE_DATA, USER)])
+        self.assertFalse(self.evaluator(USER).allows(
+            d, ACCESS_MASK.FILE_WRITE_DATA))
+
+    def test_owner(self):
+        d = self.decode([], owner=USER)
+        e = self.evaluator(USER)
+        self.assertTrue(e.allows(d, ACCESS_MASK.WRITE_DAC))
+        self.assertFalse(e.allows(d, ACCESS_MASK.FILE_WRITE_DATA))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+#!/usr/bin/python
+import os
+import sys
+import array
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from BinaryParser import StringsExtractor
+
+
+class StringsExtractorTest(unittest.TestCase):
+    def strings(self, buf, min_length=4, *args):
+        return list(StringsExtractor(min_length).strings(buf, *args))
+
+    def test_ascii(self):
+        self.assertEqual(self.strings("\x00\x01hello\x00ab\x00"),
+                         [(2, "ascii", u"hello")])
+
+    def test_utf16(self):
+        buf = "\xff" + u"world".encode("utf-16le") + "\xff"
+        self.assertEqual(self.strings(buf), [(1, "utf-16", u"world")])
+
+    def test_utf16_after_ascii(self):
+        self.assertEqual(self.strings("xyzA\x00B\x00C\x00D\x00"),
+                         [(0, "ascii", u"xyzA"), (3, "utf-16", u"ABCD")])
+
+    def test_ordered_by_offset(self):
+        buf = u"first".encode("utf-16le") + "\x00\x00second\xff" + \
+            u"third".encode("utf-16le")
+        self.assertEqual([(offset, encoding) for (offset, encoding, _)
+                          in self.strings(buf)],
+                         [(0, "utf-16"), (12, "ascii"), (19, "utf-16")])
+
+    def test_min_length(self):
+        self.assertEqual(self.strings("abc\x00abcdef", 6),
+                         [(4, "ascii", u"abcdef")])
+
+    def test_range_of_array(self):
+        buf = array.array("B", "skip\x00\x00keep\x00\x00skip")
+        self.assertEqual(self.strings(buf, 4, 6, 10),
+                         [(6, "ascii", u"keep")])
+
+
+if __name__ == "__main__":
+    unittest.main()
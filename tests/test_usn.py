@@ -0,0 +1,124 @@
+#!/usr/bin/python
+import os
+import sys
+import struct
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from MFT import MFTTreeStore
+from USN import USN_REASON
+from USN import UsnPathResolver
+from USN import reason_string
+from USN import decode_usn_record
+from USN import usn_records
+
+
+FILETIME = 130000000000000000
+
+
+def v2_record(ref, parent, usn, reason, name):
+    name = name.encode("utf-16le")
+    body = struct.pack("<QQqQIIIIHH", ref, parent, usn, FILETIME, reason,
+                       0, 0x100, 0x20, len(name), 0x3C) + name
+    length = (8 + len(body) + 7) // 8 * 8
+    record = struct.pack("<IHH", length, 2, 0) + body
+    return record + "\x00" * (length - len(record))
+
+
+def v3_record(ref, parent, usn, reason, name):
+    name = name.encode("utf-16le")
+    body = struct.pack("<QQQQqQIIIIHH", ref, 0, parent, 0, usn, FILETIME,
+                       reason, 0, 0x100, 0x20, len(name), 0x4C) + name
+    length = (8 + len(body) + 7) // 8 * 8
+    record = struct.pack("<IHH", length, 3, 0) + body
+    return record + "\x00" * (length - len(record))
+
+
+class UsnRecordTest(unittest.TestCase):
+    def test_decode_v2(self):
+        buf = v2_record((1 << 48) | 16, (5 << 48) | 5, 0x1000,
+                        USN_REASON.FILE_CREATE, u"a.txt")
+        record = decode_usn_record(buf, 0, 0x1000)
+        self.assertEqual(record.offset, 0x1000)
+        self.assertEqual(record.major_version, 2)
+        self.assertEqual(record.mft_reference, (1 << 48) | 16)
+        self.assertEqual(record.parent_reference, (5 << 48) | 5)
+        self.assertEqual(record.security_id, 0x100)
+        self.assertEqual(record.filename, u"a.txt")
+
+    def test_decode_v3(self):
+        buf = v3_record(17, 5, 0x2000, USN_REASON.FILE_DELETE, u"b.txt")
+        record = decode_usn_record(buf, 0)
+        self.assertEqual(record.major_version, 3)
+        self.assertEqual(record.mft_reference, 17)
+        self.assertEqual(record.usn, 0x2000)
+        self.assertEqual(record.filename, u"b.txt")
+
+    def test_decode_invalid(self):
+        self.assertEqual(decode_usn_record("\x00" * 0x60, 0), None)
+        buf = struct.pack("<IHH", 0x30, 9, 0) + "x" * 0x28
+        self.assertEqual(decode_usn_record(buf, 0), None)
+
+    def test_reason_string(self):
+        self.assertEqual(reason_string(USN_REASON.FILE_CREATE |
+                                       USN_REASON.CLOSE),
+                         "FILE_CREATE|CLOSE")
+
+
+class UsnRecordsTest(unittest.TestCase):
+    def test_sparse_prefix(self):
+        data = "\x00" * 0x3000 + \
+            v2_record(16, 5, 0x3000, USN_REASON.FILE_CREATE, u"a") + \
+            v3_record(17, 5, 0x3048, USN_REASON.CLOSE, u"b")
+        records = list(usn_records(StringIO(data), chunk_size=0x1000))
+        self.assertEqual([r.filename for r in records], [u"a", u"b"])
+        self.assertEqual(records[0].offset, 0x3000)
+
+    def test_zero_prefixed_slot(self):
+        # a slot whose first four bytes are zero, but not the rest,
+        #  must be skipped rather than searched again
+        data = "\x00" * 16 + "\x00" * 6 + "\x01\x00" + "\x00" * 64
+        self.assertEqual(list(usn_records(StringIO(data))), [])
+
+    def test_record_after_zero_prefixed_slot(self):
+        record = v2_record(16, 5, 0x18, USN_REASON.FILE_CREATE, u"a")
+        data = "\x00" * 16 + "\x00" * 6 + "\x01\x00" + record
+        records = list(usn_records(StringIO(data), chunk_size=0x10))
+        self.assertEqual([r.offset for r in records], [0x18])
+
+    def test_invalid_record_body(self):
+        record = v2_record(16, 5, 0x48, USN_REASON.FILE_CREATE, u"a")
+        data = struct.pack("<IHH", 0x30, 9, 0) + "\x00\x00\x00\x00x" * 8 + \
+            record
+        records = list(usn_records(StringIO(data)))
+        self.assertEqual([r.filename for r in records], [u"a"])
+
+
+class UsnPathResolverTest(unittest.TestCase):
+    def resolve(self, resolver, parent, name):
+        record = decode_usn_record(v2_record(100, parent, 0, 0, name), 0)
+        return resolver.path(record)
+
+    def test_path(self):
+        tree = MFTTreeStore()
+        tree.add(5, u".", 5, True, 5, 5)
+        tree.add(30, u"dir", 2, True, 5, 5)
+        resolver = UsnPathResolver(tree)
+        self.assertEqual(self.resolve(resolver, (2 << 48) | 30, u"a.txt"),
+                         u"\\.\\dir\\a.txt")
+        self.assertEqual(self.resolve(resolver, (5 << 48) | 5, u"b.txt"),
+                         u"\\.\\b.txt")
+        # the directory was reused since the change
+        self.assertEqual(self.resolve(resolver, (1 << 48) | 30, u"c.txt"),
+                         u"\\$OrphanFiles\\c.txt")
+        self.assertEqual(self.resolve(resolver, (1 << 48) | 31, u"d.txt"),
+                         u"\\??\\d.txt")
+        resolver = UsnPathResolver(tree, root="C:")
+        self.assertEqual(self.resolve(resolver, (2 << 48) | 30, u"a.txt"),
+                         u"C:\\dir\\a.txt")
+
+
+if __name__ == "__main__":
+    unittest.main()